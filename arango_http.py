@@ -0,0 +1,92 @@
+"""
+_________________________________
+ARANGODB HTTP CLIENT
+Pooled python-arango HTTP client, imported by database.py when a worker connects.
+_________________________________
+"""
+from time import sleep
+from random import uniform
+
+import urllib3
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout, Timeout, RequestException
+from arango.http import HTTPClient
+from arango.response import Response as ArangoResponse
+
+from database import CircuitBreaker, DatabaseUnavailable, is_read_only
+from metrics import span
+
+
+""" The cluster certificate is not verified (verify_override=False), silence the warning of every request. """
+urllib3.disable_warnings()
+
+
+""" HTTP client for python-arango with a sized connection pool, jittered retries and a circuit breaker.
+Requests are retried when their method is idempotent or they are sent inside database.read_only(),
+which the lookups wrap around their AQL cursor POSTs. """
+class PooledHTTPClient(HTTPClient):
+	IDEMPOTENT_METHODS = ("get", "head", "options")
+	RETRY_STATUS_CODES = (502, 503, 504)
+
+	def __init__(self, pool_size=10, timeout=10.0, retries=3, backoff=0.1, backoff_max=2.0, breaker=None, span_name="db"):
+		self.pool_size = pool_size
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.backoff_max = backoff_max
+		self.breaker = breaker or CircuitBreaker()
+		self.span_name = span_name
+
+	def create_session(self, host: str) -> Session:
+		# Retries are handled in send_request, the adapter only pools connections.
+		adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+		session = Session()
+		session.mount("https://", adapter)
+		session.mount("http://", adapter)
+		return session
+
+	def _delay(self, attempt: int) -> float:
+		return uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+	def send_request(self, session, method, url, headers=None, params=None, data=None, auth=None):
+		with span(self.span_name):
+			return self._send_request(session, method, url, headers, params, data, auth)
+
+	def _send_request(self, session, method, url, headers=None, params=None, data=None, auth=None):
+		self.breaker.before_request()
+		idempotent = method.lower() in self.IDEMPOTENT_METHODS or is_read_only()
+		try:
+			response = self._send_with_retries(session, method, url, headers, params, data, auth, idempotent)
+		except BaseException as error:
+			# Every way of getting no answer counts as a failure, so a failed half-open trial reopens the breaker.
+			self.breaker.record_failure()
+			if isinstance(error, RequestException):
+				raise DatabaseUnavailable(retry_after=max(1, int(self.breaker.cooldown)))
+			raise
+
+		if response.status_code in self.RETRY_STATUS_CODES:
+			self.breaker.record_failure()
+		else:
+			self.breaker.record_success()
+		return ArangoResponse(method=method, url=response.url, headers=response.headers,
+			status_code=response.status_code, status_text=response.reason, raw_body=response.text)
+
+	def _send_with_retries(self, session, method, url, headers, params, data, auth, idempotent: bool):
+		for attempt in range(self.retries + 1):
+			is_last_attempt = attempt == self.retries
+			try:
+				response = session.request(method=method, url=url, params=params, data=data,
+					headers=headers, auth=auth, timeout=self.timeout)
+			except (ConnectTimeout, RequestsConnectionError, Timeout) as error:
+				# A request that never connected is safe to send again whatever its method.
+				retryable = idempotent or isinstance(error, ConnectTimeout)
+				if is_last_attempt or not retryable:
+					raise
+				sleep(self._delay(attempt))
+				continue
+
+			if response.status_code in self.RETRY_STATUS_CODES and idempotent and not is_last_attempt:
+				sleep(self._delay(attempt))
+				continue
+			return response
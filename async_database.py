@@ -0,0 +1,115 @@
+"""
+_________________________________
+ASYNC DATABASE ACCESS
+Non-blocking ArangoDB HTTP client used by the asyncio serving mode, with the
+jittered retries and circuit breaker of arango_http.py.
+_________________________________
+"""
+import asyncio
+from os import environ
+from random import uniform
+
+import httpx
+
+from database import GET_ONE_BY_QUERY, lookup_fields, connection_settings, CircuitBreaker, DatabaseUnavailable
+from metrics import span
+
+
+""" Raised for ArangoDB error responses, mirrors the error_code of python-arango exceptions. """
+class AsyncDatabaseError(Exception):
+	def __init__(self, status_code: int, error_code: int, message: str):
+		super().__init__(message)
+		self.status_code = status_code
+		self.error_code = error_code
+
+
+""" Connects with the settings of database.connection_settings, the same user as the Flask app. """
+class AsyncDatabase():
+	RETRY_STATUS_CODES = (502, 503, 504)
+
+	def __init__(self, url=None, name=None, username=None, password=None, pool_size=None, timeout=None):
+		settings = connection_settings()
+		self.url = (url or settings["url"]).rstrip("/")
+		self.name = name or settings["name"]
+		self.username = username or settings["username"]
+		self.password = password if password is not None else settings["password"]
+		self.pool_size = pool_size or int(environ.get("ARANGO_POOL_SIZE", 64))
+		self.timeout = timeout or settings["timeout"]
+		self.retries = settings["retries"]
+		self.backoff = settings["backoff"]
+		self.backoff_max = 2.0
+		self.breaker = CircuitBreaker(threshold=settings["breaker_threshold"], cooldown=settings["breaker_cooldown"])
+		self._client = None
+
+	@property
+	def client(self) -> httpx.AsyncClient:
+		""" One pooled client per instance, created on first use, run_async.py uses its instance from one event loop. """
+		if self._client is None:
+			self._client = httpx.AsyncClient(
+				base_url=f"{self.url}/_db/{self.name}",
+				auth=(self.username, self.password),
+				limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+				timeout=self.timeout,
+				# matches verify_override=False of the synchronous client
+				verify=False)
+		return self._client
+
+	async def _send_with_retries(self, method: str, path: str, idempotent: bool, **kwargs) -> httpx.Response:
+		for attempt in range(self.retries + 1):
+			is_last_attempt = attempt == self.retries
+			try:
+				response = await self.client.request(method, path, **kwargs)
+			except httpx.TransportError as error:
+				# A request that never connected is safe to send again whatever it does.
+				if is_last_attempt or not (idempotent or isinstance(error, httpx.ConnectError)):
+					raise
+				await asyncio.sleep(uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt))))
+				continue
+
+			if response.status_code in self.RETRY_STATUS_CODES and idempotent and not is_last_attempt:
+				await asyncio.sleep(uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt))))
+				continue
+			return response
+
+	async def _request(self, method: str, path: str, idempotent=False, **kwargs) -> dict:
+		self.breaker.before_request()
+		try:
+			with span("db"):
+				response = await self._send_with_retries(method, path, idempotent, **kwargs)
+		except httpx.TransportError:
+			self.breaker.record_failure()
+			raise DatabaseUnavailable(retry_after=max(1, int(self.breaker.cooldown)))
+		except Exception:
+			self.breaker.record_failure()
+			raise
+
+		if response.status_code in self.RETRY_STATUS_CODES:
+			self.breaker.record_failure()
+			raise DatabaseUnavailable(retry_after=max(1, int(self.breaker.cooldown)))
+		self.breaker.record_success()
+		body = response.json()
+		if body.get("error"):
+			raise AsyncDatabaseError(response.status_code, body.get("errorNum"), body.get("errorMessage"))
+		return body
+
+	async def aql(self, query: str, bind_vars=None, batch_size=1000) -> list:
+		""" Runs a read-only query, its cursor POST is retried like a GET. """
+		body = await self._request("POST", "/_api/cursor", idempotent=True,
+			json={ "query": query, "bindVars": bind_vars or {}, "batchSize": batch_size })
+		results = body["result"]
+		while body.get("hasMore"):
+			body = await self._request("PUT", f"/_api/cursor/{body['id']}")
+			results.extend(body["result"])
+		return results
+
+	async def get_one_by(self, field: str, value, keep=None, collection="accounts"):
+		if field not in lookup_fields(collection):
+			raise ValueError(f'"{field}" is not an indexed lookup field of "{collection}".')
+		results = await self.aql(GET_ONE_BY_QUERY,
+			bind_vars={ "@collection": collection, "field": field, "value": value, "keep": keep })
+		return results[0] if len(results) else None
+
+	async def close(self):
+		if self._client is not None:
+			await self._client.aclose()
+			self._client = None
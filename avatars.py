@@ -0,0 +1,114 @@
+"""
+_________________________________
+AVATAR RESOLVER
+Looks up Gravatar profiles for the avatar job, signups never wait on the upstream.
+_________________________________
+"""
+from os import environ
+from hashlib import md5
+from time import monotonic
+from threading import Lock
+from collections import OrderedDict
+
+from metrics import logger
+
+
+""" Fallback avatar every account starts with. """
+def fallback_avatar_url(username: str) -> str:
+	return f"https://avatars.dicebear.com/api/pixel-art-neutral/{username}.svg"
+
+
+class AvatarResolver():
+	def __init__(self, base_url=None, timeout=None, ttl=None, negative_ttl=None, cache_size=None, retries=None, backoff=None, breaker=None):
+		self.base_url = (base_url or environ.get("GRAVATAR_URL", "https://www.gravatar.com")).rstrip("/")
+		self.timeout = timeout or float(environ.get("GRAVATAR_TIMEOUT", 2))
+		self.retries = retries if retries is not None else int(environ.get("GRAVATAR_RETRIES", 1))
+		self.backoff = backoff if backoff is not None else float(environ.get("GRAVATAR_BACKOFF", 0.1))
+		self.breaker = breaker
+		self.ttl = ttl or float(environ.get("AVATAR_CACHE_TTL", 86400))
+		self.negative_ttl = negative_ttl or float(environ.get("AVATAR_CACHE_NEGATIVE_TTL", 3600))
+		self.cache_size = cache_size or int(environ.get("AVATAR_CACHE_SIZE", 10000))
+
+		self._cache = OrderedDict()
+		self._lock = Lock()
+		self._http = None
+		self._session = None
+		self._metrics = {
+			"cache_hits": 0, "cache_misses": 0,
+			"upstream_requests": 0, "upstream_errors": 0,
+			"upstream_latency_total": 0.0, "upstream_latency_max": 0.0 }
+
+	def _count(self, metric: str, value=1):
+		with self._lock:
+			self._metrics[metric] += value
+
+	def _cached(self, email_hash: str):
+		with self._lock:
+			entry = self._cache.get(email_hash)
+			if entry is not None and entry[1] > monotonic():
+				self._cache.move_to_end(email_hash)
+				self._metrics["cache_hits"] += 1
+				return entry
+			self._metrics["cache_misses"] += 1
+			return None
+
+	def _client(self):
+		""" Pooled client of arango_http, GET lookups are retried and a failing upstream opens the breaker. """
+		with self._lock:
+			if self._http is None:
+				from arango_http import PooledHTTPClient
+				from database import CircuitBreaker
+				breaker = self.breaker or CircuitBreaker(threshold=int(environ.get("GRAVATAR_BREAKER_THRESHOLD", 5)),
+					cooldown=float(environ.get("GRAVATAR_BREAKER_COOLDOWN", 30)))
+				self._http = PooledHTTPClient(pool_size=2, timeout=self.timeout, retries=self.retries,
+					backoff=self.backoff, breaker=breaker, span_name="http")
+				self._session = self._http.create_session(self.base_url)
+			return self._http, self._session
+
+	def _store(self, email_hash: str, image_url):
+		ttl = self.ttl if image_url is not None else self.negative_ttl
+		with self._lock:
+			self._cache[email_hash] = (image_url, monotonic() + ttl)
+			self._cache.move_to_end(email_hash)
+			while len(self._cache) > self.cache_size:
+				self._cache.popitem(last=False)
+
+	def resolve(self, email_address: str):
+		""" Returns the Gravatar image url, or None when the address has no Gravatar profile. """
+		email_hash = md5(email_address.strip().lower().encode("utf-8")).hexdigest()
+		cached = self._cached(email_hash)
+		if cached is not None:
+			return cached[0]
+
+		started = monotonic()
+		try:
+			self._count("upstream_requests")
+			http, session = self._client()
+			status_code = http.send_request(session, "get", f"{self.base_url}/{email_hash}.json").status_code
+		except:
+			# Upstream failures and an open breaker are not cached, the account keeps its fallback avatar.
+			self._count("upstream_errors")
+			return None
+		finally:
+			elapsed = monotonic() - started
+			with self._lock:
+				self._metrics["upstream_latency_total"] += elapsed
+				self._metrics["upstream_latency_max"] = max(self._metrics["upstream_latency_max"], elapsed)
+
+		if status_code == 404:
+			self._store(email_hash, None)
+			return None
+		elif status_code == 200:
+			image_url = f"{self.base_url}/avatar/{email_hash}"
+			self._store(email_hash, image_url)
+			return image_url
+		self._count("upstream_errors")
+		return None
+
+	def metrics(self) -> dict:
+		with self._lock:
+			metrics = { **self._metrics }
+			metrics["breaker_state"] = self._http.breaker.state if self._http else "closed"
+		metrics["upstream_latency_avg"] = (metrics["upstream_latency_total"] / metrics["upstream_requests"]
+			if metrics["upstream_requests"] else 0.0)
+		return metrics
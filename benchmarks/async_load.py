@@ -0,0 +1,159 @@
+"""
+_________________________________
+ASYNC SERVING LOAD TEST
+Serves the app with uvicorn twice, once with run_async.py and once with every
+request on the Flask app over ASYNC_FLASK_THREADS=--threads threads, the
+processes * threads requests the uwsgi setup serves at a time. Both answer
+profile reads from an HTTP ArangoDB stand-in (benchmarks/fault_http.py) that
+takes --latency-ms per query; httpx keeps --concurrency clients busy:
+	python -m benchmarks.async_load --concurrency 500 --requests 10000 --latency-ms 20 --output async.json
+The profile cache is off (PROFILE_CACHE_TTL=0) so every read waits on the
+stand-in. --arango-url points both at a real ArangoDB instead, with
+DATABASE_NAME, ARANGO_PASSWORD and --username naming an existing account.
+_________________________________
+"""
+import argparse
+import asyncio
+import socket
+import subprocess
+import sys
+import tempfile
+from os import environ, path
+from time import perf_counter, sleep, time
+
+import httpx
+
+from benchmarks import results
+from benchmarks.fault_http import FaultServer
+
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+""" uvicorn application of each scenario. """
+APPLICATIONS = { "asyncio": "run_async:application", "threaded": "benchmarks.async_load:threaded_application" }
+
+""" Account the stand-in answers every lookup with. """
+ACCOUNT = {
+	"_id": "accounts/1", "_key": "1", "_rev": "_load", "username": "loaded", "email_address": "loaded@load.test",
+	"display_name": "Loaded Account", "time_created": { "timestamp": 0 }, "last_modified": { "timestamp": 0 } }
+
+
+async def threaded_application(scope, receive, send):
+	""" Every request on the Flask app thread pool, profile reads included. """
+	import run_async
+	if scope["type"] == "lifespan":
+		return await run_async.lifespan(receive, send)
+	return await run_async.call_flask(scope, receive, send)
+
+
+def free_port() -> int:
+	with socket.socket() as probe:
+		probe.bind(("127.0.0.1", 0))
+		return probe.getsockname()[1]
+
+
+def start_server(name: str, args, arango_url: str, port: int) -> subprocess.Popen:
+	settings = {
+		"environment": "production", "SEED": environ.get("SEED", "benchmark-seed"), "ACCESS_LOG": "false",
+		"JOBS_IN_PROCESS": "false", "ENSURE_INDEXES_ON_STARTUP": "false", "PROFILE_CACHE_TTL": "0",
+		"ARANGO_URL": arango_url, "DATABASE_NAME": environ.get("DATABASE_NAME", "hetch"),
+		"ARANGO_PASSWORD": environ.get("ARANGO_PASSWORD", ""), "ARANGO_POOL_SIZE": str(args.concurrency),
+		"JWT_KEYRING": path.join(tempfile.mkdtemp(prefix="hetch-load-"), "keyring.json") }
+	if name == "threaded":
+		settings["ASYNC_FLASK_THREADS"] = str(args.threads)
+	# Pooled client connections can sit idle for seconds while the others are served, they are kept open.
+	return subprocess.Popen([sys.executable, "-m", "uvicorn", APPLICATIONS[name], "--host", "127.0.0.1",
+		"--port", str(port), "--no-access-log", "--log-level", "warning", "--timeout-keep-alive", "120",
+		"--backlog", str(args.concurrency * 2)], cwd=ROOT, env={ **environ, **settings })
+
+
+def wait_until_serving(url: str, server: subprocess.Popen, timeout: float = 30.0):
+	deadline = time() + timeout
+	while time() < deadline:
+		if server.poll() is not None:
+			raise RuntimeError(f"Server exited with {server.returncode}.")
+		try:
+			httpx.get(f"{url}/accounts/status", timeout=1.0)
+			return
+		except httpx.HTTPError:
+			sleep(0.1)
+	raise RuntimeError(f"Server at {url} did not answer within {timeout} seconds.")
+
+
+async def drive(url: str, username: str, requests: int, concurrency: int) -> tuple:
+	""" Runs the requests from concurrency clients at once, returns (latencies, statuses, elapsed). """
+	latencies, statuses = [], []
+	remaining = iter(range(requests))
+	limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+	async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120.0) as client:
+		async def run_client():
+			for _ in remaining:
+				started = perf_counter()
+				try:
+					status = (await client.get(f"/accounts/{username}/")).status_code
+				except httpx.HTTPError as error:
+					# Counted under the name of the error, a client that could not connect got no answer at all.
+					status = type(error).__name__
+				latencies.append(perf_counter() - started)
+				statuses.append(status)
+
+		started = perf_counter()
+		await asyncio.gather(*[run_client() for _ in range(concurrency)])
+		return latencies, statuses, perf_counter() - started
+
+
+def run_scenario(name: str, args, arango_url: str) -> dict:
+	port = free_port()
+	url = f"http://127.0.0.1:{port}"
+	server = start_server(name, args, arango_url, port)
+	try:
+		wait_until_serving(url, server)
+		asyncio.run(drive(url, args.username, args.warmup, args.concurrency))
+		latencies, statuses, elapsed = asyncio.run(drive(url, args.username, args.requests, args.concurrency))
+	finally:
+		server.terminate()
+		server.wait()
+
+	counted = {}
+	for status in statuses:
+		counted[str(status)] = counted.get(str(status), 0) + 1
+	return results.summarize(latencies, elapsed, errors=sum(1 for status in statuses if status != 200),
+		statuses=counted, concurrency=args.concurrency)
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--scenarios", default=",".join(APPLICATIONS), help="Comma separated scenarios to run.")
+	parser.add_argument("--requests", type=int, default=10000, help="Timed profile reads per scenario.")
+	parser.add_argument("--warmup", type=int, default=1000, help="Profile reads sent before timing starts.")
+	parser.add_argument("--concurrency", type=int, default=500, help="Clients sending requests at the same time.")
+	parser.add_argument("--threads", type=int, default=8, help="Flask threads of the threaded scenario.")
+	parser.add_argument("--latency-ms", type=float, default=20.0, help="Time the stand-in takes per query.")
+	parser.add_argument("--arango-url", help="Real ArangoDB to read from instead of the stand-in.")
+	parser.add_argument("--username", default=ACCOUNT["username"], help="Account whose profile is read.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	stand_in = None
+	arango_url = args.arango_url
+	if arango_url is None:
+		stand_in = FaultServer(latency=args.latency_ms / 1000, documents=[ACCOUNT]).start()
+		arango_url = stand_in.url
+
+	scenarios = {}
+	try:
+		for name in args.scenarios.split(","):
+			scenarios[name.strip()] = run_scenario(name.strip(), args, arango_url)
+	finally:
+		if stand_in is not None:
+			stand_in.shutdown()
+			stand_in.server_close()
+
+	return results.finish(args, scenarios, {
+		"requests": args.requests, "concurrency": args.concurrency, "threads": args.threads,
+		"latency_ms": None if args.arango_url else args.latency_ms, "arango_url": args.arango_url })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+_________________________________
+COLD START
+Measures a fresh interpreter importing the server and answering its first
+request, the work every worker restart pays:
+	python -m benchmarks.coldstart --runs 10 --output coldstart.json
+	import_server       importing server.py, app creation included
+	first_response      process start until GET /accounts/status has answered
+The first request uses the in-memory database stand-in, the time spent
+importing the stand-in itself is not counted. Importing the server must not
+load any module of HEAVY_MODULES, each one that is loaded counts as an error.
+_________________________________
+"""
+import argparse
+import json
+import sys
+import subprocess
+from os import environ, path
+
+from benchmarks import results
+
+
+""" Modules the routes only need after a worker starts serving. dotenv is left out, Flask imports it when installed. """
+HEAVY_MODULES = ("arango", "passlib", "requests", "urllib3")
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+""" Runs in a fresh interpreter and prints its timings as JSON. """
+CHILD = """
+from time import perf_counter
+started = perf_counter()
+import sys
+import server
+imported = perf_counter()
+eager = [name for name in HEAVY_MODULES if name in sys.modules]
+
+import database
+from benchmarks.fake_arango import FakeDatabase
+fake_started = perf_counter()
+database.use_database(FakeDatabase())
+fake_imported = perf_counter()
+status_code = server.server_instance.test_client().get("/accounts/status").status_code
+answered = perf_counter()
+
+import json
+print(json.dumps({
+	"import_server": imported - started,
+	"first_response": (answered - started) - (fake_imported - fake_started),
+	"status_code": status_code, "eager": eager }))
+"""
+
+
+def run_child() -> dict:
+	script = f"HEAVY_MODULES = {HEAVY_MODULES!r}\n" + CHILD
+	output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True,
+		env={ **environ, "environment": "production", "SEED": environ.get("SEED", "benchmark-seed"), "ACCESS_LOG": "false", "JOBS_IN_PROCESS": "false" })
+	if output.returncode != 0:
+		raise RuntimeError(output.stderr)
+	return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters started.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	runs = [run_child() for _ in range(args.runs)]
+	eager = sorted({ name for run in runs for name in run["eager"] })
+	failed = sum(1 for run in runs if run["status_code"] != 200)
+	scenarios = {
+		"import_server": results.summarize([run["import_server"] for run in runs],
+			sum(run["import_server"] for run in runs), errors=len(eager), eager_modules=eager),
+		"first_response": results.summarize([run["first_response"] for run in runs],
+			sum(run["first_response"] for run in runs), errors=failed) }
+	return results.finish(args, scenarios, { "runs": args.runs })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
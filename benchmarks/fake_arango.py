@@ -0,0 +1,384 @@
+"""
+_________________________________
+IN-MEMORY ARANGODB STAND-IN
+Implements the parts of the python-arango database and collection API the
+service uses. AQL is not interpreted: every query constant the routes execute
+has a Python handler registered in FakeDatabase.QUERY_HANDLERS.
+Every operation can be given an injected latency.
+_________________________________
+"""
+from copy import deepcopy
+from time import sleep
+from random import uniform
+from threading import RLock
+from itertools import count
+from types import SimpleNamespace
+
+from arango.exceptions import (
+	AQLQueryExecuteError,
+	DocumentInsertError,
+	DocumentUpdateError,
+	DocumentDeleteError )
+
+import database
+import verification
+import search
+import migrations
+import jobs
+import notifications
+import exports
+
+
+UNIQUE_CONSTRAINT_ERROR = 1210
+CONFLICT_ERROR = 1200
+DOCUMENT_NOT_FOUND_ERROR = 1202
+
+
+def server_error(error_class, error_code: int, message: str):
+	""" Builds a python-arango server error the way the real client would raise it. """
+	response = SimpleNamespace(error_message=message, error_code=error_code, status_text=message,
+		status_code=409 if error_code in (UNIQUE_CONSTRAINT_ERROR, CONFLICT_ERROR) else 404,
+		url="http://fake-arango", method="post", headers={})
+	return error_class(response, SimpleNamespace())
+
+
+def merge_patch(document: dict, patch: dict, keep_null: bool = True) -> dict:
+	merged = { **document }
+	for field, value in patch.items():
+		if value is None and not keep_null:
+			merged.pop(field, None)
+		elif isinstance(value, dict) and isinstance(merged.get(field), dict):
+			merged[field] = merge_patch(merged[field], value, keep_null)
+		else:
+			merged[field] = value
+	return merged
+
+
+def trigrams(value: str) -> set:
+	return { value[index:index + 3] for index in range(len(value) - 2) }
+
+
+class FakeCursor():
+	def __init__(self, results):
+		self._results = list(results)
+
+	def __iter__(self):
+		return iter(self._results)
+
+	def __len__(self):
+		return len(self._results)
+
+	def count(self):
+		return len(self._results)
+
+	def close(self, ignore_missing=False):
+		return True
+
+
+class FakeCollection():
+	def __init__(self, db, name: str, edge: bool = False):
+		self.db = db
+		self.name = name
+		self.edge = edge
+		self.documents = {}
+		# Unique constraints come from the same registry the real indexes are created from.
+		self.unique_fields = [index["fields"] for index in database.INDEXES.get(name, [])
+			if index["type"] == "persistent" and index.get("unique")]
+		self._keys = count(1)
+		self._revisions = count(1)
+
+	def _metadata(self, document: dict) -> dict:
+		return { "_id": document["_id"], "_key": document["_key"], "_rev": document["_rev"] }
+
+	def _violates_unique(self, document: dict, ignore_key=None):
+		""" Returns the fields of the violated unique index, None when there is none. """
+		for fields in self.unique_fields:
+			values = [document.get(field) for field in fields]
+			if None in values:
+				continue
+			for other in self.documents.values():
+				if other["_key"] != ignore_key and [other.get(field) for field in fields] == values:
+					return fields
+		return None
+
+	def _unique_error(self, error_class, fields):
+		# Same wording as ArangoDB, callers tell the violated index apart by its fields.
+		over = ", ".join(f"'{field}'" for field in fields) if fields else "'_key'"
+		return server_error(error_class, UNIQUE_CONSTRAINT_ERROR,
+			f"unique constraint violated - in index of type persistent over {over}")
+
+	def _store(self, document: dict) -> dict:
+		document["_rev"] = f"_rev{next(self._revisions)}"
+		self.documents[document["_key"]] = document
+		return document
+
+	def find(self, filters: dict, skip=None, limit=None) -> FakeCursor:
+		self.db.wait()
+		with self.db.lock:
+			return FakeCursor(deepcopy(document) for document in self.documents.values()
+				if all(document.get(field) == value for field, value in filters.items()))
+
+	def get(self, document):
+		self.db.wait()
+		key = document["_key"] if isinstance(document, dict) else str(document).split("/")[-1]
+		with self.db.lock:
+			stored = self.documents.get(key)
+			return deepcopy(stored) if stored is not None else None
+
+	def insert(self, document: dict, return_new=False, silent=False, overwrite=False, **kwargs):
+		self.db.wait()
+		with self.db.lock:
+			if overwrite and document.get("_key") is not None:
+				self.documents.pop(str(document["_key"]), None)
+			return self._insert(document, return_new, silent)
+
+	def _insert(self, document: dict, return_new=False, silent=False):
+		document = deepcopy(document)
+		document["_key"] = str(document.get("_key") or next(self._keys))
+		document["_id"] = f"{self.name}/{document['_key']}"
+		if document["_key"] in self.documents:
+			raise self._unique_error(DocumentInsertError, None)
+		violated = self._violates_unique(document)
+		if violated is not None:
+			raise self._unique_error(DocumentInsertError, violated)
+		self._store(document)
+		if silent:
+			return True
+		metadata = self._metadata(document)
+		if return_new:
+			metadata["new"] = deepcopy(document)
+		return metadata
+
+	def insert_many(self, documents: list, return_new=False, silent=False, overwrite_mode=None, **kwargs):
+		self.db.wait()
+		results = []
+		with self.db.lock:
+			for document in documents:
+				existing = self.documents.get(str(document.get("_key")))
+				if overwrite_mode == "ignore" and existing is not None:
+					results.append(self._metadata(existing))
+					continue
+				try:
+					results.append(self._insert(document, return_new, False))
+				except DocumentInsertError as error:
+					results.append(error)
+		return True if silent else results
+
+	def update(self, document: dict, check_rev=True, merge=True, keep_none=True, return_new=False, silent=False, **kwargs):
+		self.db.wait()
+		with self.db.lock:
+			stored = self.documents.get(document["_key"])
+			if stored is None:
+				raise server_error(DocumentUpdateError, DOCUMENT_NOT_FOUND_ERROR, "document not found")
+			if check_rev and document.get("_rev") not in (None, stored["_rev"]):
+				raise server_error(DocumentUpdateError, CONFLICT_ERROR, "conflict")
+			patch = { field: value for field, value in document.items() if field not in ("_id", "_key", "_rev") }
+			updated = self._store(merge_patch(stored, patch, keep_none))
+			metadata = { **self._metadata(updated), "_old_rev": stored["_rev"] }
+			if return_new:
+				metadata["new"] = deepcopy(updated)
+			return True if silent else metadata
+
+	def delete(self, document, ignore_missing=False, **kwargs):
+		self.db.wait()
+		key = document["_key"] if isinstance(document, dict) else str(document).split("/")[-1]
+		with self.db.lock:
+			if self.documents.pop(key, None) is None:
+				if ignore_missing:
+					return False
+				raise server_error(DocumentDeleteError, DOCUMENT_NOT_FOUND_ERROR, "document not found")
+			return True
+
+	def indexes(self) -> list:
+		return []
+
+	def count(self) -> int:
+		return len(self.documents)
+
+
+class FakeAQL():
+	def __init__(self, db):
+		self.db = db
+
+	def execute(self, query: str, bind_vars=None, **kwargs) -> FakeCursor:
+		handler = self.db.QUERY_HANDLERS.get(query)
+		if handler is None:
+			raise NotImplementedError(f"The stand-in has no handler for query: {query.strip()[:80]}")
+		self.db.wait()
+		with self.db.lock:
+			return FakeCursor(deepcopy(list(handler(self.db, bind_vars or {}))))
+
+
+class FakeDatabase():
+	def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+		self.latency = latency
+		self.jitter = jitter
+		self.lock = RLock()
+		self.aql = FakeAQL(self)
+		self.collections = {}
+		for name, options in database.COLLECTIONS.items():
+			self.create_collection(name, edge=options["edge"])
+
+	def wait(self):
+		""" Injected round trip latency. """
+		if self.latency or self.jitter:
+			sleep(self.latency + uniform(0, self.jitter))
+
+	def has_collection(self, name: str) -> bool:
+		return name in self.collections
+
+	def create_collection(self, name: str, edge: bool = False) -> FakeCollection:
+		self.collections[name] = FakeCollection(self, name, edge)
+		return self.collections[name]
+
+	def collection(self, name: str) -> FakeCollection:
+		return self.collections[name]
+
+	def _first_by(self, collection: str, field: str, value):
+		for document in self.collections[collection].documents.values():
+			if document.get(field) == value:
+				return document
+		return None
+
+	"""
+	__________________________________
+	QUERY HANDLERS
+	__________________________________
+	"""
+	def _get_one_by(self, bind_vars: dict):
+		document = self._first_by(bind_vars["@collection"], bind_vars["field"], bind_vars["value"])
+		if document is None:
+			return []
+		keep = bind_vars.get("keep")
+		return [document if keep is None else { field: document[field] for field in keep if field in document }]
+
+	def _get_many_by(self, bind_vars: dict):
+		keep = bind_vars.get("keep")
+		for value in bind_vars["values"]:
+			document = self._first_by(bind_vars["@collection"], bind_vars["field"], value)
+			if document is not None and keep is not None:
+				document = { field: document[field] for field in keep if field in document }
+			yield document
+
+	def _update_one_by(self, bind_vars: dict):
+		collection = self.collections[bind_vars["@collection"]]
+		document = self._first_by(bind_vars["@collection"], bind_vars["field"], bind_vars["value"])
+		if document is None:
+			return []
+		if bind_vars.get("rev") is not None and bind_vars["rev"] != document["_rev"]:
+			raise server_error(AQLQueryExecuteError, CONFLICT_ERROR, "conflict, _rev values do not match")
+		patch = { field: value for field, value in bind_vars["patch"].items() if field not in ("_id", "_key", "_rev") }
+		merged = merge_patch(document, patch, keep_null=False)
+		violated = collection._violates_unique(merged, ignore_key=document["_key"])
+		if violated is not None:
+			raise collection._unique_error(AQLQueryExecuteError, violated)
+		updated = collection._store(merged)
+		return [{ field: value for field, value in updated.items() if field not in bind_vars["unset"] }]
+
+	def _evict_verification_codes(self, bind_vars: dict):
+		codes = self.collections["verification_codes"].documents
+		owned = sorted((code for code in codes.values() if code["account"] == bind_vars["account"]),
+			key=lambda code: code["time_created"]["timestamp"], reverse=True)
+		for code in owned[bind_vars["keep"]:]:
+			del codes[code["_key"]]
+		return []
+
+	def _consume_verification_code(self, bind_vars: dict):
+		codes = self.collections["verification_codes"].documents
+		for code in list(codes.values()):
+			if code["account"] == bind_vars["account"] and code["code"] == bind_vars["code"] and code["expire_at"] > bind_vars["now"]:
+				del codes[code["_key"]]
+				return [code["_key"]]
+		return []
+
+	def _search(self, bind_vars: dict):
+		# Lowercased prefix and trigram overlap stand in for the view analyzers, prefix matches rank first.
+		q = bind_vars["q"].strip().lower()
+		query_trigrams = trigrams(q)
+		ranked = []
+		for document in self.collections["accounts"].documents.values():
+			values = [str(document.get(field) or "").lower() for field in ("username", "display_name")]
+			if any(value.startswith(q) for value in values):
+				score = 2.0
+			elif "threshold" in bind_vars and len(query_trigrams):
+				score = max(len(query_trigrams & trigrams(value)) / len(query_trigrams) for value in values)
+				if score < bind_vars["threshold"]:
+					continue
+			else:
+				continue
+			ranked.append((-score, document["username"], document))
+		ranked.sort(key=lambda entry: entry[:2])
+		return [{ field: document[field] for field in bind_vars["fields"] if field in document }
+			for _, _, document in ranked[bind_vars["offset"]:bind_vars["offset"] + bind_vars["limit"]]]
+
+	def _bulk_chunk(self, bind_vars: dict):
+		after = bind_vars["after"]
+		chunk = sorted((document for document in self.collections["accounts"].documents.values()
+			if after is None or document["_key"] > after), key=lambda document: document["_key"])[:bind_vars["chunk_size"]]
+		return [{
+			"last": chunk[-1]["_key"] if len(chunk) else None, "scanned": len(chunk),
+			"pending": [document for document in chunk
+				if document.get("_schema_version_", bind_vars["initial"]) < bind_vars["latest"]] }]
+
+	def _write_back(self, bind_vars: dict):
+		accounts = self.collections["accounts"]
+		for item in bind_vars["items"]:
+			document = accounts.documents.get(item["key"])
+			if document is None or document["_rev"] != item["rev"]:
+				continue
+			updated = { **document, **item["patch"], "last_modified": bind_vars["modified"] }
+			yield accounts._store({ field: value for field, value in updated.items() if value is not None })["username"]
+
+	def _job_stats(self, bind_vars: dict):
+		statuses = {}
+		for job in self.collections["jobs"].documents.values():
+			count, oldest = statuses.get(job["status"], (0, None))
+			statuses[job["status"]] = (count + 1, job["run_at"] if oldest is None else min(oldest, job["run_at"]))
+		return [{ "status": status, "count": count, "oldest": oldest } for status, (count, oldest) in statuses.items()]
+
+	def _pending_notification_arrays(self, bind_vars: dict):
+		pending = [document for document in self.collections["accounts"].documents.values() if "notifications" in document]
+		return [{ "_key": document["_key"], "notifications": document["notifications"] if isinstance(document["notifications"], list) else [] }
+			for document in pending[:bind_vars["batch_size"]]]
+
+	def _clear_notification_arrays(self, bind_vars: dict):
+		accounts = self.collections["accounts"]
+		for item in bind_vars["accounts"]:
+			document = accounts.documents.get(item["key"])
+			if document is None:
+				continue
+			cleared = { field: value for field, value in document.items() if field != "notifications" }
+			cleared["unread_notifications"] = (document.get("unread_notifications") or 0) + item["unread"]
+			cleared["last_modified"] = bind_vars["modified"]
+			accounts._store(cleared)
+		return []
+
+	def _export(self, bind_vars: dict):
+		field, after, until = bind_vars["field"], bind_vars["after"], bind_vars.get("until")
+		positions = sorted(((document.get(field) or {}).get("timestamp"), key)
+			for key, document in self.collections["accounts"].documents.items())
+		for timestamp, key in positions:
+			if timestamp is None or timestamp < bind_vars["since"] or (until is not None and timestamp >= until):
+				continue
+			if after is not None and [timestamp, key] <= after:
+				continue
+			document = self.collections["accounts"].documents[key]
+			yield { **{ kept: document[kept] for kept in bind_vars["keep"] if kept in document }, "_key": key }
+
+	QUERY_HANDLERS = {
+		database.GET_ONE_BY_QUERY: _get_one_by,
+		database.GET_MANY_BY_QUERY: _get_many_by,
+		database.UPDATE_ONE_BY_QUERY: _update_one_by,
+		database.UPDATE_ONE_BY_REVISION_QUERY: _update_one_by,
+		verification.EVICT_QUERY: _evict_verification_codes,
+		verification.CONSUME_QUERY: _consume_verification_code,
+		search.PREFIX_SEARCH_QUERY: _search,
+		search.SEARCH_QUERY: _search,
+		migrations.BULK_CHUNK_QUERY: _bulk_chunk,
+		migrations.WRITE_BACK_QUERY: _write_back,
+		jobs.STATS_QUERY: _job_stats,
+		notifications.PENDING_ACCOUNTS_QUERY: _pending_notification_arrays,
+		notifications.CLEAR_ARRAYS_QUERY: _clear_notification_arrays,
+		exports.EXPORT_QUERY: _export,
+		exports.EXPORT_UNTIL_QUERY: _export,
+	}
@@ -0,0 +1,166 @@
+"""
+_________________________________
+FAULT-INJECTING HTTP STAND-IN
+Sits where ArangoDB would and breaks some of the requests it gets, to see
+the retries and the circuit breaker of arango_http.py at work:
+	python -m benchmarks.fault_http --port 8530 --upstream http://localhost:8529 --drop 0.05 --unavailable 0.05 --delay 0.05 --delay-ms 2000
+	ARANGO_URL=http://localhost:8530 flask run
+Faults per request:
+	ok           answers, from --upstream when given, an AQL result of the given documents and status otherwise
+	drop         closes the connection without an answer
+	delay        waits --delay-ms before answering, past ARANGO_TIMEOUT
+	unavailable  answers 503
+	truncate     breaks off a chunked answer halfway
+Tests script the fault of each request with FaultServer.script().
+_________________________________
+"""
+import argparse
+import json
+import sys
+from time import sleep
+from random import random
+from threading import Lock, Thread
+from collections import deque
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FAULTS = ("ok", "drop", "delay", "unavailable", "truncate")
+
+""" Answer of "ok" without an upstream, an AQL cursor with the documents of the server as results. """
+def cursor(documents: list) -> dict:
+	return { "error": False, "code": 201, "result": documents, "hasMore": False, "cached": False, "extra": {} }
+
+
+class FaultHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def answer(self, status: int, body: bytes, headers=()):
+		self.send_response(status)
+		for name, value in headers:
+			self.send_header(name, value)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def forward(self, body: bytes):
+		upstream = Request(self.server.upstream + self.path, data=body if body else None, method=self.command,
+			headers={ name: value for name, value in self.headers.items() if name.lower() not in ("host", "content-length") })
+		try:
+			with urlopen(upstream, timeout=60) as response:
+				return response.status, response.read()
+		except HTTPError as error:
+			return error.code, error.read()
+
+	def handle_request(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		fault = self.server.next_fault()
+		self.server.record(self.command, self.path, fault)
+
+		if fault == "drop":
+			self.close_connection = True
+			return
+		if fault == "unavailable":
+			self.answer(503, json.dumps({ "error": True, "code": 503, "errorNum": 503, "errorMessage": "injected" }).encode())
+			return
+		if fault == "truncate":
+			self.send_response(200)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Transfer-Encoding", "chunked")
+			self.end_headers()
+			self.wfile.write(b"40\r\n{\"error\":false,")
+			self.close_connection = True
+			return
+		if fault == "delay":
+			sleep(self.server.delay)
+		if self.server.latency:
+			sleep(self.server.latency)
+
+		status, answer = self.forward(body) if self.server.upstream else (self.server.status, self.server.answer)
+		try:
+			self.answer(status, answer)
+		except (BrokenPipeError, ConnectionResetError):
+			# The client gave up waiting for a delayed answer.
+			self.close_connection = True
+
+	do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = handle_request
+
+
+class FaultServer(ThreadingHTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+	def __init__(self, host: str = "127.0.0.1", port: int = 0, upstream: str = None, delay: float = 1.0, rates: dict = None,
+		latency: float = 0.0, documents: list = None, status: int = 201):
+		super().__init__((host, port), FaultHandler)
+		self.upstream = upstream.rstrip("/") if upstream else None
+		self.delay = delay
+		self.latency = latency
+		self.status = status
+		self.answer = json.dumps(cursor(documents or [])).encode()
+		self.rates = rates or {}
+		self.requests = []
+		self._script = deque()
+		self._lock = Lock()
+
+	@property
+	def url(self) -> str:
+		return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+	def script(self, *faults):
+		""" Faults of the next requests in order, the random rates apply once they are used up. """
+		with self._lock:
+			self._script.extend(faults)
+
+	def next_fault(self) -> str:
+		with self._lock:
+			if len(self._script):
+				return self._script.popleft()
+		draw = random()
+		for fault, rate in self.rates.items():
+			if draw < rate:
+				return fault
+			draw -= rate
+		return "ok"
+
+	def record(self, method: str, path: str, fault: str):
+		with self._lock:
+			self.requests.append((method, path, fault))
+
+	def start(self):
+		""" Serves from a daemon thread, returns the server. """
+		Thread(target=self.serve_forever, args=(0.05,), name="fault-http", daemon=True).start()
+		return self
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8530)
+	parser.add_argument("--upstream", help="ArangoDB to forward the requests that are not broken to.")
+	parser.add_argument("--delay-ms", type=float, default=2000.0)
+	for fault in FAULTS[1:]:
+		parser.add_argument(f"--{fault}", type=float, default=0.0, help=f"Share of requests that get the {fault} fault.")
+	args = parser.parse_args()
+
+	server = FaultServer(args.host, args.port, args.upstream, args.delay_ms / 1000,
+		{ fault: getattr(args, fault) for fault in FAULTS[1:] if getattr(args, fault) })
+	print(f"Injecting faults on {server.url}" + (f" in front of {args.upstream}" if args.upstream else ""))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		counted = {}
+		for _, _, fault in server.requests:
+			counted[fault] = counted.get(fault, 0) + 1
+		print(counted)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
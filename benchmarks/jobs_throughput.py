@@ -0,0 +1,86 @@
+"""
+_________________________________
+JOB QUEUE THROUGHPUT
+Compares sending email inside the request with enqueueing it as a job, on a
+file job store and the local SMTP stand-in:
+	python -m benchmarks.jobs_throughput --messages 500 --batch-sizes 1,10,50 --message-delay 1 --handshake-delay 20
+"send_inline" times one connection and message per request, as the routes
+would without jobs. Every "jobs_batch_*" scenario times the enqueues the
+requests wait on, then how long the workers take to deliver every message
+and how many connections they open for it.
+_________________________________
+"""
+import argparse
+import sys
+import tempfile
+from os import environ, path
+from time import perf_counter, sleep
+
+from benchmarks import results
+from benchmarks.smtp_sink import SMTPSink
+
+
+def drain(queue, timeout: float) -> bool:
+	""" Waits until no job is queued or running, returns False on timeout. """
+	deadline = perf_counter() + timeout
+	while perf_counter() < deadline:
+		stats = queue.store.stats(0)
+		if stats["queued"] == 0 and stats["running"] == 0:
+			return True
+		sleep(0.01)
+	return False
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--messages", type=int, default=500)
+	parser.add_argument("--batch-sizes", default="1,10,50", help="Comma separated email job batch sizes.")
+	parser.add_argument("--workers", type=int, default=2)
+	parser.add_argument("--handshake-delay", type=float, default=20.0, help="Milliseconds the stand-in takes to greet a connection.")
+	parser.add_argument("--message-delay", type=float, default=1.0, help="Milliseconds the stand-in takes per message.")
+	parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for the workers to deliver everything.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	sink = SMTPSink(handshake_delay=args.handshake_delay / 1000, message_delay=args.message_delay / 1000).start()
+	directory = tempfile.mkdtemp(prefix="jobs-benchmark-")
+	environ.update(SMTP_HOST="127.0.0.1", SMTP_PORT=str(sink.port), SMTP_SECURITY="none", SMTP_USERNAME="",
+		JOBS_STORE="file", JOBS_FILE=path.join(directory, "jobs.json"))
+	import jobs
+	import mailer
+
+	payloads = [{ "to": f"user{index}@benchmark.test", "subject": "Your code", "body": f"Your code is {index:06d}." }
+		for index in range(args.messages)]
+	scenarios = {}
+
+	before = dict(sink.counts)
+	latencies, elapsed = results.time_operations([lambda payload=payload: mailer.send_messages([payload]) for payload in payloads])
+	scenarios["send_inline"] = results.summarize(latencies, elapsed,
+		connections=sink.counts["connections"] - before["connections"], delivered=sink.counts["messages"] - before["messages"])
+
+	for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(",")]:
+		jobs.HANDLERS["email"].batch_size = batch_size
+		queue = jobs.JobQueue(jobs.FileJobStore(path.join(directory, f"jobs-{batch_size}.json")),
+			workers=args.workers, poll_interval=0.05)
+		latencies, _ = results.time_operations([lambda payload=payload: queue.enqueue("email", payload) for payload in payloads])
+
+		before = dict(sink.counts)
+		started = perf_counter()
+		queue.ensure_workers()
+		drained = drain(queue, args.timeout)
+		delivery = perf_counter() - started
+		# The workers of this queue only poll its empty store from here on, the next scenario gets a queue of its own.
+		delivered = sink.counts["messages"] - before["messages"]
+		scenarios[f"jobs_batch_{batch_size}"] = results.summarize(latencies, delivery,
+			drained=drained, delivery_seconds=delivery, delivered_per_second=delivered / delivery if delivery > 0 else 0.0,
+			connections=sink.counts["connections"] - before["connections"], delivered=delivered,
+			retried=queue.metrics()["retried"])
+
+	sink.shutdown()
+	return results.finish(args, scenarios, {
+		"messages": args.messages, "workers": args.workers,
+		"handshake_delay_ms": args.handshake_delay, "message_delay_ms": args.message_delay })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
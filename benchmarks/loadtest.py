@@ -0,0 +1,375 @@
+"""
+_________________________________
+ROUTE LOAD TEST
+Drives the real Flask app through its test client against the in-memory
+database stand-in, no ArangoDB or network needed:
+	python -m benchmarks.loadtest --requests 500 --concurrency 8 --latency 2 --output results.json
+Each scenario is timed at the given concurrency, then a smaller sequential pass
+measures allocations per request with tracemalloc. mixed_login_* and
+mixed_get_* send logins and profile reads together, with password checks on
+the hashing pool and again on the request threads. burst_login and burst_get
+send password guesses on one account with throttling on, next to profile reads.
+The patch_lost_updates and signup race checks exercise the route logic only:
+the stand-in runs one query at a time, so they can not show what ArangoDB
+does with concurrent writes. tests/test_arango_queries.py covers that
+against a real ArangoDB (ARANGO_TEST_URL).
+_________________________________
+"""
+import argparse
+import sys
+from os import environ, devnull
+from time import perf_counter
+from threading import local
+from collections import Counter
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import results
+
+
+""" Password of every seeded account. """
+PASSWORD = "benchmark-password"
+
+""" Profile reads sent for every login in the hashing pool comparison. """
+LOGINS_EVERY = 4
+
+""" Throttling of the login burst check, the defaults of ratelimit.py. """
+BURST_USERNAME_CAPACITY = 5
+BURST_ADDRESS_CAPACITY = 20
+BURST_PERIOD = 60
+
+""" Concurrent copies of every request in the signup race checks. """
+SIGNUP_COPIES = 4
+
+
+def configure_environment(args):
+	""" Settings the service reads at import time, throttling is lifted so only the routes are measured.
+	check_login_burst turns it back on. """
+	environ.setdefault("environment", "production")
+	environ.setdefault("SEED", "benchmark-seed")
+	environ.setdefault("ACCESS_LOG", "false")
+	environ.setdefault("LOGIN_RATE_USERNAME_CAPACITY", "1e9")
+	environ.setdefault("LOGIN_RATE_ADDRESS_CAPACITY", "1e9")
+	environ.setdefault("AUTH_CONCURRENCY_INITIAL", str(max(64, args.concurrency)))
+	environ.setdefault("AUTH_CONCURRENCY_MAX", str(max(64, args.concurrency)))
+	environ.setdefault("AUTH_LATENCY_P95_THRESHOLD", "1e9")
+	environ.setdefault("HASH_QUEUE_SIZE", str(max(16, args.concurrency)))
+	# Avatar lookups fail fast against a closed local port instead of reaching Gravatar.
+	environ.setdefault("GRAVATAR_URL", "http://127.0.0.1:9")
+	environ.setdefault("GRAVATAR_TIMEOUT", "0.05")
+	# Jobs are queued in the stand-in and left there, the routes are measured without workers competing for it.
+	environ.setdefault("JOBS_IN_PROCESS", "false")
+	if args.hash_rounds:
+		environ["HASH_ROUNDS"] = str(args.hash_rounds)
+
+
+""" One request of a scenario, options are passed to the test client. """
+class Call():
+	def __init__(self, method: str, path: str, **options):
+		self.method = method
+		self.path = path
+		self.options = options
+
+
+""" Seeds accounts straight into the stand-in and hands out their tokens. """
+class Context():
+	def __init__(self, db, server):
+		self.db = db
+		self.server = server
+		self.password_hash = server.password_hasher.hash(PASSWORD)
+		self._seeded = 0
+
+	def seed(self, count: int, two_factor: bool = False, email_addresses: list = None) -> list:
+		""" Seeds count generated accounts, or one account per given email address. """
+		latency, jitter = self.db.latency, self.db.jitter
+		self.db.latency, self.db.jitter = 0.0, 0.0
+		try:
+			seeded = []
+			for index in range(count if email_addresses is None else len(email_addresses)):
+				self._seeded += 1
+				email_address = f"bench{self._seeded}@bench.test" if email_addresses is None else email_addresses[index]
+				account = self.server.AccountModel({
+					"email_address": email_address, "display_name": f"Benchmark {self._seeded}",
+					"preferences": { "2fa_authentication": two_factor, "is_expire_login": True } },
+					password_hash=self.password_hash)
+				metadata = self.db.collection("accounts").insert(account.to_dict())
+				seeded.append({
+					"_key": metadata["_key"], "username": account.username, "email_address": email_address,
+					"authorization": f"Bearer {self.server.generate_authentication_token(email_address)}" })
+			return seeded
+		finally:
+			self.db.latency, self.db.jitter = latency, jitter
+
+	def without_latency(self, fn, *args):
+		latency, jitter = self.db.latency, self.db.jitter
+		self.db.latency, self.db.jitter = 0.0, 0.0
+		try:
+			return fn(*args)
+		finally:
+			self.db.latency, self.db.jitter = latency, jitter
+
+
+"""
+__________________________________
+SCENARIOS
+Each returns the calls to make and the statuses they are expected to answer with.
+__________________________________
+"""
+def signup(context: Context, count: int, readers: list) -> tuple:
+	return [Call("POST", "/accounts/", json={
+		"email_address": f"signup{index}@bench.test", "display_name": "Signup", "password": PASSWORD })
+		for index in range(count)], (200,)
+
+def profile_get(context: Context, count: int, readers: list) -> tuple:
+	return [Call("GET", f'/accounts/{readers[index % len(readers)]["username"]}/') for index in range(count)], (200,)
+
+def batch(context: Context, count: int, readers: list) -> tuple:
+	usernames = [reader["username"] for reader in readers[:50]]
+	return [Call("POST", "/accounts/batch", json={ "usernames": usernames }) for _ in range(count)], (200,)
+
+def search(context: Context, count: int, readers: list) -> tuple:
+	# Prefixes of seeded usernames and display names with a typo, seeded usernames are "bench<n>".
+	queries = ["be", "bench1", "benchmark 4", "bnchmark 12"]
+	return [Call("GET", "/accounts/search", query_string={ "q": queries[index % len(queries)], "limit": 20 })
+		for index in range(count)], (200,)
+
+def login(context: Context, count: int, readers: list) -> tuple:
+	return [Call("GET", "/accounts/authentication", json={
+		"username": readers[index % len(readers)]["username"], "password": PASSWORD }) for index in range(count)], (200,)
+
+def login_2fa(context: Context, count: int, readers: list) -> tuple:
+	accounts = context.seed(min(count, 100), two_factor=True)
+	return [Call("GET", "/accounts/authentication", json={
+		"username": accounts[index % len(accounts)]["username"], "password": PASSWORD }) for index in range(count)], (201,)
+
+def verify_2fa(context: Context, count: int, readers: list) -> tuple:
+	calls = []
+	for account in context.seed(count, two_factor=True):
+		code = context.without_latency(context.server.verification.issue, account["_key"]).code
+		calls.append(Call("POST", "/accounts/authentication/verify", json={ "username": account["username"], "code": str(code) }))
+	return calls, (200,)
+
+def re_auth(context: Context, count: int, readers: list) -> tuple:
+	return [Call("GET", "/accounts/authentication/re",
+		headers={ "Authorization": readers[index % len(readers)]["authorization"] }) for index in range(count)], (200,)
+
+def patch(context: Context, count: int, readers: list) -> tuple:
+	return [Call("PATCH", f'/accounts/{readers[index % len(readers)]["username"]}',
+		json={ "display_name": f"Patched {index}" },
+		headers={ "Authorization": readers[index % len(readers)]["authorization"] }) for index in range(count)], (200,)
+
+def delete(context: Context, count: int, readers: list) -> tuple:
+	return [Call("DELETE", f'/accounts/{account["username"]}', headers={ "Authorization": account["authorization"] })
+		for account in context.seed(count)], (200,)
+
+
+SCENARIOS = {
+	"signup": signup,
+	"profile_get": profile_get,
+	"batch": batch,
+	"search": search,
+	"login": login,
+	"login_2fa": login_2fa,
+	"verify_2fa": verify_2fa,
+	"re_auth": re_auth,
+	"patch": patch,
+	"delete": delete,
+}
+
+
+def perform(server_instance, calls: list, concurrency: int, header: str = None) -> tuple:
+	""" Makes the calls from a pool of threads, each with its own test client, returns (latencies, statuses, elapsed),
+	followed by the values of the response header when one is named. """
+	clients = local()
+
+	def perform_call(call: Call) -> tuple:
+		if getattr(clients, "client", None) is None:
+			clients.client = server_instance.test_client()
+		started = perf_counter()
+		response = clients.client.open(call.path, method=call.method, **call.options)
+		latency = perf_counter() - started
+		response.close()
+		return latency, response.status_code, response.headers.get(header) if header else None
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		started = perf_counter()
+		outcomes = list(executor.map(perform_call, calls))
+		elapsed = perf_counter() - started
+	performed = [latency for latency, _, _ in outcomes], [status for _, status, _ in outcomes], elapsed
+	return (*performed, [value for _, _, value in outcomes]) if header else performed
+
+
+def run_scenario(context: Context, name: str, args, readers: list) -> dict:
+	calls, expected = SCENARIOS[name](context, args.requests + args.alloc_samples, readers)
+	timed_calls, allocation_calls = calls[:args.requests], calls[args.requests:]
+
+	latencies, statuses, elapsed = perform(context.server.server_instance, timed_calls, args.concurrency)
+	client = context.server.server_instance.test_client()
+	allocated_kib = results.measure_allocations(
+		lambda call=call: client.open(call.path, method=call.method, **call.options).close() for call in allocation_calls)
+
+	counted = {}
+	for status in statuses:
+		counted[str(status)] = counted.get(str(status), 0) + 1
+	return results.summarize(latencies, elapsed, allocated_kib,
+		errors=sum(1 for status in statuses if status not in expected), statuses=counted)
+
+
+""" Parallel PATCHes of different fields on one account, every field has to survive. """
+def check_lost_updates(context: Context, args) -> dict:
+	account = context.seed(1)[0]
+	calls = [Call("PATCH", f'/accounts/{account["username"]}', json={ f"benchmark_field_{index}": index },
+		headers={ "Authorization": account["authorization"] }) for index in range(args.requests)]
+	latencies, statuses, elapsed = perform(context.server.server_instance, calls, args.concurrency)
+
+	document = context.db.collection("accounts").documents[account["_key"]]
+	lost = sum(1 for index in range(args.requests) if document.get(f"benchmark_field_{index}") != index)
+	return results.summarize(latencies, elapsed,
+		errors=lost + sum(1 for status in statuses if status != 200), lost_updates=lost)
+
+
+def check_hashing_pool(context: Context, args, readers: list, pooled: bool) -> dict:
+	""" Logins and profile reads side by side, one login for every LOGINS_EVERY reads, with the password checks on the
+	hashing pool or run on the request threads. Reports login latencies and read throughput of the same run. """
+	logins, _ = login(context, max(1, args.requests // LOGINS_EVERY), readers)
+	reads, _ = profile_get(context, args.requests, readers)
+	calls, kinds = [], []
+	for index, read in enumerate(reads):
+		calls.append(read)
+		kinds.append("get")
+		if index % LOGINS_EVERY == 0 and index // LOGINS_EVERY < len(logins):
+			calls.append(logins[index // LOGINS_EVERY])
+			kinds.append("login")
+
+	hasher = context.server.password_hasher
+	if not pooled:
+		# passlib resolves its handlers on first access and not thread safely, the pool processes do it one at a time.
+		from passlib.hash import pbkdf2_sha256
+		hasher._run = lambda fn, *arguments: fn(*arguments)
+	try:
+		latencies, statuses, elapsed = perform(context.server.server_instance, calls, args.concurrency)
+	finally:
+		hasher.__dict__.pop("_run", None)
+
+	summaries = {}
+	for kind in ("login", "get"):
+		outcomes = [(latency, status) for call_kind, latency, status in zip(kinds, latencies, statuses) if call_kind == kind]
+		summaries[kind] = results.summarize([latency for latency, _ in outcomes], elapsed,
+			errors=sum(1 for _, status in outcomes if status != 200))
+	return summaries
+
+
+def check_login_burst(context: Context, args, readers: list) -> dict:
+	""" Throttling back on at the defaults of ratelimit.py, a burst of password guesses on one account is sent side by
+	side with profile reads. Guesses past the buckets have to get a 429 with Retry-After and every read a 200.
+	The reads are timed alone first, their throughput during the burst is reported relative to it. """
+	import ratelimit
+	reads, _ = profile_get(context, args.requests, readers)
+	guesses = [Call("GET", "/accounts/authentication", json={ "username": readers[0]["username"], "password": f"guess-{index}" })
+		for index in range(args.requests)]
+	calls = [call for pair in zip(reads, guesses) for call in pair]
+	_, _, alone_elapsed = perform(context.server.server_instance, reads, args.concurrency)
+
+	limiters = ratelimit.username_limiter, ratelimit.address_limiter
+	store = ratelimit.ShardedMemoryStore()
+	ratelimit.username_limiter = ratelimit.TokenBucketLimiter(store, BURST_USERNAME_CAPACITY, BURST_PERIOD)
+	ratelimit.address_limiter = ratelimit.TokenBucketLimiter(store, BURST_ADDRESS_CAPACITY, BURST_PERIOD)
+	try:
+		latencies, statuses, elapsed, retry_afters = perform(context.server.server_instance, calls, args.concurrency,
+			header="Retry-After")
+	finally:
+		ratelimit.username_limiter, ratelimit.address_limiter = limiters
+
+	read_outcomes, guess_outcomes = [list(zip(latencies, statuses, retry_afters))[start::2] for start in (0, 1)]
+	throttled = [retry_after for _, status, retry_after in guess_outcomes if status == 429]
+	# The username bucket refills while the burst runs, a guess or two more can get through.
+	allowed = BURST_USERNAME_CAPACITY + int(elapsed * BURST_USERNAME_CAPACITY / BURST_PERIOD) + 1
+	admitted = len(guess_outcomes) - len(throttled)
+	return {
+		"login": results.summarize([latency for latency, _, _ in guess_outcomes], elapsed, throttled=len(throttled),
+			admitted=admitted, errors=max(0, admitted - allowed) + sum(1 for retry_after in throttled
+				if not retry_after or int(retry_after) < 1)),
+		"get": results.summarize([latency for latency, _, _ in read_outcomes], elapsed,
+			throughput_alone=len(reads) / alone_elapsed if alone_elapsed > 0 else 0.0,
+			errors=sum(1 for _, status, _ in read_outcomes if status != 200)) }
+
+
+def check_signup_races(context: Context, args, idempotency_keys: bool) -> dict:
+	""" Sends every signup SIGNUP_COPIES times side by side, each address has to end up with exactly one account.
+	Without keys one copy gets a 200 and the others the 208, with a shared key copies get the replayed 200 or a 409. """
+	prefix = "retry" if idempotency_keys else "duplicate"
+	addresses = [f"{prefix}{index}@bench.test" for index in range(max(1, args.requests // SIGNUP_COPIES))]
+	calls = [Call("POST", "/accounts/", json={ "email_address": email_address, "display_name": "Race", "password": PASSWORD },
+		headers={ "Idempotency-Key": f"{prefix}-{index}" } if idempotency_keys else {})
+		for index, email_address in enumerate(addresses) for _ in range(SIGNUP_COPIES)]
+	latencies, statuses, elapsed = perform(context.server.server_instance, calls, args.concurrency)
+
+	stored = Counter(document.get("email_address") for document in context.db.collection("accounts").documents.values())
+	wrong_counts = sum(1 for email_address in addresses if stored[email_address] != 1)
+	created = Counter(call.options["json"]["email_address"] for call, status in zip(calls, statuses) if status == 200)
+	if idempotency_keys:
+		unexpected = sum(1 for status in statuses if status not in (200, 409))
+	else:
+		unexpected = sum(1 for status in statuses if status not in (200, 208)) + sum(
+			1 for email_address in addresses if created[email_address] != 1)
+	return results.summarize(latencies, elapsed,
+		errors=wrong_counts + unexpected, wrong_account_counts=wrong_counts, unexpected_statuses=unexpected)
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run.")
+	parser.add_argument("--requests", type=int, default=200, help="Timed requests per scenario.")
+	parser.add_argument("--concurrency", type=int, default=8)
+	parser.add_argument("--latency", type=float, default=0.0, help="Injected database latency per operation, in milliseconds.")
+	parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency of up to this many milliseconds.")
+	parser.add_argument("--accounts", type=int, default=1000, help="Accounts seeded for the read scenarios.")
+	parser.add_argument("--alloc-samples", type=int, default=20, help="Sequential requests measured with tracemalloc.")
+	parser.add_argument("--hash-rounds", type=int, help="PBKDF2 rounds, defaults to HASH_ROUNDS or the passlib default.")
+	parser.add_argument("--skip-lost-updates", action="store_true", help="Skip the parallel PATCH consistency check.")
+	parser.add_argument("--skip-signup-races", action="store_true", help="Skip the parallel duplicate signup checks.")
+	parser.add_argument("--skip-login-burst", action="store_true", help="Skip the throttled login burst next to profile reads.")
+	parser.add_argument("--skip-hashing-pool", action="store_true", help="Skip the logins and reads with and without the hashing pool.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	configure_environment(args)
+	import database
+	import server
+	from benchmarks.fake_arango import FakeDatabase
+
+	db = FakeDatabase(latency=args.latency / 1000, jitter=args.jitter / 1000)
+	database.use_database(db)
+	context = Context(db, server)
+
+	scenarios = {}
+	try:
+		readers = context.seed(args.accounts)
+		# Route handlers print tracebacks and verification codes, keep the report readable.
+		with open(devnull, "w") as silenced, redirect_stdout(silenced):
+			for name in args.scenarios.split(","):
+				scenarios[name] = run_scenario(context, name.strip(), args, readers)
+			if not args.skip_lost_updates:
+				scenarios["patch_lost_updates"] = check_lost_updates(context, args)
+			if not args.skip_login_burst:
+				burst = check_login_burst(context, args, readers)
+				scenarios["burst_login"] = burst["login"]
+				scenarios["burst_get"] = burst["get"]
+			if not args.skip_hashing_pool:
+				for pooled, suffix in ((True, "pool"), (False, "inline")):
+					mixed = check_hashing_pool(context, args, readers, pooled)
+					scenarios[f"mixed_login_{suffix}"] = mixed["login"]
+					scenarios[f"mixed_get_{suffix}"] = mixed["get"]
+			if not args.skip_signup_races:
+				scenarios["signup_duplicates"] = check_signup_races(context, args, idempotency_keys=False)
+				scenarios["signup_retries"] = check_signup_races(context, args, idempotency_keys=True)
+	finally:
+		server.password_hasher.shutdown()
+
+	return results.finish(args, scenarios, {
+		"requests": args.requests, "concurrency": args.concurrency, "latency_ms": args.latency,
+		"jitter_ms": args.jitter, "accounts": args.accounts, "hash_rounds": server.password_hasher.rounds })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+_________________________________
+LOOKUP LATENCY
+Times database.get_one_by on username and email_address as a real ArangoDB
+collection grows, the same generated accounts as search_latency.py. Needs
+ARANGO_URL, ARANGO_PASSWORD and a database the benchmark may fill:
+	python -m benchmarks.lookup_latency --database hetch_search_benchmark --sizes 10000,100000,1000000
+Accounts are seeded up to each size in turn, then lookups of random seeded
+accounts are timed. The run fails when a lookup query does not use the
+unique index of its field, or when the p95 at a size grows past --max-growth
+times the p95 at the smallest size.
+_________________________________
+"""
+import argparse
+import sys
+from os import environ
+from random import Random
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import results
+from benchmarks.search_latency import seed
+
+
+""" Fields get_one_by looks accounts up by in the routes. """
+FIELDS = ("username", "email_address")
+
+SAMPLE_QUERY = """
+FOR key IN @keys
+	LET account = DOCUMENT("accounts", key)
+	FILTER account != null
+	RETURN KEEP(account, @fields)
+"""
+
+
+def uses_index(database, field: str, value) -> bool:
+	""" Whether the plan of the lookup query reads an index on the field instead of scanning the collection. """
+	from database import GET_ONE_BY_QUERY
+	plan = database.aql.explain(GET_ONE_BY_QUERY,
+		bind_vars={ "@collection": "accounts", "field": field, "value": value, "keep": None })
+	return any(node["type"] == "IndexNode" and any(index["fields"] == [field] for index in node.get("indexes", []))
+		for node in plan["nodes"])
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--database", default="hetch_search_benchmark", help="Database the accounts are seeded into.")
+	parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma separated collection sizes to time lookups at.")
+	parser.add_argument("--chunk-size", type=int, default=10000)
+	parser.add_argument("--lookups", type=int, default=2000, help="Timed lookups per field and size.")
+	parser.add_argument("--concurrency", type=int, default=8)
+	parser.add_argument("--max-growth", type=float, default=2.0)
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	from database import get_database, load_environment
+	load_environment()
+	environ["DATABASE_NAME"] = args.database
+	environ["ENSURE_INDEXES_ON_STARTUP"] = "true"
+	import database as accounts_database
+
+	database = get_database()
+	sizes = sorted(int(size) for size in args.sizes.split(","))
+	random = Random(0)
+	scenarios = {}
+	for size in sizes:
+		seed(database, size, args.chunk_size)
+		keys = [str(random.randrange(size)) for _ in range(args.lookups)]
+		sample = list(database.aql.execute(SAMPLE_QUERY, bind_vars={ "keys": keys, "fields": list(FIELDS) }))
+
+		for field in FIELDS:
+			def timed_lookup(account: dict) -> tuple:
+				started = perf_counter()
+				found = accounts_database.get_one_by(field, account[field], keep=["_key"])
+				return perf_counter() - started, found is not None
+
+			with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+				started = perf_counter()
+				outcomes = list(executor.map(timed_lookup, sample))
+				elapsed = perf_counter() - started
+			indexed = uses_index(database, field, sample[0][field])
+			scenarios[f"{field}_{size}"] = results.summarize([latency for latency, _ in outcomes], elapsed,
+				size=size, indexed=indexed, errors=sum(1 for _, found in outcomes if not found) + int(not indexed))
+
+	for field in FIELDS:
+		smallest = scenarios[f"{field}_{sizes[0]}"]["p95"]
+		for size in sizes[1:]:
+			summary = scenarios[f"{field}_{size}"]
+			summary["growth"] = summary["p95"] / smallest if smallest > 0 else 0.0
+			summary["errors"] += int(summary["growth"] > args.max_growth)
+
+	return results.finish(args, scenarios, {
+		"sizes": sizes, "lookups": args.lookups, "concurrency": args.concurrency, "max_growth": args.max_growth })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+_________________________________
+MICRO BENCHMARKS
+Times the hot paths underneath the routes in isolation:
+	python -m benchmarks.micro --iterations 200 --output micro.json
+	serialize_large_lists     sanitize and serialize an account with 10k element lists
+	construct_sanitize        wrap a realistic loaded document and build the owner view
+	construct_sanitize_legacy the same with the model before the slotted view, which copied
+	                          every field with fresh defaults and timestamps into the instance
+	token_verify_cached       Bearer verification answered by the token cache
+	token_verify_uncached     Bearer verification with HMAC and JSON decoding
+	patch_auth[_legacy]       authentication and account reads and writes of a PATCH
+	delete_auth[_legacy]      authentication and account lookup of a DELETE, the delete left out
+	                          _legacy runs the path before require_authentication: the
+	                          re-authentication view decoded every token and the handler read
+	                          the claims back out of its JSON, PATCH read the whole account
+	                          before writing it back; --db-latency-ms per stand-in round trip
+	jwt_sign_<algorithm>      token signing with hs256, es256 or eddsa
+	jwt_verify_<algorithm>    signature and expiry check of such a token
+	request_instrumentation   request metrics with one span of every kind
+	hash_verify_pool          concurrent password checks on the hashing pool
+	hash_verify_inline        the same checks run on the request threads
+_________________________________
+"""
+import argparse
+import sys
+from os import environ
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import results
+
+
+def realistic_document(list_size: int = 20) -> dict:
+	""" A loaded account as the database returns it. """
+	from migrations import LATEST_VERSION
+	return {
+		"_id": "accounts/1", "_key": "1", "_rev": "_rev1",
+		"time_created": { "timestamp": 1656633600.0, "date": "01 July 2022", "time": "00:00" },
+		"last_modified": { "timestamp": 1656633600.0, "date": "01 July 2022", "time": "00:00" },
+		"display_name": "Benchmark Account", "email_address": "bench@bench.test", "username": "bench",
+		"password": "$pbkdf2-sha256$29000$salt$hash", "profile_image": "https://avatars.dicebear.com/api/initials/bench.svg",
+		"eggs": [f"eggs/{index}" for index in range(list_size)],
+		"eggs_funded": [f"eggs/{index}" for index in range(list_size)],
+		"eggs_bookmarked": [f"eggs/{index}" for index in range(list_size)],
+		"eggs_archived": [f"eggs/{index}" for index in range(list_size)],
+		"comments": [f"comments/{index}" for index in range(list_size)],
+		"transactions": [f"transactions/{index}" for index in range(list_size)],
+		"interests": ["technology", "agriculture"], "external_links": ["https://example.com"],
+		"followers_count": list_size, "follows_count": list_size,
+		"previous_usernames": ["bench"], "home_city": "Johannesburg", "nationality": "South African",
+		"preferences": { "2fa_authentication": False, "is_expire_login": True },
+		"_schema_version_": LATEST_VERSION }
+
+
+def serialize_large_lists(args) -> dict:
+	from models.account import AccountModel
+	from models.response import Response as ResponseModel
+	document = realistic_document(10000)
+	operation = lambda: ResponseModel(cd=200, d=AccountModel(document).sanitize()).serialize()
+	latencies, elapsed = results.time_operations([operation] * args.iterations)
+	return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+
+
+def construct_sanitize(args) -> dict:
+	from models.account import AccountModel
+	document = realistic_document()
+	operation = lambda: AccountModel(document).sanitize_soft()
+	latencies, elapsed = results.time_operations([operation] * args.iterations)
+	return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+
+
+""" AccountModel before it became a view over the document, as a baseline for construct_sanitize. """
+class LegacyAccountModel():
+	def __init__(self, params):
+		from models.time_created import TimeCreatedModel
+		from models.account import ACCOUNT_FIELDS, ACCOUNT_DEFAULTS
+		# Data.__init__ stamped both timestamps on every construction, loaded documents included.
+		self.time_created = TimeCreatedModel().__dict__
+		self.last_modified = TimeCreatedModel().__dict__
+		self._id = params.get("_id")
+		for field in ACCOUNT_FIELDS:
+			if field in ("time_created", "last_modified"):
+				continue
+			value = params.get(field)
+			if value is None:
+				default = ACCOUNT_DEFAULTS.get(field)
+				value = list(default) if isinstance(default, tuple) else dict(default) if isinstance(default, dict) else default
+			setattr(self, field, value)
+
+	def sanitize_soft(self) -> dict:
+		from models.account import PROJECTIONS
+		return PROJECTIONS["owner"](self.__dict__)
+
+def construct_sanitize_legacy(args) -> dict:
+	document = realistic_document()
+	operation = lambda: LegacyAccountModel(document).sanitize_soft()
+	latencies, elapsed = results.time_operations([operation] * args.iterations)
+	return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+
+
+def _token_verification(args, cached: bool) -> dict:
+	from utilities import verify_authorization, generate_authentication_token, token_cache
+	authorization = f'Bearer {generate_authentication_token("bench@bench.test")}'
+
+	def operation():
+		if not cached:
+			token_cache._entries.clear()
+		verify_authorization(authorization)
+
+	verify_authorization(authorization)
+	latencies, elapsed = results.time_operations([operation] * args.iterations)
+	return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+
+def token_verify_cached(args) -> dict:
+	return _token_verification(args, cached=True)
+
+def token_verify_uncached(args) -> dict:
+	return _token_verification(args, cached=False)
+
+
+def _legacy_authentication(authorization: str) -> dict:
+	""" What PATCH and DELETE ran before require_authentication, the response of the re-authentication view parsed back. """
+	from utilities import jwt
+	from models.response import Response as ResponseModel
+	claims = jwt.decode(authorization.split(" ")[1], environ["SEED"], options={"verify_exp": True}, algorithms=["HS256"])
+	return ResponseModel(cd=200, d={ "p+a": authorization, "p+d": claims }).to_json().json["data"]["p+d"]
+
+def _authenticated_write(args, method: str, legacy: bool) -> dict:
+	import database
+	from datetime import datetime, timedelta
+	from server import server_instance
+	from utilities import jwt, verify_authorization
+	from models.account import HIDDEN_FIELDS
+	from benchmarks.fake_arango import FakeDatabase
+	fake_database = FakeDatabase(latency=args.db_latency_ms / 1000)
+	accounts = fake_database.collection("accounts")
+	accounts.insert({ field: value for field, value in realistic_document().items() if field not in ("_id", "_key", "_rev") })
+	# Signed with HS256 and SEED, the only tokens the legacy path verified.
+	authorization = "Bearer " + jwt.encode({ "email_address": "bench@bench.test", "exp": datetime.utcnow() + timedelta(days=365) },
+		environ["SEED"], algorithm="HS256")
+	patch = { "display_name": "Patched Benchmark Account" }
+
+	def authenticate() -> dict:
+		return _legacy_authentication(authorization) if legacy else verify_authorization(authorization)
+
+	def patch_account():
+		username = authenticate()["email_address"].split("@")[0]
+		if legacy:
+			account = database.get_one_by("username", username)
+			accounts.update({ **account, **patch })
+		else:
+			database.update_one_by("username", username, patch, unset=HIDDEN_FIELDS["owner"])
+
+	def look_up_deleted_account():
+		database.get_one_by("email_address", authenticate()["email_address"], keep=["_key", "username"])
+
+	operation = patch_account if method == "PATCH" else look_up_deleted_account
+
+	# One request context for every operation, the legacy path builds Flask responses.
+	database.use_database(fake_database)
+	try:
+		with server_instance.test_request_context(method=method, headers={ "Authorization": authorization }):
+			operation()
+			latencies, elapsed = results.time_operations([operation] * args.iterations)
+			return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+	finally:
+		database.use_database(None)
+
+
+def _jwt_algorithm(args, algorithm: str, sign: bool) -> dict:
+	""" Raw PyJWT cost per algorithm, the keyring lookup and token cache are left out. """
+	from datetime import datetime, timedelta
+	from utilities import jwt
+	from keys import generate_private_key
+	if algorithm == "HS256":
+		signing_key = verification_key = environ["SEED"]
+	else:
+		signing_key = generate_private_key(algorithm)
+		verification_key = signing_key.public_key()
+	claims = { "email_address": "bench@bench.test", "exp": datetime.utcnow() + timedelta(days=365) }
+	headers = None if algorithm == "HS256" else { "kid": "benchmark" }
+	token = jwt.encode(claims, signing_key, algorithm=algorithm, headers=headers)
+
+	if sign:
+		operation = lambda: jwt.encode(claims, signing_key, algorithm=algorithm, headers=headers)
+	else:
+		operation = lambda: jwt.decode(token, verification_key, options={"verify_exp": True}, algorithms=[algorithm])
+	latencies, elapsed = results.time_operations([operation] * args.iterations)
+	return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+
+""" Algorithm names as accepted by PyJWT, keyed by the scenario suffix. """
+JWT_ALGORITHMS = { "hs256": "HS256", "es256": "ES256", "eddsa": "EdDSA" }
+
+
+def request_instrumentation(args) -> dict:
+	import metrics
+
+	def operation():
+		token = metrics.start_request()
+		for kind in metrics.SPAN_KINDS:
+			with metrics.span(kind):
+				pass
+		metrics.finish_request(token, "/accounts/<username>/", "GET", 200)
+
+	latencies, elapsed = results.time_operations([operation] * args.iterations)
+	return results.summarize(latencies, elapsed, results.measure_allocations([operation] * args.alloc_samples))
+
+
+def _hash_verification(args, pooled: bool) -> dict:
+	from hashing import password_hasher, _hash, _verify
+	password_hash = _hash("benchmark-password", password_hasher.rounds)
+	verify = password_hasher.verify if pooled else lambda password, stored: _verify(password, stored, password_hasher.rounds)
+
+	def operation(_) -> float:
+		started = perf_counter()
+		verify("benchmark-password", password_hash)
+		return perf_counter() - started
+
+	with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+		started = perf_counter()
+		latencies = list(executor.map(operation, range(args.hash_iterations)))
+		elapsed = perf_counter() - started
+	return results.summarize(latencies, elapsed)
+
+def hash_verify_pool(args) -> dict:
+	return _hash_verification(args, pooled=True)
+
+def hash_verify_inline(args) -> dict:
+	return _hash_verification(args, pooled=False)
+
+
+SCENARIOS = {
+	"serialize_large_lists": serialize_large_lists,
+	"construct_sanitize": construct_sanitize,
+	"construct_sanitize_legacy": construct_sanitize_legacy,
+	"token_verify_cached": token_verify_cached,
+	"token_verify_uncached": token_verify_uncached,
+	**{ f"{method.lower()}_auth{suffix}": (lambda args, method=method, legacy=legacy: _authenticated_write(args, method, legacy))
+		for method in ("PATCH", "DELETE") for suffix, legacy in (("_legacy", True), ("", False)) },
+	**{ f"jwt_sign_{name}": (lambda args, algorithm=algorithm: _jwt_algorithm(args, algorithm, sign=True))
+		for name, algorithm in JWT_ALGORITHMS.items() },
+	**{ f"jwt_verify_{name}": (lambda args, algorithm=algorithm: _jwt_algorithm(args, algorithm, sign=False))
+		for name, algorithm in JWT_ALGORITHMS.items() },
+	"request_instrumentation": request_instrumentation,
+	"hash_verify_pool": hash_verify_pool,
+	"hash_verify_inline": hash_verify_inline,
+}
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run.")
+	parser.add_argument("--iterations", type=int, default=200)
+	parser.add_argument("--alloc-samples", type=int, default=20)
+	parser.add_argument("--hash-iterations", type=int, default=64, help="Password checks per hashing scenario.")
+	parser.add_argument("--concurrency", type=int, default=8, help="Threads making password checks at once.")
+	parser.add_argument("--db-latency-ms", type=float, default=1.0, help="Round trip of the stand-in in the PATCH and DELETE scenarios.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	environ.setdefault("SEED", "benchmark-seed")
+	environ.setdefault("HASH_QUEUE_SIZE", str(max(16, args.concurrency)))
+	scenarios = { name.strip(): SCENARIOS[name.strip()](args) for name in args.scenarios.split(",") }
+
+	from hashing import password_hasher
+	password_hasher.shutdown()
+	return results.finish(args, scenarios, {
+		"iterations": args.iterations, "hash_iterations": args.hash_iterations,
+		"concurrency": args.concurrency, "hash_rounds": password_hasher.rounds, "db_latency_ms": args.db_latency_ms })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
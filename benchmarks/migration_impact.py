@@ -0,0 +1,99 @@
+"""
+_________________________________
+MIGRATION IMPACT
+Times profile reads on the in-memory database stand-in while accounts of the
+previous schema are upgraded: first with every account current, then with
+on-read upgrades alone, then with the bulk migrator running at each budget:
+	python -m benchmarks.migration_impact --accounts 5000 --budgets 500,2000,10000 --latency 1
+Every later phase starts with all accounts back at the initial version, reads miss
+the profile cache so each one reaches the database.
+_________________________________
+"""
+import argparse
+import sys
+from os import environ, devnull
+from random import Random
+from threading import Thread, Event
+from contextlib import redirect_stdout
+
+from benchmarks import results
+from benchmarks.loadtest import Call, Context, configure_environment, perform
+
+
+def set_versions(db, version: float, legacy: bool):
+	""" Puts every account at the version, legacy accounts lose what the migrations fill in. """
+	with db.lock:
+		for document in db.collections["accounts"].documents.values():
+			document["_schema_version_"] = version
+			if legacy:
+				document["preferences"] = { "2fa_authentication": False }
+				document.pop("follows_count", None)
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--accounts", type=int, default=5000)
+	parser.add_argument("--requests", type=int, default=2000, help="Profile reads per phase.")
+	parser.add_argument("--concurrency", type=int, default=8)
+	parser.add_argument("--budgets", default="500,2000,10000", help="Comma separated migrator budgets in operations per second.")
+	parser.add_argument("--chunk-size", type=int, default=100)
+	parser.add_argument("--latency", type=float, default=1.0, help="Injected database latency per operation, in milliseconds.")
+	parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency of up to this many milliseconds.")
+	parser.add_argument("--hash-rounds", type=int, help="PBKDF2 rounds, defaults to HASH_ROUNDS or the passlib default.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	environ.setdefault("PROFILE_CACHE_TTL", "0")
+	configure_environment(args)
+	import database
+	import server
+	import migrations
+	from benchmarks.fake_arango import FakeDatabase
+
+	db = FakeDatabase(latency=args.latency / 1000, jitter=args.jitter / 1000)
+	database.use_database(db)
+	context = Context(db, server)
+
+	scenarios = {}
+	try:
+		readers = context.seed(args.accounts)
+		random = Random(0)
+		calls = [Call("GET", f'/accounts/{random.choice(readers)["username"]}/') for _ in range(args.requests)]
+		phases = [("reads_current", None), ("reads_on_read_upgrade", None)] + [
+			(f"reads_bulk_{budget}", float(budget)) for budget in args.budgets.split(",")]
+
+		for name, budget in phases:
+			set_versions(db, migrations.LATEST_VERSION if name == "reads_current" else migrations.INITIAL_VERSION,
+				legacy=name != "reads_current")
+			migrations.write_back.flush()
+			written_before = migrations.write_back.metrics()["written"]
+
+			stop, progress = Event(), {}
+			migrator = None
+			if budget is not None:
+				migrator = Thread(target=lambda: progress.update(migrations.migrate(ops_per_second=budget,
+					chunk_size=args.chunk_size, checkpoint_path=None, stop=stop, report=None)))
+				migrator.start()
+			with open(devnull, "w") as silenced, redirect_stdout(silenced):
+				latencies, statuses, elapsed = perform(server.server_instance, calls, args.concurrency)
+			stop.set()
+			if migrator is not None:
+				migrator.join()
+			migrations.write_back.flush()
+
+			scenarios[name] = results.summarize(latencies, elapsed,
+				errors=sum(1 for status in statuses if status != 200),
+				migrated_in_bulk=progress.get("migrated", 0),
+				written_back_on_read=migrations.write_back.metrics()["written"] - written_before,
+				still_legacy=sum(1 for document in db.collections["accounts"].documents.values()
+					if migrations.needs_upgrade(document)))
+	finally:
+		server.password_hasher.shutdown()
+
+	return results.finish(args, scenarios, {
+		"accounts": args.accounts, "requests": args.requests, "concurrency": args.concurrency,
+		"chunk_size": args.chunk_size, "latency_ms": args.latency, "jitter_ms": args.jitter })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+_________________________________
+WORKLOAD REPLAY
+Re-drives a capture written with CAPTURE_FILE (see capture.py) against the
+app on the in-memory database stand-in, keeping the recorded arrival times
+scaled by each speed:
+	python -m benchmarks.replay capture.jsonl --speeds 1,2,4,8 --concurrency 8 --latency 2
+Requests start on time whatever is still running, so waiting for one of the
+--concurrency slots (processes x threads in app.ini by default) is counted in
+the latency. A route is saturated at a speed when its queueing p95 is above
+--max-wait-ms, or when its backlog keeps growing: the mean wait of its last
+quarter of requests is more than --max-wait-growth-ms above that of its
+first quarter. The
+slots needed to serve the peak second of every speed at --utilization are
+reported as well, to size app.ini or gunicorn ahead of traffic spikes.
+Accounts named in the capture are seeded under their pseudonyms, redacted
+passwords become the seeded password, redacted codes, tokens and cursors
+are left out.
+_________________________________
+"""
+import argparse
+import json
+import re
+import sys
+from math import ceil
+from os import devnull
+from time import perf_counter, sleep
+from uuid import uuid4
+from threading import local
+from contextlib import redirect_stdout
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import results
+from benchmarks.loadtest import Call, Context, PASSWORD, configure_environment
+
+
+""" Arguments in route rules, with or without a converter. """
+RULE_ARGUMENT = re.compile(r"<(?:[^:<>]+:)?([^<>]+)>")
+
+
+def app_ini_slots(ini_path: str = "app.ini") -> int:
+	""" Requests the uwsgi configuration serves at once. """
+	parser = ConfigParser(strict=False)
+	parser.read(ini_path)
+	if not parser.has_section("uwsgi"):
+		return 8
+	return parser.getint("uwsgi", "processes", fallback=1) * parser.getint("uwsgi", "threads", fallback=1)
+
+
+def read_capture(capture_path: str) -> list:
+	records = []
+	with open(capture_path, encoding="utf-8") as capture:
+		capture.readline()
+		for line in capture:
+			# A worker killed mid-write can leave a partial last line.
+			try:
+				records.append(json.loads(line))
+			except ValueError:
+				continue
+	return sorted(records, key=lambda record: record["t"])
+
+
+""" Turns sanitized records back into requests for the seeded pseudonymous accounts. """
+class Restorer():
+	def __init__(self, capture):
+		self.capture = capture
+		self.authorizations = {}
+
+	def email_address(self, identity: str) -> str:
+		return f"{identity[len(self.capture.IDENTITY_PREFIX):]}@replay.test"
+
+	def identities(self, value) -> set:
+		if isinstance(value, dict):
+			return set().union(*(self.identities(item) for item in value.values()))
+		if isinstance(value, list):
+			return set().union(*(self.identities(item) for item in value))
+		if isinstance(value, str) and value.startswith(self.capture.IDENTITY_PREFIX):
+			return { value }
+		return set()
+
+	def seeded_identities(self, records: list) -> list:
+		""" Every account the capture names, except the ones its signups create. """
+		named, created = set(), set()
+		for record in records:
+			named |= self.identities([record.get("v"), record.get("b"), record.get("a")])
+			if record["r"] == "/accounts/" and record["m"] == "POST" and isinstance(record.get("b"), dict):
+				created |= self.identities(record["b"].get("email_address"))
+		return sorted(named - created)
+
+	def restore(self, value, field: str = None):
+		if isinstance(value, dict):
+			return { key: self.restore(item, key) for key, item in value.items()
+				if item != self.capture.REDACTED or key == "password" }
+		if isinstance(value, list):
+			return [self.restore(item, field) for item in value]
+		if value == self.capture.REDACTED:
+			return PASSWORD
+		if isinstance(value, str) and value.startswith(self.capture.IDENTITY_PREFIX):
+			return self.email_address(value) if field == "email_address" else value[len(self.capture.IDENTITY_PREFIX):]
+		return value
+
+	def call(self, record: dict, generate_authentication_token) -> Call:
+		view_args = record.get("v", {})
+		path = RULE_ARGUMENT.sub(lambda match: str(self.restore(view_args.get(match.group(1), ""), match.group(1))), record["r"])
+		options = {}
+		if "q" in record:
+			options["query_string"] = self.restore(record["q"])
+		if "b" in record:
+			options["json"] = self.restore(record["b"])
+
+		headers = {}
+		if "a" in record:
+			if record["a"] not in self.authorizations:
+				self.authorizations[record["a"]] = f'Bearer {generate_authentication_token(self.email_address(record["a"]))}'
+			headers["Authorization"] = self.authorizations[record["a"]]
+		if "Idempotency-Key" in record.get("h", ()):
+			headers["Idempotency-Key"] = uuid4().hex
+		if "If-None-Match" in record.get("h", ()):
+			headers["If-None-Match"] = '"replayed"'
+		if len(headers):
+			options["headers"] = headers
+		return Call(record["m"], path, **options)
+
+
+def replay(server_instance, schedule: list, speed: float, slots: int) -> list:
+	""" Starts every call at its offset divided by speed, returns (scheduled, started, finished, status) per call. """
+	clients = local()
+
+	def perform_call(call: Call, scheduled: float) -> tuple:
+		if getattr(clients, "client", None) is None:
+			clients.client = server_instance.test_client()
+		started = perf_counter()
+		response = clients.client.open(call.path, method=call.method, **call.options)
+		response.close()
+		return scheduled, started, perf_counter(), response.status_code
+
+	futures = []
+	with ThreadPoolExecutor(max_workers=slots) as executor:
+		origin = perf_counter()
+		for offset, call in schedule:
+			scheduled = origin + offset / speed
+			delay = scheduled - perf_counter()
+			if delay > 0:
+				sleep(delay)
+			futures.append(executor.submit(perform_call, call, scheduled))
+	return [future.result() for future in futures]
+
+
+def peak_rate(offsets: list) -> float:
+	""" Most arrivals within one second. """
+	peak, first = 0, 0
+	for last, offset in enumerate(offsets):
+		while offset - offsets[first] >= 1.0:
+			first += 1
+		peak = max(peak, last - first + 1)
+	return float(peak)
+
+
+def backlog_growth(waits: list) -> float:
+	""" Mean wait of the last quarter of requests minus that of the first, in arrival order. A queue that keeps up
+	drains between bursts and stays near 0, one that does not keeps adding to every later wait. """
+	quarter = len(waits) // 4
+	if quarter == 0:
+		return 0.0
+	return sum(waits[-quarter:]) / quarter - sum(waits[:quarter]) / quarter
+
+
+def summarize_requests(outcomes: list, offsets: list, captured_statuses: list, args) -> dict:
+	latencies = [finished - scheduled for scheduled, _, finished, _ in outcomes]
+	waits = [started - scheduled for scheduled, started, _, _ in outcomes]
+	services = [finished - started for _, started, finished, _ in outcomes]
+	arrival_span = max(offsets[-1] - offsets[0], 1e-3)
+	completion_span = max(max(finished for _, _, finished, _ in outcomes) - min(scheduled for scheduled, _, _, _ in outcomes), 1e-3)
+	offered = len(outcomes) / arrival_span if len(outcomes) > 1 else 0.0
+	wait_p95 = results.percentile(waits, 0.95) * 1000
+	wait_growth = backlog_growth(waits) * 1000
+	return results.summarize(latencies, completion_span,
+		errors=sum(1 for *_, status in outcomes if status >= 500),
+		status_mismatches=sum(1 for (*_, status), captured in zip(outcomes, captured_statuses) if status != captured),
+		offered_rps=offered, wait_p95=wait_p95, wait_growth=wait_growth, service_mean=sum(services) / len(services) * 1000,
+		saturated=wait_p95 > args.max_wait_ms or wait_growth > args.max_wait_growth_ms)
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("capture", help="File written by the app with CAPTURE_FILE set.")
+	parser.add_argument("--speeds", default="1,2,4,8", help="Comma separated replay speeds.")
+	parser.add_argument("--concurrency", type=int, default=app_ini_slots(), help="Requests served at once.")
+	parser.add_argument("--latency", type=float, default=0.0, help="Injected database latency per operation, in milliseconds.")
+	parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency of up to this many milliseconds.")
+	parser.add_argument("--max-wait-ms", type=float, default=50.0, help="Queueing p95 above which a route counts as saturated.")
+	parser.add_argument("--max-wait-growth-ms", type=float, default=20.0,
+		help="Growth of the mean queueing wait over a replay above which a route counts as saturated.")
+	parser.add_argument("--utilization", type=float, default=0.7, help="Target share of busy slots when sizing.")
+	parser.add_argument("--hash-rounds", type=int, help="PBKDF2 rounds, defaults to HASH_ROUNDS or the passlib default.")
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	configure_environment(args)
+	import database
+	import server
+	import capture
+	from cache import profile_cache
+	from benchmarks.fake_arango import FakeDatabase
+
+	records = read_capture(args.capture)
+	if len(records) == 0:
+		print(f"{args.capture} holds no requests.", file=sys.stderr)
+		return 1
+	restorer = Restorer(capture)
+	seeded_addresses = [restorer.email_address(identity) for identity in restorer.seeded_identities(records)]
+	start = records[0]["t"]
+	offsets = [(record["t"] - start) / 1000 for record in records]
+	routes = sorted({ f'{record["m"]} {record["r"]}' for record in records })
+
+	scenarios = {}
+	saturation = { route: None for route in routes }
+	sizing = {}
+	try:
+		for speed in [float(speed) for speed in args.speeds.split(",")]:
+			# Every speed starts from the same seeded database and empty caches.
+			db = FakeDatabase(latency=args.latency / 1000, jitter=args.jitter / 1000)
+			database.use_database(db)
+			profile_cache._entries.clear()
+			context = Context(db, server)
+			context.seed(0, email_addresses=seeded_addresses)
+			schedule = list(zip(offsets, [restorer.call(record, server.generate_authentication_token) for record in records]))
+
+			with open(devnull, "w") as silenced, redirect_stdout(silenced):
+				outcomes = replay(server.server_instance, schedule, speed, args.concurrency)
+
+			label = f"{speed:g}x"
+			scaled = [offset / speed for offset in offsets]
+			overall = summarize_requests(outcomes, scaled, [record["s"] for record in records], args)
+			busy = peak_rate(scaled) * overall["service_mean"] / 1000
+			overall.update(peak_rps=peak_rate(scaled), slots_needed=ceil(busy / args.utilization))
+			scenarios[f"all @{label}"] = overall
+			sizing[label] = overall["slots_needed"]
+
+			for route in routes:
+				indexes = [index for index, record in enumerate(records) if f'{record["m"]} {record["r"]}' == route]
+				summary = summarize_requests([outcomes[index] for index in indexes], [scaled[index] for index in indexes],
+					[records[index]["s"] for index in indexes], args)
+				scenarios[f"{route} @{label}"] = summary
+				if summary["saturated"] and saturation[route] is None:
+					saturation[route] = label
+	finally:
+		server.password_hasher.shutdown()
+
+	print(f'{"route":<56}{"saturates at":>14}')
+	for route, label in saturation.items():
+		print(f'{route:<56}{label or "-":>14}')
+	print("Slots needed at", args.utilization, "utilization:",
+		", ".join(f"{label}: {slots}" for label, slots in sizing.items()), f"(running with {args.concurrency})")
+
+	return results.finish(args, scenarios, {
+		"capture": args.capture, "requests": len(records), "concurrency": args.concurrency,
+		"latency_ms": args.latency, "jitter_ms": args.jitter, "max_wait_ms": args.max_wait_ms,
+		"max_wait_growth_ms": args.max_wait_growth_ms,
+		"utilization": args.utilization, "hash_rounds": server.password_hasher.rounds,
+		"saturation": saturation, "slots_needed": sizing })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+_________________________________
+BENCHMARK RESULTS
+Summaries shared by every benchmark script, written as JSON and compared
+against a baseline run:
+	--output results.json --baseline baseline.json --tolerance 0.2
+A scenario regresses when its p95 or allocations grow, or its throughput
+drops, by more than the tolerance. The script then exits with status 1.
+_________________________________
+"""
+import json
+import sys
+import platform
+import tracemalloc
+from time import perf_counter
+
+
+""" Metrics compared against the baseline, and whether higher values are better. """
+COMPARED_METRICS = { "throughput": True, "p95": False, "allocated_kib": False }
+
+
+def percentile(samples: list, q: float) -> float:
+	if not len(samples):
+		return 0.0
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def summarize(latencies: list, elapsed: float, allocated_kib: float = None, **extra) -> dict:
+	""" Latencies are in seconds, reported in milliseconds. """
+	summary = {
+		"requests": len(latencies),
+		"throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+		"p50": percentile(latencies, 0.50) * 1000,
+		"p95": percentile(latencies, 0.95) * 1000,
+		"p99": percentile(latencies, 0.99) * 1000 }
+	if allocated_kib is not None:
+		summary["allocated_kib"] = allocated_kib
+	summary.update(extra)
+	return summary
+
+
+def measure_allocations(operations) -> float:
+	""" Mean peak of traced memory per operation in KiB, each operation is measured on its own. """
+	samples = []
+	tracemalloc.start()
+	try:
+		for operation in operations:
+			current, _ = tracemalloc.get_traced_memory()
+			tracemalloc.reset_peak()
+			operation()
+			_, peak = tracemalloc.get_traced_memory()
+			samples.append((peak - current) / 1024)
+	finally:
+		tracemalloc.stop()
+	return sum(samples) / len(samples) if len(samples) else 0.0
+
+
+def time_operations(operations) -> tuple:
+	""" Runs the operations one after another, returns (latencies, elapsed). """
+	latencies = []
+	started = perf_counter()
+	for operation in operations:
+		operation_started = perf_counter()
+		operation()
+		latencies.append(perf_counter() - operation_started)
+	return latencies, perf_counter() - started
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+	regressions = []
+	for name, previous in baseline.get("scenarios", {}).items():
+		current = results["scenarios"].get(name)
+		if current is None:
+			continue
+		for metric, higher_is_better in COMPARED_METRICS.items():
+			if metric not in current or not previous.get(metric):
+				continue
+			change = (current[metric] - previous[metric]) / previous[metric]
+			if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+				regressions.append(f"{name}: {metric} {previous[metric]:.2f} -> {current[metric]:.2f} ({change:+.0%})")
+	return regressions
+
+
+def add_arguments(parser):
+	parser.add_argument("--output", help="Write the results as JSON to this file.")
+	parser.add_argument("--baseline", help="Results of an earlier run to compare against.")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative change before a metric counts as a regression.")
+
+
+def report(results: dict):
+	print(f'{"scenario":<24}{"requests":>10}{"req/s":>12}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"KiB/req":>10}{"errors":>8}')
+	for name, summary in results["scenarios"].items():
+		allocated_kib = summary.get("allocated_kib")
+		print(f'{name:<24}{summary["requests"]:>10}{summary["throughput"]:>12.1f}{summary["p50"]:>10.2f}'
+			f'{summary["p95"]:>10.2f}{summary["p99"]:>10.2f}'
+			f'{allocated_kib if allocated_kib is not None else float("nan"):>10.1f}{summary.get("errors", 0):>8}')
+
+
+def finish(args, scenarios: dict, settings: dict) -> int:
+	""" Reports, writes and compares the results, returns the exit status of the script. """
+	results = {
+		"environment": { "python": platform.python_version(), "platform": platform.platform(), **settings },
+		"scenarios": scenarios }
+	report(results)
+	if args.output:
+		with open(args.output, "w", encoding="utf-8") as output:
+			json.dump(results, output, indent=2)
+
+	status = 0
+	if any(summary.get("errors") for summary in scenarios.values()):
+		print("Some requests did not answer with the expected status, see the errors column.", file=sys.stderr)
+		status = 1
+	if args.baseline:
+		with open(args.baseline, encoding="utf-8") as baseline:
+			regressions = compare(results, json.load(baseline), args.tolerance)
+		for regression in regressions:
+			print("REGRESSION:", regression, file=sys.stderr)
+		if len(regressions):
+			status = 1
+	return status
@@ -0,0 +1,108 @@
+"""
+_________________________________
+SEARCH LATENCY
+Seeds generated accounts into a real ArangoDB and times /accounts/search
+queries against the accounts_search view. Needs ARANGO_URL, ARANGO_PASSWORD
+and a database the benchmark may fill:
+	python -m benchmarks.search_latency --database hetch_search_benchmark --accounts 1000000
+Seeding is skipped for accounts that already exist, so later runs only time queries.
+The run fails when the p95 is above --target-ms.
+_________________________________
+"""
+import argparse
+import sys
+from os import environ
+from random import Random
+from time import perf_counter, time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import results
+
+
+FIRST_NAMES = ("libby", "thabo", "naledi", "sipho", "lerato", "karabo", "zanele", "pieter", "amara", "tendai",
+	"mpho", "lindiwe", "johan", "ayanda", "kagiso", "refilwe", "musa", "nomvula", "bongani", "palesa")
+LAST_NAMES = ("lebyane", "mokoena", "dlamini", "nkosi", "botha", "naidoo", "khumalo", "molefe", "van wyk", "mahlangu",
+	"ndlovu", "pillay", "mthembu", "zulu", "sithole", "baloyi", "venter", "maseko", "radebe", "mabaso")
+
+
+def generated_account(index: int, random: Random) -> dict:
+	first, last = random.choice(FIRST_NAMES), random.choice(LAST_NAMES)
+	username = f"{first}{last.replace(' ', '')}{index}"
+	now = time()
+	return {
+		"_key": str(index), "username": username, "email_address": f"{username}@search.test",
+		"display_name": f"{first.title()} {last.title()}", "followers_count": random.randint(0, 5000),
+		"time_created": { "timestamp": now }, "last_modified": { "timestamp": now } }
+
+
+def seed(database, count: int, chunk_size: int) -> int:
+	accounts = database.collection("accounts")
+	existing = accounts.count()
+	random = Random(existing)
+	for start in range(existing, count, chunk_size):
+		accounts.insert_many([generated_account(index, random) for index in range(start, min(count, start + chunk_size))],
+			overwrite=True, silent=True)
+		print(f"SEEDED {min(count, start + chunk_size)} / {count}", file=sys.stderr)
+	return max(0, count - existing)
+
+
+def generated_queries(count: int, random: Random) -> list:
+	""" Prefixes of 2 to 6 characters, full names, and full names with one character dropped. """
+	queries = []
+	for index in range(count):
+		name = f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}"
+		kind = index % 3
+		if kind == 0:
+			queries.append(name[:random.randint(2, 6)])
+		elif kind == 1:
+			queries.append(name)
+		else:
+			typo = random.randint(1, len(name) - 2)
+			queries.append(name[:typo] + name[typo + 1:])
+	return queries
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--database", default="hetch_search_benchmark", help="Database the accounts are seeded into.")
+	parser.add_argument("--accounts", type=int, default=1000000)
+	parser.add_argument("--chunk-size", type=int, default=10000)
+	parser.add_argument("--queries", type=int, default=1000)
+	parser.add_argument("--concurrency", type=int, default=8)
+	parser.add_argument("--limit", type=int, default=20)
+	parser.add_argument("--target-ms", type=float, default=20.0)
+	results.add_arguments(parser)
+	args = parser.parse_args()
+
+	from database import get_database, load_environment
+	load_environment()
+	environ["DATABASE_NAME"] = args.database
+	environ["ENSURE_INDEXES_ON_STARTUP"] = "true"
+	import search
+
+	database = get_database()
+	seeded = seed(database, args.accounts, args.chunk_size)
+	# Views commit asynchronously, wait until every seeded account is searchable.
+	list(database.aql.execute("FOR a IN accounts_search SEARCH true OPTIONS { waitForSync: true } LIMIT 1 RETURN 1"))
+
+	def timed_search(q: str) -> tuple:
+		started = perf_counter()
+		page = search.search_accounts(q, limit=args.limit)
+		return perf_counter() - started, len(page["accounts"])
+
+	queries = generated_queries(args.queries, Random(0))
+	with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+		started = perf_counter()
+		outcomes = list(executor.map(timed_search, queries))
+		elapsed = perf_counter() - started
+
+	latencies = [latency for latency, _ in outcomes]
+	summary = results.summarize(latencies, elapsed,
+		empty_results=sum(1 for _, found in outcomes if found == 0), target_ms=args.target_ms)
+	summary["errors"] = int(summary["p95"] > args.target_ms)
+	return results.finish(args, { "search": summary }, {
+		"accounts": args.accounts, "seeded": seeded, "queries": args.queries, "concurrency": args.concurrency })
+
+
+if __name__ == "__main__":
+	sys.exit(main())
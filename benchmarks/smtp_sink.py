@@ -0,0 +1,92 @@
+"""
+_________________________________
+SMTP STAND-IN
+Accepts mail on a local port and throws it away, counting connections and
+messages. Point the mailer at it to try outgoing email without a relay:
+	python -m benchmarks.smtp_sink --port 8025
+	SMTP_HOST=127.0.0.1 SMTP_PORT=8025 python jobs.py work
+A handshake and a per message delay stand in for the round trips of a real
+relay.
+_________________________________
+"""
+import argparse
+import sys
+import socketserver
+from time import sleep
+from threading import Lock, Thread
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+	def reply(self, line: str):
+		self.wfile.write(f"{line}\r\n".encode())
+
+	def handle(self):
+		sink = self.server
+		sink.count("connections")
+		sleep(sink.handshake_delay)
+		self.reply("220 sink ready")
+		for raw_line in self.rfile:
+			command = raw_line.decode(errors="replace").strip().split(" ", 1)[0].upper()
+			if command in ("EHLO", "HELO"):
+				self.reply("250 sink")
+			elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+				self.reply("250 OK")
+			elif command == "DATA":
+				self.reply("354 End data with <CR><LF>.<CR><LF>")
+				for data_line in self.rfile:
+					if data_line in (b".\r\n", b".\n"):
+						break
+				sleep(sink.message_delay)
+				sink.count("messages")
+				self.reply("250 OK queued")
+			elif command == "QUIT":
+				self.reply("221 Bye")
+				return
+			else:
+				self.reply("502 Command not implemented")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, host: str = "127.0.0.1", port: int = 0, handshake_delay: float = 0.0, message_delay: float = 0.0):
+		super().__init__((host, port), SinkHandler)
+		self.handshake_delay = handshake_delay
+		self.message_delay = message_delay
+		self._lock = Lock()
+		self.counts = { "connections": 0, "messages": 0 }
+
+	@property
+	def port(self) -> int:
+		return self.server_address[1]
+
+	def count(self, name: str):
+		with self._lock:
+			self.counts[name] += 1
+
+	def start(self):
+		""" Serves from a daemon thread, returns the sink. """
+		Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+		return self
+
+
+def main() -> int:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8025)
+	parser.add_argument("--handshake-delay", type=float, default=0.0, help="Milliseconds before the greeting.")
+	parser.add_argument("--message-delay", type=float, default=0.0, help="Milliseconds per accepted message.")
+	args = parser.parse_args()
+
+	sink = SMTPSink(args.host, args.port, args.handshake_delay / 1000, args.message_delay / 1000)
+	print(f"Accepting mail on {args.host}:{sink.port}")
+	try:
+		sink.serve_forever()
+	except KeyboardInterrupt:
+		print(sink.counts)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
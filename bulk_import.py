@@ -0,0 +1,94 @@
+"""
+_________________________________
+BULK ACCOUNT IMPORT
+Streams accounts from an NDJSON file into the accounts collection:
+	python bulk_import.py accounts.ndjson [chunk_size] > errors.ndjson
+Rows are validated like signups, passwords are hashed across the hashing pool
+and every chunk is written with one insert_many. Rejected rows are reported
+on stdout as NDJSON, progress goes to stderr.
+_________________________________
+"""
+import json
+import sys
+from sys import argv
+
+from database import get_database, load_environment
+from hashing import password_hasher
+from utilities import validate_request
+from models.account import AccountModel, SYSTEM_FIELDS
+
+
+""" Same fields a signup requires. """
+SIGNUP_SCHEMA = { "email_address": str, "display_name": str, "password": str }
+
+
+def read_chunks(lines, chunk_size: int):
+	""" Yields lists of (line_number, raw_line), only one chunk is held in memory. """
+	chunk = []
+	for line_number, line in enumerate(lines, start=1):
+		if line.strip():
+			chunk.append((line_number, line))
+		if len(chunk) >= chunk_size:
+			yield chunk
+			chunk = []
+	if len(chunk):
+		yield chunk
+
+
+def import_chunk(chunk: list, report_error) -> int:
+	rows = []
+	for line_number, line in chunk:
+		try:
+			params = json.loads(line)
+		except ValueError:
+			report_error(line_number, [{ "error": "Invalid JSON.", "type": "Invalid." }])
+			continue
+		if not isinstance(params, dict):
+			report_error(line_number, [{ "error": "Each line has to be a JSON object.", "type": "Invalid." }])
+			continue
+		v_errors = validate_request(d=params, schema=SIGNUP_SCHEMA)
+		if len(v_errors):
+			report_error(line_number, v_errors)
+			continue
+		# An _id would make AccountModel wrap the row as a stored document, unhashed and without a username.
+		rows.append((line_number, { field: value for field, value in params.items() if field not in SYSTEM_FIELDS }))
+
+	if len(rows) == 0:
+		return 0
+
+	password_hashes = password_hasher.hash_many([params["password"] for _, params in rows])
+	documents = [AccountModel(params, password_hash=password_hash).to_dict()
+		for (_, params), password_hash in zip(rows, password_hashes)]
+
+	imported = 0
+	results = get_database().collection("accounts").insert_many(documents, silent=False)
+	for (line_number, _), result in zip(rows, results):
+		if isinstance(result, Exception):
+			report_error(line_number, [{ "error": str(result), "type": "Rejected." }])
+		else:
+			imported += 1
+	return imported
+
+
+def import_accounts(lines, chunk_size: int = 500, output=sys.stdout) -> dict:
+	report = { "imported": 0, "rejected": 0 }
+
+	def report_error(line_number: int, errors: list):
+		report["rejected"] += 1
+		output.write(json.dumps({ "line": line_number, "errors": errors }) + "\n")
+
+	for chunk in read_chunks(lines, chunk_size):
+		report["imported"] += import_chunk(chunk, report_error)
+		print("IMPORTED ACCOUNTS:", report, file=sys.stderr)
+	return report
+
+
+if __name__ == "__main__":
+	if len(argv) < 2:
+		print("Usage: python bulk_import.py accounts.ndjson [chunk_size]")
+	else:
+		load_environment()
+		with open(argv[1], encoding="utf-8") as lines:
+			report = import_accounts(lines, chunk_size=int(argv[2]) if len(argv) > 2 else 500)
+		password_hasher.shutdown()
+		print(report, file=sys.stderr)
@@ -0,0 +1,163 @@
+"""
+_________________________________
+CACHE
+Size bounded LRU + TTL cache behind a pluggable backend interface.
+_________________________________
+"""
+from os import environ
+from time import monotonic, time
+from hashlib import sha256
+from threading import Lock
+from collections import OrderedDict
+
+from database import get_database, UNIQUE_CONSTRAINT_ERROR, CONFLICT_ERROR
+
+
+""" Interface every cache backend implements, a shared store can be swapped in later. """
+class CacheBackend():
+	def get(self, key):
+		raise NotImplementedError
+
+	def set(self, key, value, ttl=None):
+		raise NotImplementedError
+
+	def add(self, key, value, ttl=None) -> bool:
+		""" Stores the value only when the key has no live entry, returns whether it was stored. """
+		raise NotImplementedError
+
+	def delete(self, key):
+		raise NotImplementedError
+
+	def metrics(self) -> dict:
+		return {}
+
+
+""" In-process backend, each worker keeps its own entries. """
+class MemoryCache(CacheBackend):
+	def __init__(self, max_size=1024, ttl=60):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._entries = OrderedDict()
+		self._lock = Lock()
+		self._metrics = { "hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0 }
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self._metrics["misses"] += 1
+				return None
+			value, expires_at = entry
+			if expires_at <= monotonic():
+				del self._entries[key]
+				self._metrics["expirations"] += 1
+				self._metrics["misses"] += 1
+				return None
+			self._entries.move_to_end(key)
+			self._metrics["hits"] += 1
+			return value
+
+	def set(self, key, value, ttl=None):
+		expires_at = monotonic() + (self.ttl if ttl is None else ttl)
+		with self._lock:
+			self._entries[key] = (value, expires_at)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+				self._metrics["evictions"] += 1
+
+	def add(self, key, value, ttl=None) -> bool:
+		expires_at = monotonic() + (self.ttl if ttl is None else ttl)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and entry[1] > monotonic():
+				return False
+			self._entries[key] = (value, expires_at)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+				self._metrics["evictions"] += 1
+			return True
+
+	def delete(self, key):
+		with self._lock:
+			if self._entries.pop(key, None) is not None:
+				self._metrics["invalidations"] += 1
+
+	def metrics(self) -> dict:
+		with self._lock:
+			return { **self._metrics, "size": len(self._entries) }
+
+
+""" ArangoDB error number of a document that does not exist. """
+DOCUMENT_NOT_FOUND_ERROR = 1202
+
+
+""" Backend shared by every worker process, entries are documents of a collection with a TTL index on expire_at.
+Values have to be JSON, tuples come back as lists. """
+class ArangoCache(CacheBackend):
+	def __init__(self, collection: str, ttl=60):
+		self.collection = collection
+		self.ttl = ttl
+		self._lock = Lock()
+		self._metrics = { "hits": 0, "misses": 0, "taken_over": 0, "invalidations": 0 }
+
+	def _count(self, metric: str):
+		with self._lock:
+			self._metrics[metric] += 1
+
+	def _document(self, key, value, ttl=None) -> dict:
+		# Document keys only allow some characters, the hash of the cache key fits them.
+		return { "_key": sha256(str(key).encode("utf-8")).hexdigest(), "value": value,
+			"expire_at": time() + (self.ttl if ttl is None else ttl) }
+
+	def get(self, key):
+		document = get_database().collection(self.collection).get(self._document(key, None)["_key"])
+		# The TTL index removes expired documents in the background, they can still be read until then.
+		if document is None or document["expire_at"] <= time():
+			self._count("misses")
+			return None
+		self._count("hits")
+		return document["value"]
+
+	def set(self, key, value, ttl=None):
+		get_database().collection(self.collection).insert(self._document(key, value, ttl), overwrite=True, silent=True)
+
+	def add(self, key, value, ttl=None) -> bool:
+		""" Inserts against the unique _key, so exactly one process stores a key at a time. """
+		from arango.exceptions import DocumentInsertError, DocumentUpdateError
+		collection = get_database().collection(self.collection)
+		document = self._document(key, value, ttl)
+		try:
+			collection.insert(document, silent=True)
+			return True
+		except DocumentInsertError as error:
+			if error.error_code != UNIQUE_CONSTRAINT_ERROR:
+				raise
+
+		# An expired entry the TTL index has not removed yet is taken over, only by the revision that was read.
+		existing = collection.get(document["_key"])
+		if existing is None or existing["expire_at"] > time():
+			return False
+		try:
+			collection.update({ **document, "_rev": existing["_rev"] }, check_rev=True, merge=False, silent=True)
+		except DocumentUpdateError as error:
+			if error.error_code in (CONFLICT_ERROR, DOCUMENT_NOT_FOUND_ERROR):
+				return False
+			raise
+		self._count("taken_over")
+		return True
+
+	def delete(self, key):
+		if get_database().collection(self.collection).delete(self._document(key, None)["_key"], ignore_missing=True):
+			self._count("invalidations")
+
+	def metrics(self) -> dict:
+		with self._lock:
+			return { **self._metrics }
+
+
+""" Serialized, sanitized profiles keyed by username. Entries are (etag, body) pairs. """
+profile_cache = MemoryCache(
+	max_size=int(environ.get("PROFILE_CACHE_SIZE", 10000)),
+	ttl=float(environ.get("PROFILE_CACHE_TTL", 60)))
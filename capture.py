@@ -0,0 +1,150 @@
+"""
+_________________________________
+WORKLOAD CAPTURE
+With CAPTURE_FILE set, every /accounts/* request is appended to that file
+as one compact JSON line, for replaying the traffic shape with
+	python -m benchmarks.replay <capture file> --speeds 1,2,4
+The first line holds the capture epoch, records carry:
+	t  arrival in milliseconds after the epoch    r, m, s  route rule, method, status
+	d  milliseconds spent in the app              i, o     request and response body bytes
+	v, q, b  path arguments, query and JSON body  a        account of the Bearer token
+	h  conditional and idempotency headers present
+Passwords, codes, tokens and cursors are redacted, other strings keep only
+their length, and account names are replaced with keyed pseudonyms so a
+replay can tell accounts apart without knowing them.
+_________________________________
+"""
+import hmac
+import json
+from os import environ, getpid, open as open_file, write, O_WRONLY, O_CREAT, O_EXCL, O_APPEND
+from time import perf_counter, time, sleep
+from random import random
+from hashlib import sha256
+from threading import Lock
+
+from metrics import logger
+
+
+CAPTURE_FILE = environ.get("CAPTURE_FILE")
+
+""" Share of requests captured. """
+CAPTURE_SAMPLE_RATE = float(environ.get("CAPTURE_SAMPLE_RATE", 1))
+
+""" Values never written to the capture. """
+REDACTED_FIELDS = frozenset(("password", "code", "jwt", "token", "authorization", "cursor", "payment_tokens"))
+
+""" Values naming an account, written as pseudonyms. """
+IDENTITY_FIELDS = frozenset(("username", "other_username", "email_address", "usernames"))
+
+""" Headers whose presence is recorded. """
+CAPTURED_HEADERS = ("Idempotency-Key", "If-None-Match", "If-Match")
+
+""" Routes left out of the capture. """
+SKIPPED_RULES = frozenset(("/accounts/metrics",))
+
+REDACTED = "<redacted>"
+IDENTITY_PREFIX = "$id:"
+
+
+def pseudonym(name: str) -> str:
+	""" Usernames and email addresses of one account map to the same pseudonym, keyed with SEED. """
+	username = name.split("@")[0]
+	digest = hmac.new(environ.get("SEED", "").encode("utf-8"), username.encode("utf-8"), sha256).hexdigest()
+	return f"{IDENTITY_PREFIX}u{digest[:15]}"
+
+
+def sanitize(value, field: str = None):
+	if field in REDACTED_FIELDS:
+		return REDACTED
+	if isinstance(value, dict):
+		return { key: sanitize(item, key) for key, item in value.items() }
+	if isinstance(value, list):
+		return [sanitize(item, field) for item in value]
+	if isinstance(value, str):
+		return pseudonym(value) if field in IDENTITY_FIELDS else "a" * len(value)
+	return value
+
+
+""" Appends records from every worker to one file, each record is a single write on an O_APPEND descriptor. """
+class CaptureWriter():
+	def __init__(self, file_path: str):
+		self.path = file_path
+		self.epoch = None
+		self._descriptor = None
+		self._pid = None
+		self._lock = Lock()
+
+	def _open(self, arrival: float):
+		try:
+			# The worker creating the file writes the epoch every worker measures arrivals from, the arrival of the
+			# request it is writing, so that request is at 0 rather than before the epoch.
+			self._descriptor = open_file(self.path, O_WRONLY | O_CREAT | O_EXCL | O_APPEND, 0o600)
+			self.epoch = arrival
+			write(self._descriptor, (json.dumps({ "capture": 1, "epoch": self.epoch }) + "\n").encode("utf-8"))
+		except FileExistsError:
+			self._descriptor = open_file(self.path, O_WRONLY | O_APPEND)
+			self.epoch = self._read_epoch()
+		self._pid = getpid()
+
+	def _read_epoch(self) -> float:
+		for _ in range(50):
+			with open(self.path, encoding="utf-8") as capture:
+				header = capture.readline()
+			if header.endswith("\n"):
+				return json.loads(header)["epoch"]
+			# Another worker created the file and has not written the header yet.
+			sleep(0.01)
+		raise ValueError(f"{self.path} has no capture header.")
+
+	def write(self, record: dict, arrival: float):
+		with self._lock:
+			# Workers forked from a preloaded master open a descriptor of their own.
+			if self._descriptor is None or self._pid != getpid():
+				self._open(arrival)
+			record["t"] = round((arrival - self.epoch) * 1000)
+			write(self._descriptor, (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+
+
+def install(app, file_path: str = CAPTURE_FILE):
+	""" Captures the requests of the app, does nothing unless CAPTURE_FILE is set. """
+	if not file_path:
+		return app
+	from flask import request, g
+	writer = CaptureWriter(file_path)
+
+	@app.before_request
+	def start_capture():
+		if random() < CAPTURE_SAMPLE_RATE:
+			g.capture_started = (time(), perf_counter())
+
+	@app.after_request
+	def finish_capture(response):
+		started = g.pop("capture_started", None)
+		rule = request.url_rule.rule if request.url_rule is not None else None
+		if started is None or rule is None or not rule.startswith("/accounts") or rule in SKIPPED_RULES:
+			return response
+		try:
+			record = {
+				"r": rule, "m": request.method, "s": response.status_code,
+				"d": round((perf_counter() - started[1]) * 1000, 3),
+				"i": request.content_length or 0,
+				"o": -1 if response.is_streamed else response.calculate_content_length() }
+			if request.view_args:
+				record["v"] = sanitize(request.view_args)
+			if request.args:
+				record["q"] = sanitize(request.args.to_dict())
+			body = request.get_json(silent=True) if request.is_json else None
+			if body is not None:
+				record["b"] = sanitize(body)
+			authentication = g.get("authentication")
+			if authentication is not None and authentication.get("email_address"):
+				record["a"] = pseudonym(authentication["email_address"])
+			headers = [header for header in CAPTURED_HEADERS if header in request.headers]
+			if len(headers):
+				record["h"] = headers
+			writer.write(record, started[0])
+		except:
+			logger.exception("Capturing the request failed.")
+		return response
+
+	return app
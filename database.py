@@ -0,0 +1,488 @@
+"""
+_________________________________
+DATABASE ACCESS
+Lazily created per-process connection pool, index registry and single document lookups.
+python-arango is imported on first connection, see arango_http.py for the HTTP client.
+_________________________________
+"""
+from os import environ, getpid
+from sys import argv
+from time import monotonic, sleep
+from random import uniform
+from threading import Lock, local
+from contextlib import contextmanager
+
+from errors import ServiceUnavailable
+from metrics import span, logger
+
+
+""" Collections the service owns, created when missing. """
+COLLECTIONS = {
+	"accounts": { "edge": False },
+	"follows": { "edge": True },
+	"verification_codes": { "edge": False },
+	"notifications": { "edge": False },
+	"jobs": { "edge": False },
+	"idempotency_keys": { "edge": False },
+}
+
+""" Indexes declared per collection, reconciled at startup or with `python database.py ensure-indexes`. """
+INDEXES = {
+	"accounts": [
+		{ "type": "persistent", "fields": ["username"], "unique": True, "sparse": False },
+		{ "type": "persistent", "fields": ["email_address"], "unique": True, "sparse": False },
+		{ "type": "persistent", "fields": ["time_created.timestamp"], "unique": False, "sparse": False },
+		{ "type": "persistent", "fields": ["last_modified.timestamp"], "unique": False, "sparse": False },
+	],
+	"follows": [
+		{ "type": "persistent", "fields": ["_from", "_to"], "unique": True, "sparse": False },
+		{ "type": "persistent", "fields": ["_from", "created_at"], "unique": False, "sparse": False },
+		{ "type": "persistent", "fields": ["_to", "created_at"], "unique": False, "sparse": False },
+	],
+	"verification_codes": [
+		{ "type": "persistent", "fields": ["account", "time_created.timestamp"], "unique": False, "sparse": False },
+		{ "type": "ttl", "fields": ["expire_at"], "expiry_time": 0, "sparse": True },
+	],
+	"notifications": [
+		{ "type": "persistent", "fields": ["account", "timestamp"], "unique": False, "sparse": False },
+	],
+	"jobs": [
+		{ "type": "persistent", "fields": ["type", "status", "run_at"], "unique": False, "sparse": False },
+		{ "type": "ttl", "fields": ["expire_at"], "expiry_time": 0, "sparse": True },
+	],
+	"idempotency_keys": [
+		{ "type": "ttl", "fields": ["expire_at"], "expiry_time": 0, "sparse": True },
+	],
+}
+
+""" Name prefix of the indexes owned by the registry, only those are ever pruned. """
+INDEX_NAME_PREFIX = "registry"
+
+""" Text analyzers used by the search views, lowercase and accent-free before matching. """
+ANALYZERS = {
+	"account_norm": {
+		"type": "norm",
+		"properties": { "locale": "en", "case": "lower", "accent": False },
+		"features": ["frequency", "norm", "position"] },
+	"account_trigram": {
+		"type": "pipeline",
+		"properties": { "pipeline": [
+			{ "type": "norm", "properties": { "locale": "en", "case": "lower", "accent": False } },
+			{ "type": "ngram", "properties": { "min": 3, "max": 3, "preserveOriginal": False, "streamType": "utf8" } }] },
+		"features": ["frequency", "norm", "position"] },
+}
+
+""" ArangoSearch views, kept up to date by the database on every insert, update and remove. """
+VIEWS = {
+	"accounts_search": {
+		"commitIntervalMsec": 250,
+		"links": {
+			"accounts": {
+				"includeAllFields": False,
+				"fields": {
+					"username": { "analyzers": ["account_norm", "account_trigram"] },
+					"display_name": { "analyzers": ["account_norm", "account_trigram"] } } } } },
+}
+
+GET_ONE_BY_QUERY = """
+FOR document IN @@collection
+	FILTER document.@field == @value
+	LIMIT 1
+	RETURN @keep == null ? document : KEEP(document, @keep)
+"""
+
+""" One document per value, in the order of the values, null where nothing matched. """
+GET_MANY_BY_QUERY = """
+FOR value IN @values
+	RETURN FIRST(
+		FOR document IN @@collection
+			FILTER document.@field == value
+			LIMIT 1
+			RETURN @keep == null ? document : KEEP(document, @keep))
+"""
+
+""" Merge-patches the first matching document and returns it, the second form rejects stale revisions. """
+UPDATE_ONE_BY_QUERY = """
+FOR document IN @@collection
+	FILTER document.@field == @value
+	LIMIT 1
+	UPDATE document WITH @patch IN @@collection
+	OPTIONS { mergeObjects: true, keepNull: false }
+	RETURN UNSET(NEW, @unset)
+"""
+
+UPDATE_ONE_BY_REVISION_QUERY = """
+FOR document IN @@collection
+	FILTER document.@field == @value
+	LIMIT 1
+	UPDATE MERGE(@patch, { _key: document._key, _rev: @rev }) IN @@collection
+	OPTIONS { mergeObjects: true, keepNull: false, ignoreRevs: false }
+	RETURN UNSET(NEW, @unset)
+"""
+
+""" ArangoDB error number of a revision conflict. """
+CONFLICT_ERROR = 1200
+
+""" Attempts of an unconditional write that lost a write-write conflict to a concurrent one. """
+CONFLICT_ATTEMPTS = 5
+
+""" ArangoDB error number of a unique index violation. """
+UNIQUE_CONSTRAINT_ERROR = 1210
+
+""" Raised when a conditional write targets a revision that is no longer current. """
+class PreconditionFailed(Exception):
+	pass
+
+""" Raised while the database is unreachable or the circuit breaker is open. """
+class DatabaseUnavailable(ServiceUnavailable):
+	def __init__(self, retry_after=1):
+		super().__init__("Database unavailable, try again shortly.", retry_after)
+
+
+"""
+__________________________________
+CONNECTION POOL
+__________________________________
+"""
+""" Fails fast once consecutive failures pass the threshold, lets one trial request through after the cooldown. """
+class CircuitBreaker():
+	def __init__(self, threshold=5, cooldown=10.0):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.opened_at = None
+		self._trial_running = False
+		self._lock = Lock()
+
+	@property
+	def state(self) -> str:
+		if self.opened_at is None:
+			return "closed"
+		return "half-open" if monotonic() - self.opened_at >= self.cooldown else "open"
+
+	def before_request(self):
+		with self._lock:
+			if self.opened_at is None:
+				return
+			remaining = self.cooldown - (monotonic() - self.opened_at)
+			if remaining > 0 or self._trial_running:
+				raise DatabaseUnavailable(retry_after=max(1, int(remaining + 0.5)))
+			self._trial_running = True
+
+	def record_success(self):
+		with self._lock:
+			self.failures = 0
+			self.opened_at = None
+			self._trial_running = False
+
+	def record_failure(self):
+		with self._lock:
+			self.failures += 1
+			self._trial_running = False
+			if self.failures >= self.threshold or self.opened_at is not None:
+				self.opened_at = monotonic()
+
+
+""" Flags of the requests the current thread is sending. """
+_request_context = local()
+
+
+@contextmanager
+def read_only():
+	""" Queries sent inside only read, the HTTP client retries them after a failure like it retries GETs. """
+	previous = getattr(_request_context, "read_only", False)
+	_request_context.read_only = True
+	try:
+		yield
+	finally:
+		_request_context.read_only = previous
+
+
+def is_read_only() -> bool:
+	return getattr(_request_context, "read_only", False)
+
+
+""" Reads the development .env file outside of production. """
+def load_environment():
+	if environ.get("environment") != "production":
+		from dotenv import load_dotenv
+		load_dotenv()
+
+
+""" Connection settings, read when the first connection of a process is made. """
+def connection_settings() -> dict:
+	return {
+		"url": environ["ARANGO_URL"],
+		"name": environ["DATABASE_NAME"],
+		"username": environ.get("ARANGO_USERNAME", "root"),
+		"password": environ["ARANGO_PASSWORD"],
+		"pool_size": int(environ.get("ARANGO_POOL_SIZE", 10)),
+		"timeout": float(environ.get("ARANGO_TIMEOUT", 10)),
+		"retries": int(environ.get("ARANGO_RETRIES", 3)),
+		"backoff": float(environ.get("ARANGO_BACKOFF", 0.1)),
+		"breaker_threshold": int(environ.get("ARANGO_BREAKER_THRESHOLD", 5)),
+		"breaker_cooldown": float(environ.get("ARANGO_BREAKER_COOLDOWN", 10)),
+		"bootstrap": environ.get("ENSURE_INDEXES_ON_STARTUP", "true") == "true" }
+
+
+""" Database handle set explicitly, takes precedence over the lazily created connection. """
+_database = None
+
+""" Connection of the current process, rebuilt after a fork. """
+_connection = { "pid": None, "database": None, "breaker": None }
+_connection_lock = Lock()
+
+
+def use_database(database):
+	global _database
+	_database = database
+
+
+def _connect(settings: dict):
+	# python-arango and requests are only imported once a worker connects.
+	from arango import ArangoClient
+	from arango_http import PooledHTTPClient
+
+	# A failed attempt keeps the breaker of this process, a forked worker starts with its own.
+	breaker = _connection["breaker"]
+	if _connection["pid"] != getpid() or breaker is None:
+		breaker = CircuitBreaker(threshold=settings["breaker_threshold"], cooldown=settings["breaker_cooldown"])
+	http_client = PooledHTTPClient(pool_size=settings["pool_size"], timeout=settings["timeout"],
+		retries=settings["retries"], backoff=settings["backoff"], breaker=breaker)
+	_connection.update(pid=getpid(), breaker=breaker, database=None)
+
+	client = ArangoClient(hosts=settings["url"], http_client=http_client, verify_override=False)
+	if settings["bootstrap"]:
+		bootstrap(client, settings)
+	return client.db(settings["name"], username=settings["username"], password=settings["password"])
+
+
+""" Creates the application database, its collections and indexes when missing. """
+def bootstrap(client, settings: dict):
+	sys_database = client.db("_system", username=settings["username"], password=settings["password"])
+	if not sys_database.has_database(settings["name"]):
+		sys_database.create_database(settings["name"])
+		sys_database.update_permission(username=settings["username"], permission="rw", database=settings["name"])
+
+	database = client.db(settings["name"], username=settings["username"], password=settings["password"])
+	ensure_collections(database)
+	ensure_indexes(database)
+	ensure_search(database)
+
+
+""" Returns the database of this process, connecting on first use and again after a fork or a failed attempt. """
+def get_database():
+	if _database is not None:
+		return _database
+	if _connection["pid"] == getpid() and _connection["database"] is not None:
+		return _connection["database"]
+
+	with _connection_lock:
+		if _connection["pid"] != getpid() or _connection["database"] is None:
+			try:
+				_connection["database"] = _connect(connection_settings())
+			except ServiceUnavailable:
+				raise
+			except:
+				logger.exception("Database connection failed.")
+				raise DatabaseUnavailable()
+		return _connection["database"]
+
+
+""" Connection health reported by the status route. """
+def database_status() -> dict:
+	breaker = _connection["breaker"] if _connection["pid"] == getpid() else None
+	return {
+		"connected": _database is not None or (_connection["pid"] == getpid() and _connection["database"] is not None),
+		"circuit_breaker": breaker.state if breaker is not None else "closed",
+		"consecutive_failures": breaker.failures if breaker is not None else 0 }
+
+
+""" Collection handle that resolves the connection of the current process on every use. """
+class LazyCollection():
+	def __init__(self, name: str):
+		self.name = name
+
+	def __getattr__(self, attribute):
+		return getattr(get_database().collection(self.name), attribute)
+
+
+""" Creates the declared collections that do not exist yet. """
+def ensure_collections(database=None) -> list:
+	database = database or get_database()
+	created = []
+	for collection_name, options in COLLECTIONS.items():
+		if not database.has_collection(collection_name):
+			database.create_collection(collection_name, edge=options["edge"])
+			created.append(collection_name)
+	return created
+
+
+def index_name(collection_name: str, index: dict) -> str:
+	return "_".join([INDEX_NAME_PREFIX, collection_name, index["type"], *index["fields"]]).replace(".", "_")
+
+
+def lookup_fields(collection_name: str) -> set:
+	""" Fields that can be looked up without a collection scan. """
+	return { index["fields"][0] for index in INDEXES.get(collection_name, []) if index["type"] == "persistent" }
+
+
+def _matches(existing: dict, index: dict) -> bool:
+	return (existing["type"] == index["type"]
+		and list(existing["fields"]) == index["fields"]
+		and bool(existing.get("unique")) == bool(index.get("unique"))
+		and bool(existing.get("sparse")) == bool(index.get("sparse")))
+
+
+def _create_index(collection, name: str, index: dict):
+	if index["type"] == "persistent":
+		collection.add_persistent_index(fields=index["fields"], unique=index.get("unique"),
+			sparse=index.get("sparse"), name=name, in_background=True)
+	elif index["type"] == "ttl":
+		collection.add_ttl_index(fields=index["fields"], expiry_time=index["expiry_time"],
+			name=name, in_background=True)
+	else:
+		raise ValueError(f'Unsupported index type "{index["type"]}".')
+
+
+""" Creates missing indexes and, when pruning, drops registry indexes that are no longer declared. """
+def ensure_indexes(database=None, prune=False) -> dict:
+	database = database or get_database()
+	report = { "created": [], "existing": [], "dropped": [], "failed": [] }
+
+	for collection_name, indexes in INDEXES.items():
+		if not database.has_collection(collection_name):
+			continue
+		collection = database.collection(collection_name)
+		existing_indexes = collection.indexes()
+
+		for index in indexes:
+			name = index_name(collection_name, index)
+			if any(_matches(existing, index) for existing in existing_indexes):
+				report["existing"].append(name)
+				continue
+			try:
+				_create_index(collection, name, index)
+				report["created"].append(name)
+			except:
+				# Creating a unique index fails when the collection already holds duplicates.
+				logger.exception("Index creation failed.", extra={ "index": name })
+				report["failed"].append(name)
+
+		if prune:
+			declared = { index_name(collection_name, index) for index in indexes }
+			for existing in existing_indexes:
+				existing_name = existing.get("name", "")
+				if existing_name.startswith(INDEX_NAME_PREFIX + "_") and existing_name not in declared:
+					collection.delete_index(existing["id"].split("/")[-1])
+					report["dropped"].append(existing_name)
+
+	return report
+
+
+""" Creates missing analyzers and views, and brings the links of existing views up to date. """
+def ensure_search(database=None) -> dict:
+	database = database or get_database()
+	report = { "created": [], "updated": [], "existing": [] }
+
+	# Analyzer names are reported with their database prefix, "<database>::<name>".
+	existing_analyzers = { analyzer["name"].split("::")[-1] for analyzer in database.analyzers() }
+	for name, analyzer in ANALYZERS.items():
+		if name in existing_analyzers:
+			report["existing"].append(name)
+		else:
+			database.create_analyzer(name, analyzer["type"], analyzer["properties"], analyzer["features"])
+			report["created"].append(name)
+
+	existing_views = { view["name"] for view in database.views() }
+	for name, properties in VIEWS.items():
+		if name in existing_views:
+			database.update_arangosearch_view(name, properties)
+			report["updated"].append(name)
+		else:
+			database.create_arangosearch_view(name, properties)
+			report["created"].append(name)
+	return report
+
+
+""" Returns the first document where field equals value, optionally keeping only some attributes. """
+def get_one_by(field: str, value, keep=None, collection="accounts"):
+	if field not in lookup_fields(collection):
+		raise ValueError(f'"{field}" is not an indexed lookup field of "{collection}".')
+
+	with read_only():
+		cursor = get_database().aql.execute(GET_ONE_BY_QUERY,
+			bind_vars={ "@collection": collection, "field": field, "value": value, "keep": keep },
+			count=False)
+		for document in cursor:
+			return document
+	return None
+
+
+""" Looks up many values in one query, returns a list aligned with values holding None for misses. """
+def get_many_by(field: str, values: list, keep=None, collection="accounts") -> list:
+	if field not in lookup_fields(collection):
+		raise ValueError(f'"{field}" is not an indexed lookup field of "{collection}".')
+
+	with read_only():
+		cursor = get_database().aql.execute(GET_MANY_BY_QUERY,
+			bind_vars={ "@collection": collection, "field": field, "values": list(values), "keep": keep },
+			count=False, batch_size=1000)
+		return list(cursor)
+
+
+""" Applies patch to the first document where field equals value in one round trip, returns None when nothing matched. """
+def update_one_by(field: str, value, patch: dict, rev=None, unset=(), collection="accounts"):
+	if field not in lookup_fields(collection):
+		raise ValueError(f'"{field}" is not an indexed lookup field of "{collection}".')
+
+	bind_vars = { "@collection": collection, "field": field, "value": value, "patch": patch, "unset": list(unset) }
+	if rev is not None:
+		bind_vars["rev"] = rev
+	from arango.exceptions import AQLQueryExecuteError
+	for attempt in range(CONFLICT_ATTEMPTS):
+		try:
+			cursor = get_database().aql.execute(
+				UPDATE_ONE_BY_QUERY if rev is None else UPDATE_ONE_BY_REVISION_QUERY,
+				bind_vars=bind_vars, count=False)
+			break
+		except AQLQueryExecuteError as error:
+			if error.error_code != CONFLICT_ERROR:
+				raise
+			if rev is not None:
+				raise PreconditionFailed(f'Revision "{rev}" is not current.')
+			# Without a revision the patch only lost a write-write conflict to a concurrent write, it applies on top of it.
+			if attempt == CONFLICT_ATTEMPTS - 1:
+				raise
+			sleep(uniform(0, 0.01 * 2 ** attempt))
+	for document in cursor:
+		return document
+	return None
+
+
+""" Runs a query that can run again after losing a write-write conflict and returns its first result, None when it has none.
+Only for queries whose writes all fail together with the conflict, like the counter updates of follows and notifications. """
+def first_retrying_conflicts(query: str, bind_vars: dict):
+	from arango.exceptions import AQLQueryExecuteError
+	for attempt in range(CONFLICT_ATTEMPTS):
+		try:
+			for result in get_database().aql.execute(query, bind_vars=bind_vars):
+				return result
+			return None
+		except AQLQueryExecuteError as error:
+			if error.error_code != CONFLICT_ERROR or attempt == CONFLICT_ATTEMPTS - 1:
+				raise
+			sleep(uniform(0, 0.01 * 2 ** attempt))
+
+
+if __name__ == "__main__":
+	load_environment()
+	if len(argv) > 1 and argv[1] == "ensure-indexes":
+		print(ensure_indexes(prune="--prune" in argv))
+		print(ensure_search())
+	elif len(argv) > 1 and argv[1] == "bootstrap":
+		environ["ENSURE_INDEXES_ON_STARTUP"] = "true"
+		get_database()
+		print("Database, collections and indexes are in place.")
+	else:
+		print("Usage: python database.py bootstrap | ensure-indexes [--prune]")
@@ -0,0 +1,5 @@
+""" Raised when a dependency is saturated or unhealthy, handlers answer with a 503 and Retry-After. """
+class ServiceUnavailable(Exception):
+	def __init__(self, message="Service unavailable.", retry_after=1):
+		super().__init__(message)
+		self.retry_after = retry_after
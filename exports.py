@@ -0,0 +1,68 @@
+"""
+_________________________________
+ACCOUNT EXPORT
+Streams sanitized accounts from a server-side cursor, ordered by
+(<field>.timestamp, _key) so an export can resume after its last line.
+Every write to an account sets last_modified, exports by it pick up
+counters, avatars and migrated documents as well as profile edits.
+_________________________________
+"""
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from database import get_database
+from models.account import AccountModel, PROJECTIONS
+from models.response import dumps
+
+
+""" Timestamps an export can be filtered and ordered by. """
+EXPORT_FIELDS = ("time_created", "last_modified")
+
+EXPORT_QUERY = """
+FOR a IN accounts
+	FILTER a.@field.timestamp >= @since
+	FILTER @after == null OR a.@field.timestamp > @after[0] OR (a.@field.timestamp == @after[0] AND a._key > @after[1])
+	SORT a.@field.timestamp, a._key
+	RETURN MERGE(KEEP(a, @keep), { _key: a._key })
+"""
+
+EXPORT_UNTIL_QUERY = """
+FOR a IN accounts
+	FILTER a.@field.timestamp >= @since AND a.@field.timestamp < @until
+	FILTER @after == null OR a.@field.timestamp > @after[0] OR (a.@field.timestamp == @after[0] AND a._key > @after[1])
+	SORT a.@field.timestamp, a._key
+	RETURN MERGE(KEEP(a, @keep), { _key: a._key })
+"""
+
+
+def encode_cursor(position: list) -> str:
+	return urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor: str) -> list:
+	position = json.loads(urlsafe_b64decode(cursor.encode("utf-8")))
+	if not isinstance(position, list) or len(position) != 2:
+		raise ValueError("Invalid cursor.")
+	return position
+
+
+""" Validates the export and returns a generator of NDJSON lines, each carrying the cursor that resumes after it. """
+def export_accounts(field: str = "time_created", since: float = 0, until: float = None,
+		cursor: str = None, batch_size: int = 1000):
+	if field not in EXPORT_FIELDS:
+		raise ValueError(f'Exports can only be ordered by {", ".join(EXPORT_FIELDS)}.')
+	after = decode_cursor(cursor) if cursor else None
+
+	bind_vars = { "field": field, "since": since, "after": after, "keep": list(PROJECTIONS["owner"].keys) }
+	if until is not None:
+		bind_vars["until"] = until
+	documents = get_database().aql.execute(EXPORT_QUERY if until is None else EXPORT_UNTIL_QUERY,
+		bind_vars=bind_vars, batch_size=batch_size, stream=True, ttl=600)
+
+	def lines():
+		try:
+			for document in documents:
+				position = [document.get(field, {}).get("timestamp"), document["_key"]]
+				yield dumps({ "cursor": encode_cursor(position), "data": AccountModel(document).sanitize_soft() }) + b"\n"
+		finally:
+			documents.close(ignore_missing=True)
+	return lines()
@@ -0,0 +1,270 @@
+"""
+_________________________________
+FOLLOW GRAPH
+Follow relationships stored as edges in the "follows" collection,
+accounts only carry the followers_count and follows_count counters.
+_________________________________
+"""
+import json
+from sys import argv
+from time import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from database import get_database, load_environment, first_retrying_conflicts
+from cache import profile_cache
+from models.time_created import TimeCreatedModel
+
+
+""" Fields returned for every account in a follower or following listing. """
+LISTING_FIELDS = ["username", "display_name", "profile_image"]
+
+FOLLOW_QUERY = """
+LET follower = FIRST(FOR a IN accounts FILTER a.username == @follower LIMIT 1 RETURN a._id)
+LET followee = FIRST(FOR a IN accounts FILTER a.username == @followee LIMIT 1 RETURN a._id)
+LET inserted = (
+	FILTER follower != null AND followee != null AND follower != followee
+	INSERT { _from: follower, _to: followee, created_at: @now } INTO follows
+	OPTIONS { ignoreErrors: true }
+	RETURN NEW._key)
+LET counted = (
+	FOR a IN accounts
+		FILTER LENGTH(inserted) > 0 AND a._id IN [follower, followee]
+		UPDATE a WITH MERGE(a._id == follower
+			? { follows_count: a.follows_count + 1 }
+			: { followers_count: a.followers_count + 1 }, { last_modified: @modified }) IN accounts
+		RETURN NEW._id)
+RETURN { follower: follower, followee: followee, changed: LENGTH(inserted) > 0 }
+"""
+
+UNFOLLOW_QUERY = """
+LET follower = FIRST(FOR a IN accounts FILTER a.username == @follower LIMIT 1 RETURN a._id)
+LET followee = FIRST(FOR a IN accounts FILTER a.username == @followee LIMIT 1 RETURN a._id)
+LET removed = (
+	FOR e IN follows
+		FILTER e._from == follower AND e._to == followee
+		LIMIT 1
+		REMOVE e IN follows
+		RETURN OLD._key)
+LET counted = (
+	FOR a IN accounts
+		FILTER LENGTH(removed) > 0 AND a._id IN [follower, followee]
+		UPDATE a WITH MERGE(a._id == follower
+			? { follows_count: MAX([a.follows_count - 1, 0]) }
+			: { followers_count: MAX([a.followers_count - 1, 0]) }, { last_modified: @modified }) IN accounts
+		RETURN NEW._id)
+RETURN { follower: follower, followee: followee, changed: LENGTH(removed) > 0 }
+"""
+
+""" Newest first, continuing after the (created_at, _key) position of the cursor. """
+LISTING_QUERY = """
+LET account = FIRST(FOR a IN accounts FILTER a.username == @username LIMIT 1 RETURN a._id)
+FILTER account != null
+LET page = (
+	FOR e IN follows
+		FILTER e.@direction == account
+		FILTER @after == null OR e.created_at < @after[0] OR (e.created_at == @after[0] AND e._key < @after[1])
+		SORT e.created_at DESC, e._key DESC
+		LIMIT @limit
+		LET other = DOCUMENT(e.@other)
+		FILTER other != null
+		RETURN { account: KEEP(other, @fields), followed_at: e.created_at, position: [e.created_at, e._key] })
+RETURN page
+"""
+
+RELATIONSHIP_QUERY = """
+LET first = FIRST(FOR a IN accounts FILTER a.username == @first LIMIT 1 RETURN a._id)
+LET second = FIRST(FOR a IN accounts FILTER a.username == @second LIMIT 1 RETURN a._id)
+FILTER first != null AND second != null
+RETURN {
+	follows: LENGTH(FOR e IN follows FILTER e._from == first AND e._to == second LIMIT 1 RETURN 1) > 0,
+	followed_by: LENGTH(FOR e IN follows FILTER e._from == second AND e._to == first LIMIT 1 RETURN 1) > 0 }
+"""
+
+
+""" Cursor tokens are opaque to clients, they wrap the position of the last listed edge. """
+def encode_cursor(position: list) -> str:
+	return urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor: str) -> list:
+	position = json.loads(urlsafe_b64decode(cursor.encode("utf-8")))
+	if not isinstance(position, list) or len(position) != 2:
+		raise ValueError("Invalid cursor.")
+	return position
+
+
+def _changed(result, follower: str, followee: str):
+	if result is None or result["follower"] is None or result["followee"] is None:
+		return None
+	if result["changed"]:
+		# Both follower counters are part of the public profiles.
+		profile_cache.delete(follower)
+		profile_cache.delete(followee)
+	return result["changed"]
+
+
+""" Returns None when either account does not exist, otherwise whether an edge was added. """
+def follow(follower: str, followee: str):
+	return _changed(first_retrying_conflicts(FOLLOW_QUERY, { "follower": follower, "followee": followee, "now": time(),
+		"modified": TimeCreatedModel().__dict__ }), follower, followee)
+
+def unfollow(follower: str, followee: str):
+	return _changed(first_retrying_conflicts(UNFOLLOW_QUERY, { "follower": follower, "followee": followee,
+		"modified": TimeCreatedModel().__dict__ }), follower, followee)
+
+
+""" Lists followers ("followers") or followed accounts ("following"), returns None for unknown accounts. """
+def list_accounts(username: str, relation: str, limit: int = 50, cursor: str = None):
+	direction, other = ("_to", "_from") if relation == "followers" else ("_from", "_to")
+	page = first_retrying_conflicts(LISTING_QUERY, {
+		"username": username, "direction": direction, "other": other,
+		"after": decode_cursor(cursor) if cursor else None,
+		"limit": limit + 1, "fields": LISTING_FIELDS })
+	if page is None:
+		return None
+
+	next_cursor = encode_cursor(page[limit - 1]["position"]) if len(page) > limit else None
+	return {
+		"accounts": [{ **item["account"], "followed_at": item["followed_at"] } for item in page[:limit]],
+		"cursor": next_cursor }
+
+
+""" Whether first follows second, is followed back, and if the follow is mutual. """
+def relationship(first: str, second: str):
+	result = first_retrying_conflicts(RELATIONSHIP_QUERY, { "first": first, "second": second })
+	if result is None:
+		return None
+	return { **result, "mutual": result["follows"] and result["followed_by"] }
+
+
+""" Removes a batch of the follows of a deleted account and takes them off the counters of the accounts on the other side. """
+REMOVE_ACCOUNT_QUERY = """
+LET removed = (
+	FOR e IN follows
+		FILTER e._from == @account OR e._to == @account
+		LIMIT @batch_size
+		REMOVE e IN follows
+		RETURN OLD)
+LET counted = (
+	FOR e IN removed
+		COLLECT other = (e._from == @account ? e._to : e._from)
+		AGGREGATE followers = SUM(e._from == @account ? 1 : 0), follows = SUM(e._to == @account ? 1 : 0)
+		LET a = DOCUMENT(other)
+		FILTER a != null
+		UPDATE a WITH {
+			followers_count: MAX([(a.followers_count || 0) - followers, 0]),
+			follows_count: MAX([(a.follows_count || 0) - follows, 0]),
+			last_modified: @modified } IN accounts
+		RETURN NEW.username)
+RETURN { removed: LENGTH(removed), counted: counted }
+"""
+
+
+""" Removes every follow of a deleted account, returns how many there were. """
+def remove_account(account_id: str, batch_size: int = 1000) -> int:
+	removed = 0
+	while True:
+		result = first_retrying_conflicts(REMOVE_ACCOUNT_QUERY, { "account": account_id, "batch_size": batch_size,
+			"modified": TimeCreatedModel().__dict__ })
+		if not result or not result["removed"]:
+			return removed
+		for username in result["counted"]:
+			profile_cache.delete(username)
+		removed += result["removed"]
+
+
+"""
+__________________________________
+MIGRATION
+Streams the legacy followers/follows arrays into edges in batches.
+__________________________________
+"""
+PENDING_ACCOUNTS_QUERY = """
+FOR a IN accounts
+	FILTER HAS(a, "followers") OR HAS(a, "follows")
+	LIMIT @batch_size
+	RETURN { _id: a._id, _key: a._key, followers: a.followers || [], follows: a.follows || [] }
+"""
+
+RESOLVE_ACCOUNTS_QUERY = """
+FOR reference IN @references
+	LET account = FIRST(
+		FOR a IN accounts
+			FILTER a.username == reference OR a._key == reference OR a._id == reference
+			LIMIT 1
+			RETURN a._id)
+	FILTER account != null
+	RETURN [reference, account]
+"""
+
+CLEAR_ARRAYS_QUERY = """
+FOR key IN @keys
+	UPDATE { _key: key } WITH { followers: null, follows: null, last_modified: @modified } IN accounts
+	OPTIONS { keepNull: false }
+"""
+
+RECOUNT_QUERY = """
+FOR a IN accounts
+	FILTER a._key > @after
+	SORT a._key
+	LIMIT @batch_size
+	UPDATE a WITH {
+		followers_count: LENGTH(FOR e IN follows FILTER e._to == a._id RETURN 1),
+		follows_count: LENGTH(FOR e IN follows FILTER e._from == a._id RETURN 1),
+		last_modified: @modified } IN accounts
+	RETURN NEW._key
+"""
+
+
+def migrate_arrays(batch_size: int = 500) -> dict:
+	database = get_database()
+	edges_collection = database.collection("follows")
+	report = { "accounts": 0, "edges": 0, "unresolved": 0 }
+
+	while True:
+		pending = list(database.aql.execute(PENDING_ACCOUNTS_QUERY, bind_vars={ "batch_size": batch_size }))
+		if len(pending) == 0:
+			break
+
+		references = list({ str(reference) for account in pending for reference in account["followers"] + account["follows"] })
+		resolved = dict(database.aql.execute(RESOLVE_ACCOUNTS_QUERY, bind_vars={ "references": references }))
+		report["unresolved"] += len(references) - len(resolved)
+
+		now = time()
+		edges = []
+		for account in pending:
+			for reference in account["followers"]:
+				if resolved.get(str(reference)) not in (None, account["_id"]):
+					edges.append({ "_from": resolved[str(reference)], "_to": account["_id"], "created_at": now })
+			for reference in account["follows"]:
+				if resolved.get(str(reference)) not in (None, account["_id"]):
+					edges.append({ "_from": account["_id"], "_to": resolved[str(reference)], "created_at": now })
+
+		if len(edges):
+			# Both sides of a relationship usually list it, the unique index drops the duplicate.
+			results = edges_collection.insert_many(edges, silent=False)
+			report["edges"] += sum(1 for result in results if isinstance(result, dict))
+
+		database.aql.execute(CLEAR_ARRAYS_QUERY, bind_vars={ "keys": [account["_key"] for account in pending],
+			"modified": TimeCreatedModel().__dict__ })
+		report["accounts"] += len(pending)
+		print("MIGRATED FOLLOWS:", report)
+
+	# Counters are recomputed from the edges once every array has been streamed out.
+	after = ""
+	while True:
+		keys = list(database.aql.execute(RECOUNT_QUERY, bind_vars={ "after": after, "batch_size": batch_size,
+			"modified": TimeCreatedModel().__dict__ }))
+		if len(keys) == 0:
+			break
+		after = keys[-1]
+
+	return report
+
+
+if __name__ == "__main__":
+	if len(argv) > 1 and argv[1] == "migrate":
+		load_environment()
+		batch_size = int(argv[2]) if len(argv) > 2 else 500
+		print(migrate_arrays(batch_size=batch_size))
+	else:
+		print("Usage: python follows.py migrate [batch_size]")
@@ -0,0 +1,101 @@
+"""
+_________________________________
+PASSWORD HASHING SERVICE
+Runs PBKDF2 hashing and verification on a fixed size process pool
+so that request threads are not pinned by CPU-bound work.
+_________________________________
+"""
+from os import environ, getpid
+from threading import BoundedSemaphore, Lock
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from errors import ServiceUnavailable
+from metrics import span
+
+
+""" Raised when the pool has no capacity left. """
+class HashingUnavailable(ServiceUnavailable):
+	def __init__(self, retry_after=1):
+		super().__init__("Too many requests right now, try again shortly.", retry_after)
+
+
+""" Work executed inside the pool processes, kept module level so it can be pickled. """
+def _hash(password: str, rounds: int) -> str:
+	from passlib.hash import pbkdf2_sha256
+	return pbkdf2_sha256.using(rounds=rounds).hash(password)
+
+def _verify(password: str, password_hash: str, rounds: int) -> tuple:
+	""" Returns the verification result and, when the stored hash is outdated, a replacement hash. """
+	from passlib.hash import pbkdf2_sha256
+	if not pbkdf2_sha256.verify(password, password_hash):
+		return False, None
+	hasher = pbkdf2_sha256.using(rounds=rounds)
+	if hasher.needs_update(password_hash):
+		return True, hasher.hash(password)
+	return True, None
+
+
+class HashingService():
+	def __init__(self, pool_size=None, queue_size=None, rounds=None, timeout=None, retry_after=None):
+		self.pool_size = pool_size or int(environ.get("HASH_POOL_SIZE", 2))
+		self.queue_size = queue_size or int(environ.get("HASH_QUEUE_SIZE", 16))
+		self._rounds = rounds or (int(environ["HASH_ROUNDS"]) if environ.get("HASH_ROUNDS") else None)
+		self.timeout = timeout or float(environ.get("HASH_TIMEOUT", 10))
+		self.retry_after = retry_after or int(environ.get("HASH_RETRY_AFTER", 1))
+
+		self._slots = BoundedSemaphore(self.queue_size)
+		self._lock = Lock()
+		self._pool = None
+		self._pool_pid = None
+
+	@property
+	def rounds(self) -> int:
+		""" Falls back to the passlib default, passlib is only imported once hashing is needed. """
+		if self._rounds is None:
+			from passlib.hash import pbkdf2_sha256
+			self._rounds = pbkdf2_sha256.default_rounds
+		return self._rounds
+
+	def _executor(self) -> ProcessPoolExecutor:
+		""" Pools are created on first use per process, workers forked by the server never share one. """
+		with self._lock:
+			if self._pool is None or self._pool_pid != getpid():
+				self._pool = ProcessPoolExecutor(max_workers=self.pool_size)
+				self._pool_pid = getpid()
+			return self._pool
+
+	def _run(self, fn, *args):
+		if not self._slots.acquire(blocking=False):
+			raise HashingUnavailable(retry_after=self.retry_after)
+		future = None
+		try:
+			with span("hashing"):
+				future = self._executor().submit(fn, *args)
+				return future.result(timeout=self.timeout)
+		except FutureTimeoutError:
+			# Work still queued behind a busy pool is dropped, nobody waits for its result anymore.
+			future.cancel()
+			raise HashingUnavailable(retry_after=self.retry_after)
+		finally:
+			self._slots.release()
+
+	def hash(self, password: str) -> str:
+		return self._run(_hash, password, self.rounds)
+
+	def verify(self, password: str, password_hash: str) -> tuple:
+		""" Returns (is_valid, new_hash), new_hash is set when the stored hash should be replaced. """
+		return self._run(_verify, password, password_hash, self.rounds)
+
+	def hash_many(self, passwords: list) -> list:
+		""" Hashes a batch across every pool process, meant for imports rather than request handlers. """
+		return list(self._executor().map(_hash, passwords, [self.rounds] * len(passwords)))
+
+	def shutdown(self):
+		with self._lock:
+			if self._pool is not None and self._pool_pid == getpid():
+				self._pool.shutdown(wait=False)
+			self._pool = None
+
+
+""" Shared instance used by the server and the models. """
+password_hasher = HashingService()
@@ -0,0 +1,78 @@
+"""
+_________________________________
+IDEMPOTENCY KEYS
+Requests sent with an Idempotency-Key header run once: retries with the same
+key and body replay the stored response without running the route again.
+A retry that arrives while the first request is still running gets a 409.
+Keys are kept per process in a store bounded to IDEMPOTENCY_CACHE_SIZE
+entries, off the database path of the request. IDEMPOTENCY_STORE=arango
+keeps them in the "idempotency_keys" collection instead, so a retry that
+reaches another worker process is replayed too, for a database round trip
+per request that carries the header.
+_________________________________
+"""
+from os import environ
+from hashlib import sha256
+from functools import wraps
+from flask import request
+
+from cache import CacheBackend, MemoryCache, ArangoCache
+from models.response import Response as ResponseModel, json_response
+
+
+""" Longest key accepted, clients usually send a UUID. """
+MAX_KEY_LENGTH = 255
+
+""" Seconds a running request keeps its key reserved, covers the slowest signup. """
+PENDING_TTL = float(environ.get("IDEMPOTENCY_PENDING_TTL", 30))
+
+""" Marker stored while the first request with a key is running. """
+PENDING = "pending"
+
+def default_store() -> CacheBackend:
+	ttl = float(environ.get("IDEMPOTENCY_TTL", 86400))
+	if environ.get("IDEMPOTENCY_STORE", "memory") == "arango":
+		return ArangoCache("idempotency_keys", ttl=ttl)
+	return MemoryCache(max_size=int(environ.get("IDEMPOTENCY_CACHE_SIZE", 10000)), ttl=ttl)
+
+
+""" Stored responses, keyed by route and key. Entries are (fingerprint, status, body) or (fingerprint, PENDING). """
+idempotency_store = default_store()
+
+
+""" Decorator for routes that create resources, requests without the header run as usual. """
+def idempotent(fn):
+	@wraps(fn)
+	def decorator(*args, **kwargs):
+		key = request.headers.get("Idempotency-Key")
+		if key is None:
+			return fn(*args, **kwargs)
+		if not key or len(key) > MAX_KEY_LENGTH:
+			return ResponseModel(cd=400, msg=f"Idempotency-Key has to be between 1 and {MAX_KEY_LENGTH} characters.").to_json()
+
+		store_key = f"{request.path}:{key}"
+		fingerprint = sha256(request.get_data()).hexdigest()
+		if not idempotency_store.add(store_key, (fingerprint, PENDING), ttl=PENDING_TTL):
+			entry = idempotency_store.get(store_key)
+			if entry is None:
+				# The entry expired in between, the request is treated as a retry still running.
+				entry = (fingerprint, PENDING)
+			if entry[0] != fingerprint:
+				return ResponseModel(cd=422, msg="Idempotency-Key was already used with a different request body.").to_json()
+			if entry[1] == PENDING:
+				return ResponseModel(cd=409, msg="A request with this Idempotency-Key is still in progress.").to_json(
+					headers={"Retry-After": "1"})
+			return json_response(entry[2], entry[1], headers={"Idempotent-Replayed": "true"})
+
+		try:
+			response = fn(*args, **kwargs)
+		except:
+			idempotency_store.delete(store_key)
+			raise
+		# Server errors are not stored so the client can retry them.
+		if response.status_code >= 500:
+			idempotency_store.delete(store_key)
+		else:
+			idempotency_store.set(store_key, (fingerprint, response.status_code, response.get_data(as_text=True)))
+		return response
+	return decorator
@@ -0,0 +1,384 @@
+"""
+_________________________________
+BACKGROUND JOBS
+Side work of the routes, emails, account clean-up and avatar lookups, is
+enqueued as a job and run later by a pool of worker threads. Jobs are stored
+in the "jobs" collection, or in a JSON file with JOBS_STORE=file for tests,
+so they survive restarts; a job claimed by a worker that died is claimed
+again once its lease runs out.
+Handlers are registered per job type and get a batch of payloads at once,
+failed jobs are retried with exponential backoff and kept as "failed" once
+their attempts are used up. Workers run in every app process that serves a
+request, or beside the app with JOBS_IN_PROCESS=false and
+	python jobs.py work
+Jobs run at least once, a handler may see a payload again after a crash.
+_________________________________
+"""
+import json
+from os import environ, getpid, path, replace
+from sys import argv
+from time import time
+from uuid import uuid4
+from random import uniform
+from threading import Lock, Thread, Event
+
+from database import get_database, load_environment, CONFLICT_ERROR
+from metrics import logger
+
+
+""" Seconds failed jobs are kept for inspection before the TTL index removes them. """
+FAILED_RETENTION = float(environ.get("JOBS_FAILED_RETENTION", 7 * 86400))
+
+
+"""
+__________________________________
+STORES
+__________________________________
+"""
+""" Interface of job stores. Jobs are dicts with _key, type, payload, status, attempts and run_at. """
+class JobStore():
+	def add(self, job: dict):
+		raise NotImplementedError
+
+	def claim(self, job_type: str, limit: int, worker: str, now: float, lease: float) -> list:
+		""" Marks up to limit due jobs of the type running for the lease, returns them with attempts counted. """
+		raise NotImplementedError
+
+	def complete(self, keys: list):
+		raise NotImplementedError
+
+	def release(self, updates: list):
+		""" Applies (key, fields) updates to jobs that are retried or failed. """
+		raise NotImplementedError
+
+	def stats(self, now: float) -> dict:
+		""" Counts per status and the seconds the oldest due job has waited. """
+		raise NotImplementedError
+
+
+CLAIM_QUERY = """
+FOR j IN jobs
+	FILTER j.type == @type
+	FILTER (j.status == "queued" AND j.run_at <= @now) OR (j.status == "running" AND j.locked_until <= @now)
+	SORT j.run_at
+	LIMIT @limit
+	UPDATE j WITH { status: "running", locked_until: @now + @lease, worker: @worker, attempts: j.attempts + 1 } IN jobs
+	RETURN NEW
+"""
+
+COMPLETE_QUERY = """
+FOR key IN @keys
+	REMOVE key IN jobs
+	OPTIONS { ignoreErrors: true }
+"""
+
+RELEASE_QUERY = """
+FOR item IN @updates
+	UPDATE item.key WITH item.fields IN jobs
+	OPTIONS { keepNull: false, ignoreErrors: true }
+"""
+
+STATS_QUERY = """
+FOR j IN jobs
+	COLLECT status = j.status AGGREGATE count = LENGTH(1), oldest = MIN(j.run_at)
+	RETURN { status, count, oldest }
+"""
+
+
+""" Jobs in the "jobs" collection, shared by every process of the app. """
+class ArangoJobStore(JobStore):
+	def add(self, job: dict):
+		get_database().collection("jobs").insert(job, silent=True)
+
+	def claim(self, job_type: str, limit: int, worker: str, now: float, lease: float) -> list:
+		from arango.exceptions import AQLQueryExecuteError
+		try:
+			return list(get_database().aql.execute(CLAIM_QUERY, bind_vars={
+				"type": job_type, "limit": limit, "worker": worker, "now": now, "lease": lease }))
+		except AQLQueryExecuteError as error:
+			# Another worker claimed the same jobs first, they are its to run.
+			if error.error_code == CONFLICT_ERROR:
+				return []
+			raise
+
+	def complete(self, keys: list):
+		if len(keys):
+			get_database().aql.execute(COMPLETE_QUERY, bind_vars={ "keys": keys })
+
+	def release(self, updates: list):
+		if len(updates):
+			get_database().aql.execute(RELEASE_QUERY, bind_vars={
+				"updates": [{ "key": key, "fields": fields } for key, fields in updates] })
+
+	def stats(self, now: float) -> dict:
+		return summarize_statuses(get_database().aql.execute(STATS_QUERY), now)
+
+
+""" Jobs in a JSON file, for tests and single process setups. """
+class FileJobStore(JobStore):
+	def __init__(self, file_path: str):
+		self.path = file_path
+		self._lock = Lock()
+		self._jobs = None
+
+	def _load(self) -> dict:
+		if self._jobs is None:
+			self._jobs = {}
+			if path.exists(self.path):
+				with open(self.path) as jobs_file:
+					self._jobs = json.load(jobs_file)
+		return self._jobs
+
+	def _save(self):
+		temporary_path = f"{self.path}.tmp"
+		with open(temporary_path, "w") as jobs_file:
+			json.dump(self._jobs, jobs_file)
+		replace(temporary_path, self.path)
+
+	def add(self, job: dict):
+		with self._lock:
+			self._load()[job["_key"]] = job
+			self._save()
+
+	def claim(self, job_type: str, limit: int, worker: str, now: float, lease: float) -> list:
+		with self._lock:
+			due = sorted((job for job in self._load().values() if job["type"] == job_type and (
+				(job["status"] == "queued" and job["run_at"] <= now) or
+				(job["status"] == "running" and job["locked_until"] <= now))), key=lambda job: job["run_at"])[:limit]
+			for job in due:
+				job.update(status="running", locked_until=now + lease, worker=worker, attempts=job["attempts"] + 1)
+			if len(due):
+				self._save()
+			return [dict(job) for job in due]
+
+	def complete(self, keys: list):
+		with self._lock:
+			for key in keys:
+				self._load().pop(key, None)
+			self._save()
+
+	def release(self, updates: list):
+		with self._lock:
+			jobs = self._load()
+			for key, fields in updates:
+				if key in jobs:
+					jobs[key].update(fields)
+					for field in [field for field, value in fields.items() if value is None]:
+						del jobs[key][field]
+			self._save()
+
+	def stats(self, now: float) -> dict:
+		with self._lock:
+			statuses = {}
+			for job in self._load().values():
+				count, oldest = statuses.get(job["status"], (0, None))
+				statuses[job["status"]] = (count + 1, job["run_at"] if oldest is None else min(oldest, job["run_at"]))
+		return summarize_statuses(
+			[{ "status": status, "count": count, "oldest": oldest } for status, (count, oldest) in statuses.items()], now)
+
+
+def summarize_statuses(rows, now: float) -> dict:
+	stats = { "queued": 0, "running": 0, "failed": 0, "lag_seconds": 0.0 }
+	for row in rows:
+		stats[row["status"]] = row["count"]
+		if row["status"] == "queued" and row["oldest"] is not None:
+			stats["lag_seconds"] = max(0.0, now - row["oldest"])
+	return stats
+
+
+"""
+__________________________________
+HANDLERS AND WORKERS
+__________________________________
+"""
+""" A job type with the function running a batch of its payloads. """
+class Handler():
+	def __init__(self, job_type: str, run, batch_size: int = 1, max_attempts: int = None):
+		self.job_type = job_type
+		self.run = run
+		self.batch_size = batch_size
+		self.max_attempts = max_attempts or int(environ.get("JOBS_MAX_ATTEMPTS", 5))
+
+
+""" Handlers by job type, registered with @handler where the work they do lives. """
+HANDLERS = {}
+
+
+def handler(job_type: str, batch_size: int = 1, max_attempts: int = None):
+	""" Registers a function taking a list of payloads. It returns None when all succeeded, or
+	one error or None per payload; raising retries the whole batch. """
+	def register(run):
+		HANDLERS[job_type] = Handler(job_type, run, batch_size, max_attempts)
+		return run
+	return register
+
+
+class JobQueue():
+	def __init__(self, store: JobStore, workers=None, poll_interval=None, lease=None, backoff=None, max_backoff=None):
+		self.store = store
+		self.workers = workers if workers is not None else int(environ.get("JOBS_WORKERS", 2))
+		self.poll_interval = poll_interval or float(environ.get("JOBS_POLL_INTERVAL", 1))
+		self.lease = lease or float(environ.get("JOBS_LEASE", 60))
+		self.backoff = backoff or float(environ.get("JOBS_BACKOFF", 2))
+		self.max_backoff = max_backoff or float(environ.get("JOBS_MAX_BACKOFF", 600))
+		self._threads = []
+		self._pid = None
+		self._wake = Event()
+		self._lock = Lock()
+		self._metrics = { "enqueued": 0, "succeeded": 0, "retried": 0, "failed": 0, "batches": 0,
+			"claim_errors": 0, "enqueue_errors": 0, "lag_total": 0.0, "lag_max": 0.0 }
+
+	def _count(self, metric: str, value=1):
+		with self._lock:
+			self._metrics[metric] += value
+
+	def enqueue(self, job_type: str, payload: dict, delay: float = 0) -> str:
+		""" Stores the job and returns its key, workers pick it up after the delay. """
+		now = time()
+		key = uuid4().hex
+		self.store.add({ "_key": key, "type": job_type, "payload": payload, "status": "queued",
+			"attempts": 0, "created_at": now, "run_at": now + delay })
+		self._count("enqueued")
+		self._wake.set()
+		return key
+
+	def enqueue_after_write(self, job_type: str, payload: dict, delay: float = 0):
+		""" Enqueues the follow-up of a write that already happened, returns None when the store failed.
+		The write stands either way, the failure is logged and counted instead of failing the request. """
+		try:
+			return self.enqueue(job_type, payload, delay)
+		except Exception:
+			logger.exception("Enqueueing a job failed.", extra={ "type": job_type, "payload": payload })
+			self._count("enqueue_errors")
+			return None
+
+	def ensure_workers(self):
+		""" The worker threads are started on first use in each process. """
+		if self.workers <= 0 or (self._pid == getpid() and len(self._threads) >= self.workers
+				and all(thread.is_alive() for thread in self._threads)):
+			return
+		with self._lock:
+			if self._pid != getpid():
+				# Threads of the parent do not exist in a forked worker.
+				self._threads = []
+				self._pid = getpid()
+			self._threads = [thread for thread in self._threads if thread.is_alive()]
+			while len(self._threads) < self.workers:
+				thread = Thread(target=self._work, args=(f"{getpid()}-{len(self._threads)}",),
+					name=f"jobs-{len(self._threads)}", daemon=True)
+				thread.start()
+				self._threads.append(thread)
+
+	def run_pending(self, worker: str = None) -> int:
+		""" Claims and runs due jobs of every type once, returns how many ran. """
+		worker = worker or f"{getpid()}-inline"
+		ran = 0
+		for job_handler in list(HANDLERS.values()):
+			try:
+				jobs = self.store.claim(job_handler.job_type, job_handler.batch_size, worker, time(), self.lease)
+			except:
+				self._count("claim_errors")
+				logger.warning("Claiming jobs failed.", exc_info=True)
+				continue
+			if len(jobs):
+				self._run(job_handler, jobs)
+				ran += len(jobs)
+		return ran
+
+	def _work(self, worker: str):
+		while True:
+			if self.run_pending(worker) == 0:
+				# Enqueues in this process wake the workers, jobs of other processes are found by polling.
+				self._wake.wait(self.poll_interval)
+				self._wake.clear()
+
+	def _run(self, job_handler: Handler, jobs: list):
+		started = time()
+		lags = [started - job["run_at"] for job in jobs]
+		try:
+			errors = job_handler.run([job["payload"] for job in jobs])
+		except Exception as error:
+			errors = [error] * len(jobs)
+		if errors is None:
+			errors = [None] * len(jobs)
+
+		now = time()
+		succeeded, updates = [], []
+		for job, error in zip(jobs, errors):
+			if error is None:
+				succeeded.append(job["_key"])
+			elif job["attempts"] >= job_handler.max_attempts:
+				updates.append((job["_key"], { "status": "failed", "last_error": repr(error), "locked_until": None,
+					"expire_at": now + FAILED_RETENTION }))
+			else:
+				delay = min(self.max_backoff, self.backoff * 2 ** (job["attempts"] - 1)) * uniform(0.5, 1.0)
+				updates.append((job["_key"], { "status": "queued", "last_error": repr(error), "locked_until": None,
+					"run_at": now + delay }))
+		failed = sum(1 for _, fields in updates if fields["status"] == "failed")
+		if failed:
+			logger.error("Jobs failed for good.", extra={ "type": job_handler.job_type, "jobs": failed })
+		self.store.complete(succeeded)
+		self.store.release(updates)
+
+		with self._lock:
+			self._metrics["batches"] += 1
+			self._metrics["succeeded"] += len(succeeded)
+			self._metrics["failed"] += failed
+			self._metrics["retried"] += len(updates) - failed
+			self._metrics["lag_total"] += sum(lags)
+			self._metrics["lag_max"] = max(self._metrics["lag_max"], max(lags))
+
+	def metrics(self) -> dict:
+		""" Counters of this process with the depth and lag of the shared queue. """
+		with self._lock:
+			metrics = { **self._metrics }
+		runs = metrics["succeeded"] + metrics["retried"] + metrics["failed"]
+		metrics["lag_avg"] = metrics["lag_total"] / runs if runs else 0.0
+		try:
+			metrics.update(self.store.stats(time()))
+		except:
+			logger.warning("Reading job queue stats failed.", exc_info=True)
+		return metrics
+
+
+def default_store() -> JobStore:
+	if environ.get("JOBS_STORE", "arango") == "file":
+		return FileJobStore(environ.get("JOBS_FILE", "jobs.json"))
+	return ArangoJobStore()
+
+
+job_queue = JobQueue(default_store())
+
+""" Whether app processes run workers, a separate `python jobs.py work` process can take over. """
+JOBS_IN_PROCESS = environ.get("JOBS_IN_PROCESS", "true") == "true"
+
+
+def enqueue(job_type: str, payload: dict, delay: float = 0) -> str:
+	return job_queue.enqueue(job_type, payload, delay)
+
+
+def enqueue_after_write(job_type: str, payload: dict, delay: float = 0):
+	return job_queue.enqueue_after_write(job_type, payload, delay)
+
+
+def install(app):
+	""" Starts the workers of each app process on its first request, never on import or in a preloading master. """
+	if JOBS_IN_PROCESS:
+		app.before_request(job_queue.ensure_workers)
+	return app
+
+
+if __name__ == "__main__":
+	load_environment()
+	# Settings are read and handlers registered on the jobs module, not on this __main__ copy of it.
+	import jobs
+	if len(argv) > 1 and argv[1] == "work":
+		import server
+		if len(argv) > 2:
+			jobs.job_queue.workers = int(argv[2])
+		jobs.job_queue.ensure_workers()
+		Event().wait()
+	elif len(argv) > 1 and argv[1] == "stats":
+		print(jobs.job_queue.metrics())
+	else:
+		print("Usage: python jobs.py work [workers] | stats")
@@ -0,0 +1,249 @@
+"""
+_________________________________
+SIGNING KEYS
+Authentication tokens are signed with ES256 or EdDSA keys from the keyring
+file JWT_KEYRING and carry the key id as "kid". Other services verify them
+with the public keys from /accounts/.well-known/jwks.json instead of
+calling /accounts/authentication/re.
+
+Rotation is scheduled: a new key is published in the JWKS right away and
+starts signing at its activation time, which also retires the previous key.
+Retired keys stay published until the longest lived token they signed has
+expired.
+	python keys.py rotate [ES256|EdDSA] [lead_hours]
+	python keys.py rotate-due [days] [ES256|EdDSA] [lead_hours]    for cron
+	python keys.py list
+	python keys.py prune
+Without a keyring tokens keep being signed with HS256 and SEED. HS256
+tokens are accepted until JWT_HS256_ACCEPTED_UNTIL (a unix timestamp).
+_________________________________
+"""
+import json
+from os import environ, path, chmod, remove, replace
+from sys import argv
+from time import time
+from uuid import uuid4
+from threading import Lock
+from base64 import urlsafe_b64encode
+
+from metrics import logger
+
+
+""" Algorithms keys can be generated for. """
+ALGORITHMS = ("ES256", "EdDSA")
+
+""" Keyring file, private keys are PEM files next to it. """
+KEYRING_PATH = environ.get("JWT_KEYRING", "keyring.json")
+
+""" Seconds between checks of the keyring file for changes. """
+KEYRING_RELOAD_INTERVAL = float(environ.get("JWT_KEYRING_RELOAD_INTERVAL", 60))
+
+""" Seconds verifiers may cache the JWKS, new keys are published at least this long before they sign. """
+JWKS_MAX_AGE = int(environ.get("JWKS_MAX_AGE", 3600))
+
+""" Days a key signs before rotate-due replaces it. """
+ROTATION_DAYS = float(environ.get("JWT_ROTATION_DAYS", 90))
+
+""" Longest lifetime of a token from generate_authentication_token, retired keys verify for this long. """
+TOKEN_MAX_LIFETIME = 365 * 86400
+
+
+def hs256_accepted(now: float = None) -> bool:
+	""" HS256 tokens are accepted until the migration deadline, indefinitely when none is set. """
+	deadline = environ.get("JWT_HS256_ACCEPTED_UNTIL")
+	return not deadline or (now or time()) < float(deadline)
+
+
+def _b64(data: bytes) -> str:
+	return urlsafe_b64encode(data).rstrip(b"=").decode("utf-8")
+
+
+""" A key of the keyring with its schedule. """
+class SigningKey():
+	__slots__ = ("kid", "alg", "private_key", "public_key", "activates_at", "retires_at")
+
+	def __init__(self, kid: str, alg: str, private_key, activates_at: float, retires_at: float = None):
+		self.kid = kid
+		self.alg = alg
+		self.private_key = private_key
+		self.public_key = private_key.public_key()
+		self.activates_at = activates_at
+		self.retires_at = retires_at
+
+	def signs(self, now: float) -> bool:
+		return self.activates_at <= now and (self.retires_at is None or now < self.retires_at)
+
+	def verifies(self, now: float) -> bool:
+		""" Published from creation until every token it signed has expired. """
+		return self.retires_at is None or now < self.retires_at + TOKEN_MAX_LIFETIME
+
+	def jwk(self) -> dict:
+		from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+		if self.alg == "ES256":
+			numbers = self.public_key.public_numbers()
+			key = { "kty": "EC", "crv": "P-256", "x": _b64(numbers.x.to_bytes(32, "big")), "y": _b64(numbers.y.to_bytes(32, "big")) }
+		else:
+			key = { "kty": "OKP", "crv": "Ed25519", "x": _b64(self.public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)) }
+		return { **key, "kid": self.kid, "alg": self.alg, "use": "sig" }
+
+
+def generate_private_key(alg: str):
+	from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+	if alg == "ES256":
+		return ec.generate_private_key(ec.SECP256R1())
+	if alg == "EdDSA":
+		return ed25519.Ed25519PrivateKey.generate()
+	raise ValueError(f"Unsupported algorithm {alg}, use one of {', '.join(ALGORITHMS)}.")
+
+
+""" Keys of the keyring file, reloaded when the file changes. """
+class Keyring():
+	def __init__(self, keyring_path: str, reload_interval: float):
+		self.path = keyring_path
+		self.reload_interval = reload_interval
+		self._keys = []
+		self._jwks = None
+		self._mtime = None
+		self._checked_at = None
+		self._lock = Lock()
+
+	def _refresh(self):
+		now = time()
+		if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+			return
+		with self._lock:
+			if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+				return
+			self._checked_at = now
+			mtime = path.getmtime(self.path) if path.exists(self.path) else None
+			if mtime == self._mtime:
+				return
+			try:
+				self._keys = self._load()
+				self._jwks = None
+				self._mtime = mtime
+			except:
+				# The keys loaded before stay in use until the file can be read again.
+				logger.exception("Loading the keyring failed.")
+
+	def _load(self) -> list:
+		from cryptography.hazmat.primitives.serialization import load_pem_private_key
+		keys = []
+		for entry in read_entries(self.path):
+			with open(path.join(path.dirname(path.abspath(self.path)), entry["private_key"]), "rb") as pem:
+				private_key = load_pem_private_key(pem.read(), password=None)
+			keys.append(SigningKey(entry["kid"], entry["alg"], private_key, entry["activates_at"], entry.get("retires_at")))
+		return keys
+
+	def signing_key(self):
+		""" The most recently activated key that is not retired, None without a keyring. """
+		self._refresh()
+		now = time()
+		signing = [key for key in self._keys if key.signs(now)]
+		return max(signing, key=lambda key: key.activates_at) if signing else None
+
+	def verification_key(self, kid: str):
+		self._refresh()
+		now = time()
+		for key in self._keys:
+			if key.kid == kid and key.verifies(now):
+				return key
+		return None
+
+	def jwks(self) -> dict:
+		self._refresh()
+		now = time()
+		published = [key for key in self._keys if key.verifies(now)]
+		# Keys only change on reload or when one leaves the verification window, the JWKS is rebuilt then.
+		if self._jwks is None or self._jwks[0] != [key.kid for key in published]:
+			self._jwks = ([key.kid for key in published], { "keys": [key.jwk() for key in published] })
+		return self._jwks[1]
+
+
+keyring = Keyring(KEYRING_PATH, KEYRING_RELOAD_INTERVAL)
+
+
+"""
+__________________________________
+KEYRING MANAGEMENT
+__________________________________
+"""
+def read_entries(keyring_path: str) -> list:
+	if not path.exists(keyring_path):
+		return []
+	with open(keyring_path) as keyring_file:
+		return json.load(keyring_file)["keys"]
+
+
+def write_entries(keyring_path: str, entries: list):
+	# Written to a temporary file first so workers never read a partial keyring.
+	temporary_path = f"{keyring_path}.tmp"
+	with open(temporary_path, "w") as keyring_file:
+		json.dump({ "keys": entries }, keyring_file, indent=2)
+	replace(temporary_path, keyring_path)
+
+
+def rotate(keyring_path: str, alg: str = "ES256", lead_hours: float = None) -> dict:
+	""" Adds a key that signs from now + lead_hours on, the keys signing until then retire at that moment. """
+	from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, NoEncryption
+	lead_seconds = JWKS_MAX_AGE * 2 if lead_hours is None else lead_hours * 3600
+	if lead_seconds < JWKS_MAX_AGE:
+		logger.warning("Rotation lead is shorter than JWKS_MAX_AGE, verifiers with a cached JWKS will reject new tokens.")
+
+	entries = read_entries(keyring_path)
+	kid = uuid4().hex
+	private_key_path = f"{kid}.pem"
+	pem = generate_private_key(alg).private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+	absolute_key_path = path.join(path.dirname(path.abspath(keyring_path)), private_key_path)
+	with open(absolute_key_path, "wb") as key_file:
+		key_file.write(pem)
+	chmod(absolute_key_path, 0o600)
+
+	activates_at = time() + lead_seconds
+	for entry in entries:
+		if entry.get("retires_at") is None or entry["retires_at"] > activates_at:
+			entry["retires_at"] = activates_at
+	entry = { "kid": kid, "alg": alg, "private_key": private_key_path, "activates_at": activates_at, "retires_at": None }
+	write_entries(keyring_path, entries + [entry])
+	return entry
+
+
+def rotation_due(keyring_path: str, days: float) -> bool:
+	""" Due when no key is scheduled to sign after the newest one has signed for the given days. """
+	entries = read_entries(keyring_path)
+	if len(entries) == 0:
+		return True
+	newest = max(entries, key=lambda entry: entry["activates_at"])
+	return newest.get("retires_at") is not None or time() - newest["activates_at"] >= days * 86400
+
+
+def prune(keyring_path: str) -> list:
+	""" Removes the keys whose tokens have all expired, returns their ids. """
+	now = time()
+	entries = read_entries(keyring_path)
+	expired = [entry for entry in entries if entry.get("retires_at") is not None and now >= entry["retires_at"] + TOKEN_MAX_LIFETIME]
+	write_entries(keyring_path, [entry for entry in entries if entry not in expired])
+	for entry in expired:
+		key_path = path.join(path.dirname(path.abspath(keyring_path)), entry["private_key"])
+		if path.exists(key_path):
+			remove(key_path)
+	return [entry["kid"] for entry in expired]
+
+
+if __name__ == "__main__":
+	command = argv[1] if len(argv) > 1 else None
+	if command == "rotate":
+		print(rotate(KEYRING_PATH, argv[2] if len(argv) > 2 else "ES256", float(argv[3]) if len(argv) > 3 else None))
+	elif command == "rotate-due":
+		days = float(argv[2]) if len(argv) > 2 else ROTATION_DAYS
+		if rotation_due(KEYRING_PATH, days):
+			print(rotate(KEYRING_PATH, argv[3] if len(argv) > 3 else "ES256", float(argv[4]) if len(argv) > 4 else None))
+		else:
+			print("ROTATION NOT DUE")
+	elif command == "list":
+		for entry in read_entries(KEYRING_PATH):
+			print(entry)
+	elif command == "prune":
+		print(prune(KEYRING_PATH))
+	else:
+		print(__doc__)
@@ -0,0 +1,75 @@
+"""
+_________________________________
+MAILER
+Outgoing email is sent by the "email" job, a batch of messages shares one
+SMTP connection. Point SMTP_HOST and SMTP_PORT at a local stand-in to test,
+for example the one in benchmarks/smtp_sink.py.
+_________________________________
+"""
+from os import environ
+
+from jobs import handler, enqueue
+
+
+SMTP_HOST = environ.get("SMTP_HOST", "localhost")
+SMTP_PORT = int(environ.get("SMTP_PORT", 25))
+SMTP_USERNAME = environ.get("SMTP_USERNAME")
+SMTP_PASSWORD = environ.get("SMTP_PASSWORD")
+
+""" "none", "starttls" or "ssl". """
+SMTP_SECURITY = environ.get("SMTP_SECURITY", "none")
+SMTP_TIMEOUT = float(environ.get("SMTP_TIMEOUT", 10))
+SMTP_FROM = environ.get("SMTP_FROM", "Hetchfund.Capital <no-reply@hetchfund.capital>")
+
+""" Messages sent over one connection. """
+SMTP_BATCH_SIZE = int(environ.get("SMTP_BATCH_SIZE", 50))
+
+
+def build_message(to: str, subject: str, body: str):
+	from email.message import EmailMessage
+	message = EmailMessage()
+	message["From"] = SMTP_FROM
+	message["To"] = to
+	message["Subject"] = subject
+	message.set_content(body)
+	return message
+
+
+def connect():
+	import smtplib
+	if SMTP_SECURITY == "ssl":
+		smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+	else:
+		smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+		if SMTP_SECURITY == "starttls":
+			smtp.starttls()
+	if SMTP_USERNAME:
+		smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+	return smtp
+
+
+def deliver(messages: list) -> list:
+	""" Sends (to, subject, body) messages over one connection, returns an error or None per message.
+	A broken connection raises so the whole batch is retried. """
+	from smtplib import SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError
+	errors = []
+	with connect() as smtp:
+		for to, subject, body in messages:
+			try:
+				smtp.send_message(build_message(to, subject, body))
+				errors.append(None)
+			# Refusals of a single message, the other messages of the connection are still sent.
+			except (SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError) as error:
+				errors.append(error)
+	return errors
+
+
+@handler("email", batch_size=SMTP_BATCH_SIZE)
+def send_messages(payloads: list) -> list:
+	""" Sends { to, subject, body } payloads. """
+	return deliver([(payload["to"], payload["subject"], payload["body"]) for payload in payloads])
+
+
+""" Queues an email, the request sending it never waits on SMTP. """
+def send_email(to: str, subject: str, body: str) -> str:
+	return enqueue("email", { "to": to, "subject": subject, "body": body })
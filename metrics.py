@@ -0,0 +1,292 @@
+"""
+_________________________________
+METRICS, LOGGING AND PROFILING
+Per-route latency histograms, spans for database calls, hashing, outbound
+HTTP and serialization, JSON logs carrying the request ID, a Prometheus text
+endpoint and a sampling profiler toggled per worker with a signal:
+	kill -USR2 <worker pid>    starts sampling, sending it again writes the profile
+Metrics are kept per process, every worker reports its own.
+_________________________________
+"""
+import json
+import logging
+import signal
+import sys
+from os import environ, getpid, path
+from time import perf_counter, time, sleep
+from uuid import uuid4
+from threading import Lock, Thread
+from contextvars import ContextVar
+from collections import Counter
+
+
+""" Upper bounds in seconds, the last bucket catches everything else. """
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+""" Span kinds recorded underneath requests. """
+SPAN_KINDS = ("db", "hashing", "http", "serialization")
+
+
+class Histogram():
+	def __init__(self, name: str, description: str, labels: tuple, buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.description = description
+		self.labels = labels
+		self.buckets = buckets
+		self._series = {}
+		self._lock = Lock()
+
+	def observe(self, value: float, *label_values):
+		with self._lock:
+			series = self._series.get(label_values)
+			if series is None:
+				series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+			for index, bound in enumerate(self.buckets):
+				if value <= bound:
+					break
+			else:
+				index = len(self.buckets)
+			series[0][index] += 1
+			series[1] += value
+			series[2] += 1
+
+	def render(self) -> list:
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+		with self._lock:
+			series = { label_values: (list(counts), total, count) for label_values, (counts, total, count) in self._series.items() }
+		for label_values, (counts, total, count) in sorted(series.items()):
+			labels = [f'{label}="{escape(value)}"' for label, value in zip(self.labels, label_values)]
+			label_text = ",".join(labels)
+			cumulative = 0
+			for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+				cumulative += bucket_count
+				bucket_labels = ",".join(labels + [f'le="{bound}"'])
+				lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+			lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+			lines.append(f"{self.name}_count{{{label_text}}} {count}")
+		return lines
+
+
+def escape(value) -> str:
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram("hetch_request_duration_seconds", "Time spent answering requests.", ("route", "method", "status"))
+span_duration = Histogram("hetch_span_duration_seconds", "Time spent in work underneath requests.", ("kind",))
+
+""" Callables returning { metric name: (description, { labels tuple: value }) } rendered as gauges. """
+_collectors = []
+
+def register_collector(collector):
+	_collectors.append(collector)
+
+
+def render() -> str:
+	lines = request_duration.render() + span_duration.render()
+	for collector in _collectors:
+		for name, (description, samples) in collector().items():
+			lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+			for labels, value in samples.items():
+				label_text = ",".join(f'{label}="{escape(label_value)}"' for label, label_value in labels)
+				lines.append(f"{name}{{{label_text}}} {float(value)}" if label_text else f"{name} {float(value)}")
+	return "\n".join(lines) + "\n"
+
+
+"""
+__________________________________
+REQUESTS AND SPANS
+__________________________________
+"""
+""" Span totals of the request handled by the current thread or task. """
+class RequestMetrics():
+	__slots__ = ("request_id", "started", "spans")
+
+	def __init__(self, request_id: str):
+		self.request_id = request_id
+		self.started = perf_counter()
+		self.spans = {}
+
+_current_request = ContextVar("current_request", default=None)
+
+
+def current_request_id():
+	current = _current_request.get()
+	return current.request_id if current is not None else None
+
+
+""" Times a block of work, e.g. `with span("db"):`, outside requests only the histogram is updated. """
+class span():
+	__slots__ = ("kind", "started")
+
+	def __init__(self, kind: str):
+		self.kind = kind
+
+	def __enter__(self):
+		self.started = perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		elapsed = perf_counter() - self.started
+		span_duration.observe(elapsed, self.kind)
+		current = _current_request.get()
+		if current is not None:
+			total = current.spans.get(self.kind)
+			current.spans[self.kind] = (total[0] + elapsed, total[1] + 1) if total is not None else (elapsed, 1)
+		return False
+
+
+def start_request(request_id=None):
+	""" Returns the token that finish_request resets the context with. """
+	return _current_request.set(RequestMetrics(request_id or uuid4().hex))
+
+
+def finish_request(token, route: str, method: str, status) -> RequestMetrics:
+	""" Records the request duration unless status is None, e.g. when another handler answers instead. """
+	current = _current_request.get()
+	_current_request.reset(token)
+	if current is not None and status is not None:
+		request_duration.observe(perf_counter() - current.started, route, method, str(status))
+	return current
+
+
+"""
+__________________________________
+STRUCTURED LOGS
+__________________________________
+"""
+""" Fields of a log record that are not copied into the JSON line. """
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | { "message", "asctime" }
+
+
+class JSONFormatter(logging.Formatter):
+	def format(self, record) -> str:
+		entry = {
+			"time": record.created, "level": record.levelname, "logger": record.name,
+			"message": record.getMessage(), "request_id": current_request_id(), "pid": record.process }
+		entry.update({ key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS })
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+		return json.dumps(entry, default=str)
+
+
+logger = logging.getLogger("hetch_accounts")
+if not logger.handlers:
+	_handler = logging.StreamHandler(sys.stdout)
+	_handler.setFormatter(JSONFormatter())
+	logger.addHandler(_handler)
+	logger.setLevel(environ.get("LOG_LEVEL", "INFO"))
+	logger.propagate = False
+
+""" Access logs for every request, the metrics are recorded either way. """
+ACCESS_LOG = environ.get("ACCESS_LOG", "true") == "true"
+
+
+"""
+__________________________________
+FLASK MIDDLEWARE
+__________________________________
+"""
+def instrument(app):
+	""" Records every request of the app, answers with its X-Request-ID and serves /accounts/metrics. """
+	from flask import request, g, Response as FlaskResponse
+
+	@app.before_request
+	def start_request_metrics():
+		g.metrics_token = start_request(request.headers.get("X-Request-ID"))
+		g.request_id = current_request_id()
+
+	@app.after_request
+	def finish_request_metrics(response):
+		token = g.pop("metrics_token", None)
+		if token is None:
+			return response
+		route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+		current = finish_request(token, route, request.method, response.status_code)
+		response.headers["X-Request-ID"] = current.request_id
+		if ACCESS_LOG:
+			logger.info("request", extra={
+				"request_id": current.request_id, "route": route, "method": request.method,
+				"status": response.status_code, "duration_ms": round((perf_counter() - current.started) * 1000, 3),
+				"spans_ms": { kind: round(total * 1000, 3) for kind, (total, _) in current.spans.items() } })
+		return response
+
+	@app.route("/accounts/metrics", methods=["GET"])
+	def metrics_endpoint():
+		return FlaskResponse(render(), mimetype="text/plain; version=0.0.4")
+
+	profiler.install_signal()
+	return app
+
+
+"""
+__________________________________
+SAMPLING PROFILER
+__________________________________
+"""
+""" Samples the stacks of every thread into folded stack counts, for flame graph tools. """
+class SamplingProfiler():
+	def __init__(self, interval=None, output_directory=None):
+		self.interval = interval or float(environ.get("PROFILER_INTERVAL", 0.005))
+		self.output_directory = output_directory or environ.get("PROFILER_OUTPUT_DIR", "/tmp")
+		self.samples = Counter()
+		self.running = False
+		self._thread = None
+		self._lock = Lock()
+
+	def start(self):
+		with self._lock:
+			if self.running:
+				return
+			self.running = True
+			self.samples = Counter()
+			self._thread = Thread(target=self._sample, name="sampling-profiler", daemon=True)
+			self._thread.start()
+		logger.info("profiler started", extra={ "interval": self.interval })
+
+	def stop(self):
+		""" Stops sampling and writes the folded stacks, returns the file path. """
+		with self._lock:
+			if not self.running:
+				return None
+			self.running = False
+		self._thread.join()
+		output = path.join(self.output_directory, f"profile-{getpid()}-{int(time())}.folded")
+		with open(output, "w", encoding="utf-8") as profile:
+			for stack, count in self.samples.most_common():
+				profile.write(f"{stack} {count}\n")
+		logger.info("profiler stopped", extra={ "output": output, "samples": sum(self.samples.values()) })
+		return output
+
+	def toggle(self, *args):
+		# Signal handlers must return quickly, stopping joins the sampler and writes a file.
+		if self.running:
+			Thread(target=self.stop, daemon=True).start()
+		else:
+			self.start()
+
+	def _sample(self):
+		own_thread = self._thread.ident
+		while self.running:
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_thread:
+					continue
+				stack = []
+				while frame is not None:
+					stack.append(f"{frame.f_code.co_name} ({path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+					frame = frame.f_back
+				self.samples[";".join(reversed(stack))] += 1
+			sleep(self.interval)
+
+	def install_signal(self):
+		""" Signal handlers can only be installed from the main thread, other setups skip the hook. """
+		signal_name = environ.get("PROFILER_SIGNAL", "SIGUSR2")
+		if not signal_name or not hasattr(signal, signal_name):
+			return False
+		try:
+			signal.signal(getattr(signal, signal_name), self.toggle)
+			return True
+		except ValueError:
+			return False
+
+
+profiler = SamplingProfiler()
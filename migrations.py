@@ -0,0 +1,312 @@
+"""
+_________________________________
+SCHEMA MIGRATIONS
+Account documents carry _schema_version_, steps registered with @migration
+are pure functions taking a document of one version to the next. Documents
+are brought to LATEST_VERSION in two ways:
+	on read     AccountModel upgrades full documents in memory, the changed
+	            fields are written back by a background thread in batches,
+	            repeated reads of an account within a batch write it once
+	in bulk     python migrations.py migrate [ops_per_second] [chunk_size]
+	            walks the accounts by _key within an operations budget and
+	            checkpoints its position, an interrupted run resumes from it
+Write-backs only apply to the revision that was read, accounts changed in
+between are upgraded again on their next read or run.
+_________________________________
+"""
+import json
+from os import environ, getpid, path, replace
+from sys import argv
+from time import monotonic, sleep
+from threading import Lock, Thread, Event
+from collections import OrderedDict
+
+from database import get_database, load_environment, CONFLICT_ERROR
+from cache import profile_cache
+from metrics import logger
+from models.time_created import TimeCreatedModel
+
+
+"""
+__________________________________
+REGISTRY
+__________________________________
+"""
+""" Version of documents written before versioning, and of documents without the field. """
+INITIAL_VERSION = 2022.01
+
+""" Steps keyed by the version they upgrade from, as (to_version, step). """
+MIGRATIONS = {}
+
+
+def migration(from_version: float, to_version: float):
+	""" Registers a pure step, it returns a new document and never changes the one it is given. """
+	def register(step):
+		if from_version in MIGRATIONS:
+			raise ValueError(f"A migration from {from_version} is already registered.")
+		MIGRATIONS[from_version] = (to_version, step)
+		return step
+	return register
+
+
+@migration(2022.01, 2023.01)
+def fill_preferences_and_counters(document: dict) -> dict:
+	# Values are spelled out here rather than read from ACCOUNT_DEFAULTS, a step must not change when the defaults do.
+	return {
+		**document,
+		"preferences": { "2fa_authentication": False, "is_expire_login": True, **(document.get("preferences") or {}) },
+		"followers_count": document.get("followers_count") or 0,
+		"follows_count": document.get("follows_count") or 0,
+		"unread_notifications": document.get("unread_notifications") or 0 }
+
+
+def _latest_version() -> float:
+	version = INITIAL_VERSION
+	while version in MIGRATIONS:
+		version = MIGRATIONS[version][0]
+	return version
+
+LATEST_VERSION = _latest_version()
+
+
+def needs_upgrade(document: dict) -> bool:
+	return document.get("_schema_version_", INITIAL_VERSION) < LATEST_VERSION
+
+
+def upgrade(document: dict) -> dict:
+	""" Runs every step from the version of the document on, returns the document itself when it is current. """
+	version = document.get("_schema_version_", INITIAL_VERSION)
+	while version in MIGRATIONS:
+		version, step = MIGRATIONS[version]
+		document = { **step(document), "_schema_version_": version }
+	return document
+
+
+_MISSING = object()
+
+def changed_fields(document: dict, upgraded: dict) -> dict:
+	""" Top level fields to replace, removed fields are null. """
+	patch = { field: value for field, value in upgraded.items() if document.get(field, _MISSING) != value }
+	patch.update({ field: None for field in document if field not in upgraded })
+	return patch
+
+
+"""
+__________________________________
+WRITE-BACK
+__________________________________
+"""
+""" Replaces the changed fields of every account still at the revision that was upgraded. """
+WRITE_BACK_QUERY = """
+FOR item IN @items
+	LET account = DOCUMENT("accounts", item.key)
+	FILTER account != null AND account._rev == item.rev
+	UPDATE account WITH MERGE(item.patch, { last_modified: @modified }) IN accounts
+	OPTIONS { keepNull: false, mergeObjects: false }
+	RETURN NEW.username
+"""
+
+
+def write_upgrades(items: list) -> int:
+	""" Writes (key, rev, patch) items in one query, returns how many accounts were still at their revision. """
+	if len(items) == 0:
+		return 0
+	usernames = list(get_database().aql.execute(WRITE_BACK_QUERY,
+		bind_vars={ "items": [{ "key": key, "rev": rev, "patch": patch } for key, rev, patch in items],
+			"modified": TimeCreatedModel().__dict__ }))
+	# Profiles cached from the document before the write carry its old revision as their ETag.
+	for username in usernames:
+		profile_cache.delete(username)
+	return len(usernames)
+
+
+""" Collects upgraded accounts and writes them in batches, once per account however often it was read. """
+class WriteBack():
+	def __init__(self, enabled=None, delay=None, batch_size=None, queue_size=None):
+		self.enabled = enabled if enabled is not None else environ.get("MIGRATION_WRITE_BACK", "true") == "true"
+		self.delay = delay or float(environ.get("MIGRATION_WRITE_BACK_DELAY", 2))
+		self.batch_size = batch_size or int(environ.get("MIGRATION_WRITE_BACK_BATCH_SIZE", 100))
+		self.queue_size = queue_size or int(environ.get("MIGRATION_WRITE_BACK_QUEUE_SIZE", 10000))
+		self._pending = OrderedDict()
+		self._lock = Lock()
+		self._wake = Event()
+		self._worker = None
+		self._worker_pid = None
+		self._metrics = { "queued": 0, "coalesced": 0, "dropped": 0, "written": 0, "stale": 0, "failed": 0, "batches": 0 }
+
+	def _ensure_worker(self):
+		""" The worker thread is started on first use in each process. """
+		if self._worker is None or self._worker_pid != getpid() or not self._worker.is_alive():
+			self._worker = Thread(target=self._work, name="migration-write-back", daemon=True)
+			self._worker_pid = getpid()
+			self._worker.start()
+
+	def submit(self, key: str, rev: str, patch: dict) -> bool:
+		""" Queues the upgrade of an account without blocking, returns False when the queue is full. """
+		if not self.enabled:
+			return False
+		with self._lock:
+			self._ensure_worker()
+			if key in self._pending:
+				self._metrics["coalesced"] += 1
+			elif len(self._pending) >= self.queue_size:
+				self._metrics["dropped"] += 1
+				return False
+			else:
+				self._metrics["queued"] += 1
+			self._pending[key] = (rev, patch)
+			if len(self._pending) >= self.batch_size:
+				self._wake.set()
+		return True
+
+	def flush(self):
+		while True:
+			with self._lock:
+				batch = []
+				while len(self._pending) and len(batch) < self.batch_size:
+					key, (rev, patch) = self._pending.popitem(last=False)
+					batch.append((key, rev, patch))
+			if len(batch) == 0:
+				return
+			try:
+				written = write_upgrades(batch)
+				with self._lock:
+					self._metrics["batches"] += 1
+					self._metrics["written"] += written
+					self._metrics["stale"] += len(batch) - written
+			except:
+				# A conflict or an outage drops the batch, the accounts are upgraded again on their next read.
+				with self._lock:
+					self._metrics["failed"] += len(batch)
+				logger.warning("Writing back upgraded accounts failed.", exc_info=True)
+
+	def _work(self):
+		while True:
+			# A batch is written when it fills up, or after the delay so repeated reads coalesce.
+			self._wake.wait(self.delay)
+			self._wake.clear()
+			self.flush()
+
+	def metrics(self) -> dict:
+		with self._lock:
+			return { **self._metrics, "pending": len(self._pending) }
+
+
+write_back = WriteBack()
+
+
+def upgrade_on_read(document: dict) -> dict:
+	""" Upgrades a document read in full, projections are returned as they are since missing fields may just not be selected. """
+	if "_rev" not in document or not needs_upgrade(document):
+		return document
+	upgraded = upgrade(document)
+	write_back.submit(document["_key"], document["_rev"], changed_fields(document, upgraded))
+	return upgraded
+
+
+"""
+__________________________________
+BULK MIGRATION
+__________________________________
+"""
+""" Accounts after the cursor in _key order, with the ones still below the latest version in full. """
+BULK_CHUNK_QUERY = """
+LET chunk = (
+	FOR a IN accounts
+		FILTER @after == null OR a._key > @after
+		SORT a._key
+		LIMIT @chunk_size
+		RETURN a)
+RETURN {
+	last: LENGTH(chunk) > 0 ? LAST(chunk)._key : null,
+	scanned: LENGTH(chunk),
+	pending: (FOR a IN chunk FILTER (HAS(a, "_schema_version_") ? a._schema_version_ : @initial) < @latest RETURN a) }
+"""
+
+""" Reads of a chunk retried when accounts changed between reading and writing them. """
+CHUNK_ATTEMPTS = 3
+
+MIGRATION_CHECKPOINT = environ.get("MIGRATION_CHECKPOINT", "migration_checkpoint.json")
+
+
+def read_checkpoint(checkpoint_path: str) -> dict:
+	""" The saved position when it was made for the current latest version, a fresh one otherwise. """
+	if checkpoint_path and path.exists(checkpoint_path):
+		with open(checkpoint_path) as checkpoint_file:
+			checkpoint = json.load(checkpoint_file)
+		if checkpoint.get("version") == LATEST_VERSION:
+			return checkpoint
+	return { "version": LATEST_VERSION, "after": None, "scanned": 0, "migrated": 0, "stale": 0, "done": False }
+
+
+def write_checkpoint(checkpoint_path: str, checkpoint: dict):
+	if not checkpoint_path:
+		return
+	temporary_path = f"{checkpoint_path}.tmp"
+	with open(temporary_path, "w") as checkpoint_file:
+		json.dump(checkpoint, checkpoint_file)
+	replace(temporary_path, checkpoint_path)
+
+
+def migrate(ops_per_second: float = 200, chunk_size: int = 100, checkpoint_path: str = MIGRATION_CHECKPOINT,
+		stop: Event = None, report=print) -> dict:
+	""" Upgrades every account below the latest version, every document read or written counts against the budget. """
+	from arango.exceptions import AQLQueryExecuteError
+	database = get_database()
+	checkpoint = read_checkpoint(checkpoint_path)
+	total = database.collection("accounts").count()
+	started, spent = monotonic(), 0
+
+	while not checkpoint["done"] and not (stop is not None and stop.is_set()):
+		for attempt in range(CHUNK_ATTEMPTS):
+			chunk = next(iter(database.aql.execute(BULK_CHUNK_QUERY, bind_vars={
+				"after": checkpoint["after"], "chunk_size": chunk_size, "initial": INITIAL_VERSION, "latest": LATEST_VERSION })))
+			items = [(document["_key"], document["_rev"], changed_fields(document, upgrade(document))) for document in chunk["pending"]]
+			try:
+				written = write_upgrades(items)
+			except AQLQueryExecuteError as error:
+				if error.error_code != CONFLICT_ERROR:
+					raise
+				written = 0
+			spent += chunk["scanned"] + written
+			# Accounts written by a request since the chunk was read are read again, the last attempt leaves them to on-read upgrades.
+			if written == len(items) or attempt == CHUNK_ATTEMPTS - 1:
+				break
+
+		if chunk["scanned"] == 0:
+			checkpoint["done"] = True
+		else:
+			checkpoint["after"] = chunk["last"]
+			checkpoint["scanned"] += chunk["scanned"]
+			checkpoint["migrated"] += written
+			checkpoint["stale"] += len(items) - written
+		write_checkpoint(checkpoint_path, checkpoint)
+
+		elapsed = monotonic() - started
+		if report is not None:
+			rate = checkpoint["scanned"] / elapsed if elapsed > 0 else 0.0
+			report("MIGRATED ACCOUNTS:", { **checkpoint, "total": total,
+				"progress": round(min(checkpoint["scanned"] / total, 1.0) * 100, 1) if total else 100.0,
+				"eta_seconds": round((total - checkpoint["scanned"]) / rate) if rate > 0 and total > checkpoint["scanned"] else 0 })
+
+		# Paced so the documents read and written stay within ops_per_second.
+		ahead = spent / ops_per_second - (monotonic() - started)
+		if ahead > 0:
+			if stop is not None:
+				stop.wait(ahead)
+			else:
+				sleep(ahead)
+
+	return checkpoint
+
+
+if __name__ == "__main__":
+	if len(argv) > 1 and argv[1] == "migrate":
+		load_environment()
+		ops_per_second = float(argv[2]) if len(argv) > 2 else 200
+		chunk_size = int(argv[3]) if len(argv) > 3 else 100
+		print(migrate(ops_per_second=ops_per_second, chunk_size=chunk_size))
+	elif len(argv) > 1 and argv[1] == "status":
+		print(read_checkpoint(MIGRATION_CHECKPOINT))
+	else:
+		print("Usage: python migrations.py migrate [ops_per_second] [chunk_size] | status")
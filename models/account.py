@@ -1,98 +1,124 @@
-from passlib.hash import pbkdf2_sha256
-from libgravatar import Gravatar
-from os import environ
-from requests import get
 from models.data import Data
+from models.projection import Projection
+from models.response import dumps
+from hashing import password_hasher
+from avatars import fallback_avatar_url
+from migrations import LATEST_VERSION, upgrade_on_read
 
+""" Every field an account document carries. """
+ACCOUNT_FIELDS = (
+	"time_created", "last_modified", "display_name", "email_address", "username", "password",
+	"eggs", "eggs_funded", "eggs_archived", "eggs_bookmarked",
+	"home_city", "nationality", "gender", "age", "occupation", "interests", "external_links",
+	"comments", "recent_searches", "followers_count", "follows_count", "previous_usernames",
+	"payment_tokens", "transactions", "unread_notifications", "preferences",
+	"_schema_version_")
+
+""" Counters kept by the service, new accounts start them from the defaults whatever the request sends. """
+COUNTER_FIELDS = ("followers_count", "follows_count", "unread_notifications")
+
+""" Fields the database assigns, never taken from a signup or an imported row. """
+SYSTEM_FIELDS = ("_id", "_key", "_rev")
+
+""" Fields only some records carry. """
+OPTIONAL_FIELDS = ("_id", "profile_image")
+
+""" Fields hidden from each view of an account. """
+HIDDEN_FIELDS = {
+	# What anyone can see on a profile.
+	"public": (
+		"password", "unread_notifications", "preferences", "payment_tokens",
+		"transactions", "previous_usernames", "recent_searches", "interests", "eggs_archived"),
+	# What the authenticated owner gets back.
+	"owner": ("password", "payment_tokens"),
+	# What gets written to the database.
+	"internal": (),
+}
+
+""" Values used for fields a document does not carry, shared and never mutated. """
+ACCOUNT_DEFAULTS = {
+	# Information that deals with funding and eggs related
+	"eggs": (), "eggs_funded": (), "eggs_archived": (), "eggs_bookmarked": (),
+
+	# Information related to biography
+	"home_city": "", "nationality": "", "gender": 0, "age": 0, "occupation": "",
+	"interests": ("inspiring",), "external_links": (),
+
+	# Profile information
+	"comments": (), "recent_searches": (), "followers_count": 0, "follows_count": 0, "previous_usernames": (),
+
+	# Sensative information that should be hidden from public
+	"payment_tokens": (), "transactions": (), "unread_notifications": 0,
+	"preferences": { "2fa_authentication": False, "is_expire_login": True },
+
+	"_schema_version_": 2022.01,
+}
+
+PROJECTIONS = {
+	view: Projection(
+		fields=[field for field in ACCOUNT_FIELDS if field not in hidden],
+		defaults=ACCOUNT_DEFAULTS,
+		optional=[field for field in OPTIONAL_FIELDS if field not in hidden])
+	for view, hidden in HIDDEN_FIELDS.items() }
+
+
+""" Account over a raw document, fields are read on access and defaults are never copied in. """
 class AccountModel(Data):
-	def __init__(self, params):
-		super().__init__()
-		self.display_name = params.get("display_name")
-		self.email_address = params.get("email_address")
+	__slots__ = ("_document",)
 
-		# Save the password as a hashed version
+	def __init__(self, params, password_hash=None):
 		if params.get("_id") is None:
+			# New accounts get a document of their own with timestamps and a hashed password.
+			object.__setattr__(self, "_document", {
+				field: params[field] for field in ACCOUNT_FIELDS if params.get(field) is not None and field not in COUNTER_FIELDS })
+			super().__init__()
+			for field in COUNTER_FIELDS:
+				self._document[field] = ACCOUNT_DEFAULTS[field]
 			self.username = self.email_address.split("@")[0]
-			self.password = pbkdf2_sha256.hash(params.get("password"))
+			self.password = password_hash or password_hasher.hash(params.get("password"))
+			self._schema_version_ = LATEST_VERSION
+			if params.get("previous_usernames") is None:
+				self.previous_usernames = [self.username]
 
 			# Profile avatar
 			self.set_profile_avatar()
 		else:
-			self._id = params.get("_id")
-			self.password = params.get("password")
-			self.username = params.get("username")
-
-		# Information that deals with funding and eggs related
-		self.eggs = [] if params.get("eggs") is None else params.get("eggs")
-		self.eggs_funded = [] if params.get("eggs_funded") is None else params.get("eggs_funded")
-		self.eggs_archived = [] if params.get("eggs_archived") is None else params.get("eggs_archived")
-		self.eggs_bookmarked = [] if params.get("eggs_bookmarked") is None else params.get("eggs_bookmarked")
-
-		# Information related to biography
-		self.home_city = "" if params.get("home_city") is None else params.get("home_city")
-		self.nationality = "" if params.get("nationality") is None else params.get("nationality")
-		self.gender = 0 if params.get("gender") is None else params.get("gender")
-		self.age = 0 if params.get("age") is None else params.get("age")
-		self.occupation = "" if params.get("occupation") is None else params.get("occupation")
-		self.interests = ["inspiring"] if params.get("interests") is None else params.get("interests")
-		self.external_links = [] if params.get("external_links") is None else params.get("external_links")
-
-		# Profile information
-		self.comments = [] if params.get("comments") is None else params.get("comments")
-		self.recent_searches = [] if params.get("recent_searches") is None else params.get("recent_searches")
-		self.followers = [] if params.get("followers") is None else params.get("followers")
-		self.follows = [] if params.get("follows") is None else params.get("follows")
-		self.previous_usernames = [self.username] if params.get("previous_usernames") is None else params.get("previous_usernames")
-
-		# Sensative information that should be hidden from public
-		self.payment_tokens = []  if params.get("payment_tokens") is None else params.get("payment_tokens")
-		self.transactions = [] if params.get("transactions") is None else params.get("transactions")
-		
-		self.verification_codes = [] if params.get("verification_codes") is None else params.get("verification_codes")
-		self.notifications = [] if params.get("notifications") is None else params.get("notifications")
-		self.preferences = {
-			"2fa_authentication": False,
-			"is_expire_login": True
-		} if params.get("preferences") is None else params.get("preferences")
-
-		self._schema_version_ = 2022.01 if params.get("_schema_version_") is None else params.get("_schema_version_")
+			# Existing records are wrapped as they are, full documents of an older schema are upgraded first.
+			object.__setattr__(self, "_document", upgrade_on_read(params))
+
+	def __getattr__(self, name):
+		document = object.__getattribute__(self, "_document")
+		if name in document:
+			return document[name]
+		if name in ACCOUNT_DEFAULTS:
+			# Mutable defaults are materialized on first access so changes stick to this record.
+			default = ACCOUNT_DEFAULTS[name]
+			if isinstance(default, (tuple, dict)):
+				default = list(default) if isinstance(default, tuple) else dict(default)
+				document[name] = default
+			return default
+		if name in ACCOUNT_FIELDS or name in OPTIONAL_FIELDS:
+			return None
+		raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		self._document[name] = value
 
 	def set_profile_avatar(self):
-		# Determine a profile picture to use
-		# Check if user registered for Gravatar
-		gravatar = Gravatar(self.email_address)
-		gravatar_profile = gravatar.get_profile()
-		gravatar_profile_status_code = get(gravatar_profile).status_code
-		if gravatar_profile_status_code == 404:
-			# Generate a random abstract profile picture
-			self.profile_image = f"https://avatars.dicebear.com/api/pixel-art-neutral/{self.username}.svg"
-		else:
-			# Use Gravatar image
-			self.profile_image = gravatar.get_image()
-			
+		# Start with a random abstract profile picture, the avatar resolver
+		# swaps in the Gravatar image later if the user registered for one.
+		self.profile_image = fallback_avatar_url(self.username)
+
+	def to_json(self) -> str:
+		return dumps(self.to_dict()).decode("utf-8")
+
+	def to_dict(self) -> dict:
+		return PROJECTIONS["internal"](self._document)
+
 	def sanitize(self) -> dict:
 		""" Sensative information """
-		copy = {**self.to_dict()}
-
-		del copy["password"]
-		del copy["verification_codes"]
-		del copy["notifications"]
-		del copy["preferences"]
-		del copy["payment_tokens"]
-		del copy["transactions"]
-		del copy["previous_usernames"]
-		del copy["recent_searches"]
-		del copy["interests"]
-		del copy["eggs_archived"]
-		
-		return copy
+		return PROJECTIONS["public"](self._document)
 
 	def sanitize_soft(self) -> dict:
 		""" Sensative information """
-		copy = {**self.to_dict()}
-
-		del copy["password"]
-		del copy["verification_codes"]
-		del copy["payment_tokens"]
-
-		return copy
\ No newline at end of file
+		return PROJECTIONS["owner"](self._document)
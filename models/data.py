@@ -5,6 +5,9 @@ import json
 from models.time_created import TimeCreatedModel
 
 class Data:
+    # Subclasses may declare __slots__ of their own, the others keep a __dict__.
+    __slots__ = ()
+
     def __init__(self):
         self.time_created = TimeCreatedModel().__dict__
         self.last_modified = TimeCreatedModel().__dict__
@@ -0,0 +1,35 @@
+""" Compiles a field selection into a function that builds the output dict directly. """
+class Projection():
+    def __init__(self, fields, defaults=None, optional=()):
+        self.fields = tuple(fields)
+        self.defaults = {} if defaults is None else dict(defaults)
+        self.optional = tuple(field for field in optional if field not in self.fields)
+        self.project = self._compile()
+
+    @property
+    def keys(self) -> tuple:
+        """ Every field the projection can output. """
+        return self.fields + self.optional
+
+    def _compile(self):
+        # Required fields fall back to their default, optional ones are only copied when present.
+        namespace = {}
+        items = []
+        for index, field in enumerate(self.fields):
+            if field in self.defaults:
+                namespace[f"default_{index}"] = self.defaults[field]
+                items.append(f"{field!r}: get({field!r}, default_{index})")
+            else:
+                items.append(f"{field!r}: get({field!r})")
+
+        lines = ["def project(source):", "    get = source.get"]
+        lines.append("    result = {" + ", ".join(items) + "}")
+        for field in self.optional:
+            lines.append(f"    if {field!r} in source: result[{field!r}] = source[{field!r}]")
+        lines.append("    return result")
+
+        exec("\n".join(lines), namespace)
+        return namespace["project"]
+
+    def __call__(self, source: dict) -> dict:
+        return self.project(source)
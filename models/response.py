@@ -1,6 +1,20 @@
 import json
 from flask import make_response
 from models.http_codes import http_codes
+from metrics import span
+
+# orjson is optional, the standard library encoder is used when it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    with span('serialization'):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 
 class Response():
@@ -25,8 +39,17 @@ class Response():
         except KeyError as error:
             print('Invalid status code')
 
-    def to_json(self):
-        response = make_response(json.dumps(
-            self.__dict__), int(self.status_code))
-        response.headers['Content-Type'] = 'application/json'
-        return response
+    def serialize(self) -> bytes:
+        return dumps(self.__dict__)
+
+    def to_json(self, headers=None):
+        return json_response(self.serialize(), int(self.status_code), headers)
+
+
+def json_response(body: bytes, status_code: int, headers=None):
+    """ Builds the flask response for an already serialized body. """
+    response = make_response(body, status_code)
+    response.headers['Content-Type'] = 'application/json'
+    if headers != None:
+        response.headers.extend(headers)
+    return response
@@ -6,13 +6,21 @@ from models.data import Data
 
 """ Class for generating Authentication codes. """
 class VerificationCodeModel(Data):
-    def __init__(self, old_code = None):
+    def __init__(self, old_code = None, account = None, lifetime = timedelta(hours=1)):
         if old_code and old_code["code"]:
             self.code = old_code["code"]
             self.time_created = old_code["time_created"]
+            self.account = old_code.get("account")
+            self.expire_at = old_code.get("expire_at")
         else:
             self.code = nanoid.generate("0123456789", size=5)
             self.time_created = TimeCreatedModel().__dict__
+            self.account = account
+            # read by the TTL index of the verification_codes collection
+            self.expire_at = self.time_created["timestamp"] + lifetime.total_seconds()
+
+    def is_expired(self) -> bool:
+        return self.expire_at is not None and self.expire_at <= datetime.now().timestamp()
 
     def verify(self, from_code: str) -> bool:
-        return self.code == from_code
\ No newline at end of file
+        return self.code == from_code and not self.is_expired()
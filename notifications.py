@@ -0,0 +1,183 @@
+"""
+_________________________________
+NOTIFICATIONS
+Notifications live in the "notifications" collection, indexed by
+(account, timestamp), accounts only carry the unread_notifications counter.
+_________________________________
+"""
+from sys import argv
+from time import time
+
+from database import get_database, load_environment, first_retrying_conflicts
+from follows import encode_cursor, decode_cursor
+from cache import profile_cache
+from models.time_created import TimeCreatedModel
+
+
+""" Fields returned for every notification in a listing. """
+NOTIFICATION_FIELDS = ["_key", "type", "data", "timestamp", "read"]
+
+NOTIFY_QUERY = """
+LET account = FIRST(FOR a IN accounts FILTER a.username == @username LIMIT 1 RETURN a)
+FILTER account != null
+LET inserted = (
+	INSERT { account: account._key, type: @type, data: @data, timestamp: @now, read: false } INTO notifications
+	RETURN NEW._key)
+UPDATE account WITH { unread_notifications: (account.unread_notifications || 0) + 1, last_modified: @modified } IN accounts
+RETURN inserted[0]
+"""
+
+""" Newest first, continuing after the (timestamp, _key) position of the cursor. """
+LISTING_QUERY = """
+LET account = FIRST(FOR a IN accounts FILTER a.username == @username LIMIT 1 RETURN a)
+FILTER account != null
+RETURN {
+	unread: account.unread_notifications || 0,
+	page: (
+		FOR n IN notifications
+			FILTER n.account == account._key
+			FILTER @after == null OR n.timestamp < @after[0] OR (n.timestamp == @after[0] AND n._key < @after[1])
+			SORT n.timestamp DESC, n._key DESC
+			LIMIT @limit
+			RETURN KEEP(n, @fields)) }
+"""
+
+""" Marks the given notifications, or every unread one when keys is null, and updates the counter in one query. """
+MARK_READ_QUERY = """
+LET account = FIRST(FOR a IN accounts FILTER a.username == @username LIMIT 1 RETURN a)
+FILTER account != null
+LET marked = (
+	FOR n IN notifications
+		FILTER n.account == account._key AND n.read == false
+		FILTER @keys == null OR n._key IN @keys
+		UPDATE n WITH { read: true } IN notifications
+		RETURN 1)
+UPDATE account WITH {
+	unread_notifications: MAX([(account.unread_notifications || 0) - LENGTH(marked), 0]),
+	last_modified: @modified } IN accounts
+RETURN { marked: LENGTH(marked), unread: NEW.unread_notifications }
+"""
+
+
+""" Stores a notification for the account and counts it as unread, returns its key or None for unknown accounts. """
+def notify(username: str, notification_type: str, data: dict = None):
+	key = first_retrying_conflicts(NOTIFY_QUERY, { "username": username, "type": notification_type, "data": data or {}, "now": time(),
+		"modified": TimeCreatedModel().__dict__ })
+	if key is not None:
+		# The counter write gave the account a new revision, the cached profile carries the old ETag.
+		profile_cache.delete(username)
+	return key
+
+
+""" Returns a page of notifications with the unread count, None for unknown accounts. """
+def list_notifications(username: str, limit: int = 50, cursor: str = None):
+	result = first_retrying_conflicts(LISTING_QUERY, {
+		"username": username, "after": decode_cursor(cursor) if cursor else None,
+		"limit": limit + 1, "fields": NOTIFICATION_FIELDS })
+	if result is None:
+		return None
+
+	page = result["page"]
+	next_cursor = encode_cursor([page[limit - 1]["timestamp"], page[limit - 1]["_key"]]) if len(page) > limit else None
+	return { "notifications": page[:limit], "unread": result["unread"], "cursor": next_cursor }
+
+
+""" Marks notifications read, every unread one when keys is None, returns { marked, unread } or None for unknown accounts. """
+def mark_read(username: str, keys: list = None):
+	result = first_retrying_conflicts(MARK_READ_QUERY, { "username": username, "keys": keys, "modified": TimeCreatedModel().__dict__ })
+	if result is not None:
+		profile_cache.delete(username)
+	return result
+
+
+REMOVE_ACCOUNT_QUERY = """
+FOR n IN notifications
+	FILTER n.account == @account
+	LIMIT @batch_size
+	REMOVE n IN notifications
+	RETURN 1
+"""
+
+
+""" Removes the notifications of a deleted account, returns how many there were. """
+def remove_account(account_key: str, batch_size: int = 1000) -> int:
+	removed = 0
+	while True:
+		count = len(list(get_database().aql.execute(REMOVE_ACCOUNT_QUERY, bind_vars={ "account": account_key, "batch_size": batch_size })))
+		if count == 0:
+			return removed
+		removed += count
+
+
+"""
+__________________________________
+MIGRATION
+Streams the legacy notifications arrays out of account documents in batches.
+__________________________________
+"""
+PENDING_ACCOUNTS_QUERY = """
+FOR a IN accounts
+	FILTER HAS(a, "notifications")
+	LIMIT @batch_size
+	RETURN { _key: a._key, notifications: IS_ARRAY(a.notifications) ? a.notifications : [] }
+"""
+
+CLEAR_ARRAYS_QUERY = """
+FOR item IN @accounts
+	LET account = DOCUMENT("accounts", item.key)
+	FILTER account != null
+	UPDATE account WITH {
+		notifications: null, unread_notifications: (account.unread_notifications || 0) + item.unread,
+		last_modified: @modified } IN accounts
+	OPTIONS { keepNull: false }
+"""
+
+
+def legacy_notification(account_key: str, index: int, item, now: float) -> dict:
+	""" Legacy entries were free-form, dicts keep their content as data, anything else becomes a message.
+	The key comes from the account and the position in its array, a batch inserted again after a crash adds nothing. """
+	key = f"legacy-{account_key}-{index}"
+	if isinstance(item, dict):
+		timestamp = item.get("timestamp") or (item.get("time_created") or {}).get("timestamp") or now
+		return {
+			"_key": key, "account": account_key, "type": item.get("type", "legacy"), "data": item,
+			"timestamp": timestamp, "read": bool(item.get("read", item.get("is_read", False))) }
+	return { "_key": key, "account": account_key, "type": "legacy", "data": { "message": item }, "timestamp": now, "read": False }
+
+
+def migrate_arrays(batch_size: int = 500) -> dict:
+	database = get_database()
+	notifications_collection = database.collection("notifications")
+	report = { "accounts": 0, "notifications": 0 }
+
+	while True:
+		pending = list(database.aql.execute(PENDING_ACCOUNTS_QUERY, bind_vars={ "batch_size": batch_size }))
+		if len(pending) == 0:
+			break
+
+		now = time()
+		documents = []
+		counters = []
+		for account in pending:
+			migrated = [legacy_notification(account["_key"], index, item, now) for index, item in enumerate(account["notifications"])]
+			documents += migrated
+			counters.append({ "key": account["_key"], "unread": sum(1 for notification in migrated if not notification["read"]) })
+
+		if len(documents):
+			# Notifications stored before a crash that kept the arrays from being cleared are left as they are.
+			notifications_collection.insert_many(documents, overwrite_mode="ignore", silent=True)
+		database.aql.execute(CLEAR_ARRAYS_QUERY, bind_vars={ "accounts": counters, "modified": TimeCreatedModel().__dict__ })
+		report["accounts"] += len(pending)
+		report["notifications"] += len(documents)
+		print("MIGRATED NOTIFICATIONS:", report)
+
+	return report
+
+
+if __name__ == "__main__":
+	if len(argv) > 1 and argv[1] == "migrate":
+		load_environment()
+		batch_size = int(argv[2]) if len(argv) > 2 else 500
+		print(migrate_arrays(batch_size=batch_size))
+	else:
+		print("Usage: python notifications.py migrate [batch_size]")
@@ -0,0 +1,158 @@
+"""
+_________________________________
+RATE LIMITING AND ADMISSION CONTROL
+Token buckets keyed by username and client address reject authentication
+bursts with a 429 before any database or hashing work, and an adaptive
+concurrency limit sheds authentication load while its p95 latency is too high.
+_________________________________
+"""
+from os import environ
+from math import ceil
+from time import monotonic
+from threading import Lock
+from functools import wraps
+from collections import OrderedDict, deque
+from flask import request
+
+from models.response import Response as ResponseModel
+
+
+""" Interface of bucket stores, a shared store can be swapped in later. """
+class RateLimitStore():
+	def take(self, key: str, capacity: float, refill_rate: float) -> float:
+		""" Takes one token, returns 0 when allowed or the seconds until a token is available. """
+		raise NotImplementedError
+
+
+""" In-process store split into shards so concurrent requests rarely wait on the same lock. """
+class ShardedMemoryStore(RateLimitStore):
+	def __init__(self, shards=16, max_keys_per_shard=10000):
+		self.max_keys_per_shard = max_keys_per_shard
+		self._shards = [(Lock(), OrderedDict()) for _ in range(shards)]
+
+	def take(self, key: str, capacity: float, refill_rate: float) -> float:
+		lock, buckets = self._shards[hash(key) % len(self._shards)]
+		now = monotonic()
+		with lock:
+			tokens, updated_at = buckets.get(key, (capacity, now))
+			tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+			if tokens >= 1:
+				buckets[key] = (tokens - 1, now)
+				wait = 0.0
+			else:
+				buckets[key] = (tokens, now)
+				wait = (1 - tokens) / refill_rate
+			buckets.move_to_end(key)
+			# Least recently used keys are full buckets again by the time they are evicted.
+			while len(buckets) > self.max_keys_per_shard:
+				buckets.popitem(last=False)
+		return wait
+
+
+class TokenBucketLimiter():
+	def __init__(self, store: RateLimitStore, capacity: float, per_seconds: float):
+		self.store = store
+		self.capacity = capacity
+		self.refill_rate = capacity / per_seconds
+
+	def take(self, key: str) -> float:
+		return self.store.take(key, self.capacity, self.refill_rate)
+
+
+""" Admits requests while in-flight work stays under a limit that shrinks when p95 latency crosses the threshold. """
+class AdaptiveConcurrencyLimit():
+	def __init__(self, initial=8, minimum=1, maximum=64, latency_threshold=0.5, window=100):
+		self.limit = initial
+		self.minimum = minimum
+		self.maximum = maximum
+		self.latency_threshold = latency_threshold
+		self.window = window
+		self.in_flight = 0
+		self.shed = 0
+		self._latencies = deque(maxlen=window)
+		self._samples_since_adjustment = 0
+		self._lock = Lock()
+
+	def acquire(self) -> bool:
+		with self._lock:
+			if self.in_flight >= int(self.limit):
+				self.shed += 1
+				return False
+			self.in_flight += 1
+			return True
+
+	def release(self, latency: float):
+		with self._lock:
+			self.in_flight -= 1
+			self._latencies.append(latency)
+			self._samples_since_adjustment += 1
+			if self._samples_since_adjustment >= self.window // 4 and len(self._latencies) >= self.window // 4:
+				self._samples_since_adjustment = 0
+				self._adjust()
+
+	def p95(self) -> float:
+		latencies = sorted(self._latencies)
+		return latencies[int(len(latencies) * 0.95) - 1] if len(latencies) else 0.0
+
+	def _adjust(self):
+		# Multiplicative decrease while slow, additive increase while healthy.
+		if self.p95() > self.latency_threshold:
+			self.limit = max(self.minimum, self.limit * 0.9)
+		else:
+			self.limit = min(self.maximum, self.limit + 1)
+
+	def metrics(self) -> dict:
+		with self._lock:
+			return { "limit": int(self.limit), "in_flight": self.in_flight, "shed": self.shed, "p95": self.p95() }
+
+
+store = ShardedMemoryStore(shards=int(environ.get("RATE_LIMIT_SHARDS", 16)))
+
+username_limiter = TokenBucketLimiter(store,
+	capacity=float(environ.get("LOGIN_RATE_USERNAME_CAPACITY", 5)),
+	per_seconds=float(environ.get("LOGIN_RATE_USERNAME_PERIOD", 60)))
+
+address_limiter = TokenBucketLimiter(store,
+	capacity=float(environ.get("LOGIN_RATE_ADDRESS_CAPACITY", 20)),
+	per_seconds=float(environ.get("LOGIN_RATE_ADDRESS_PERIOD", 60)))
+
+authentication_concurrency = AdaptiveConcurrencyLimit(
+	initial=int(environ.get("AUTH_CONCURRENCY_INITIAL", 8)),
+	maximum=int(environ.get("AUTH_CONCURRENCY_MAX", 64)),
+	latency_threshold=float(environ.get("AUTH_LATENCY_P95_THRESHOLD", 0.5)))
+
+
+def client_address() -> str:
+	# Behind a proxy the first forwarded hop is the client.
+	if environ.get("TRUST_PROXY_HEADERS") == "true" and request.headers.get("X-Forwarded-For"):
+		return request.headers["X-Forwarded-For"].split(",")[0].strip()
+	return request.remote_addr or ""
+
+
+def too_many_requests(wait: float):
+	return ResponseModel(cd=429, msg="Too many authentication attempts, try again later.").to_json(
+		headers={"Retry-After": str(max(1, ceil(wait)))})
+
+
+""" Decorator for authentication routes, throttles before the route does any work. """
+def limit_authentication(fn):
+	@wraps(fn)
+	def decorator(*args, **kwargs):
+		wait = address_limiter.take(f"address:{client_address()}")
+		if wait == 0:
+			json = request.get_json(silent=True)
+			username = json.get("username") if isinstance(json, dict) else None
+			if isinstance(username, str) and username:
+				wait = username_limiter.take(f"username:{username.lower()}")
+		if wait > 0:
+			return too_many_requests(wait)
+
+		if not authentication_concurrency.acquire():
+			return ResponseModel(cd=503, msg="Too many requests right now, try again shortly.").to_json(
+				headers={"Retry-After": "1"})
+		started = monotonic()
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			authentication_concurrency.release(monotonic() - started)
+	return decorator
@@ -0,0 +1,217 @@
+"""
+_________________________________
+HETCH_ACCOUNTS (ASYNCIO)
+Serves the /accounts/* routes on an asyncio server:
+	uvicorn run_async:application --host 0.0.0.0 --port 4000
+Profile reads run natively on the async database client, every other route
+is handed to the Flask app on a bounded thread pool, so semantics stay identical.
+_________________________________
+"""
+import re
+import sys
+import asyncio
+from io import BytesIO
+from os import environ
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+
+from server import server_instance
+from cache import profile_cache
+from async_database import AsyncDatabase
+from models.account import AccountModel
+from models.response import Response as ResponseModel
+from errors import ServiceUnavailable
+from metrics import start_request, finish_request, current_request_id, logger
+
+
+""" Threads available to the routes served by the Flask app. """
+FLASK_THREADS = int(environ.get("ASYNC_FLASK_THREADS", 32))
+
+PROFILE_ROUTE = re.compile(r"^/accounts/(?P<username>[^/]+)/$")
+
+""" Route label of the native profile reads, the same as the Flask rule. """
+PROFILE_RULE = "/accounts/<username>/"
+
+""" Chunks of a streamed Flask response held while the client is slower than the app, exports stream through it. """
+STREAM_QUEUE_SIZE = 16
+
+""" Headers flask_cors adds to every response of the WSGI app. """
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+database = AsyncDatabase()
+flask_executor = ThreadPoolExecutor(max_workers=FLASK_THREADS, thread_name_prefix="flask")
+
+
+async def send_response(send, status_code: int, body: bytes, headers=()):
+	await send({
+		"type": "http.response.start",
+		"status": status_code,
+		"headers": [(b"content-type", b"application/json"), *CORS_HEADERS, *headers] })
+	await send({ "type": "http.response.body", "body": body })
+
+
+""" Native version of server.get_hetch_account. """
+async def get_hetch_account(username: str, request_headers: dict, send):
+	cached_profile = profile_cache.get(username)
+	if cached_profile is None:
+		hetch_account = await database.get_one_by("username", username)
+		if hetch_account is None:
+			return await send_response(send, 404, ResponseModel(cd=404, msg="Account not found.").serialize())
+		cached_profile = (f'"{hetch_account["_rev"]}"',
+			ResponseModel(cd=200, d=AccountModel(hetch_account).sanitize()).serialize())
+		profile_cache.set(username, cached_profile)
+
+	etag, body = cached_profile
+	etag_header = [(b"etag", etag.encode("latin-1"))]
+	if_none_match = request_headers.get("if-none-match")
+	if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+		return await send_response(send, 304, b"", etag_header)
+	return await send_response(send, 200, body, etag_header)
+
+
+""" Runs the Flask app for one request on the thread pool. """
+async def call_flask(scope, receive, send):
+	body = b""
+	while True:
+		message = await receive()
+		body += message.get("body", b"")
+		if not message.get("more_body"):
+			break
+
+	server_name, server_port = scope.get("server") or ("localhost", 80)
+	wsgi_environ = {
+		"REQUEST_METHOD": scope["method"],
+		"SCRIPT_NAME": scope.get("root_path", ""),
+		"PATH_INFO": scope["path"],
+		"QUERY_STRING": scope["query_string"].decode("latin-1"),
+		"SERVER_NAME": server_name,
+		"SERVER_PORT": str(server_port),
+		"SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+		"REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+		"CONTENT_LENGTH": str(len(body)),
+		"wsgi.version": (1, 0),
+		"wsgi.url_scheme": scope.get("scheme", "http"),
+		"wsgi.input": BytesIO(body),
+		"wsgi.errors": sys.stderr,
+		"wsgi.multithread": True,
+		"wsgi.multiprocess": True,
+		"wsgi.run_once": False }
+	for name, value in scope["headers"]:
+		name = name.decode("latin-1").upper().replace("-", "_")
+		value = value.decode("latin-1")
+		if name == "CONTENT_TYPE":
+			wsgi_environ["CONTENT_TYPE"] = value
+		elif name != "CONTENT_LENGTH":
+			key = f"HTTP_{name}"
+			wsgi_environ[key] = f"{wsgi_environ[key]},{value}" if key in wsgi_environ else value
+
+	started = {}
+	def start_response(status, headers, exc_info=None):
+		started["status"] = int(status.split(" ")[0])
+		started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+	# The response is iterated on one Flask thread and every chunk is sent as it comes, None ends it.
+	loop = asyncio.get_running_loop()
+	chunks = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+	abandoned = Event()
+
+	def put(chunk):
+		asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+	def run():
+		result = server_instance(wsgi_environ, start_response)
+		try:
+			for chunk in result:
+				if abandoned.is_set():
+					break
+				if chunk:
+					put(chunk)
+		finally:
+			try:
+				if hasattr(result, "close"):
+					result.close()
+			finally:
+				put(None)
+
+	async def start():
+		await send({ "type": "http.response.start", "status": started["status"], "headers": started["headers"] })
+
+	finished = loop.run_in_executor(flask_executor, run)
+	response_started = False
+	try:
+		while True:
+			chunk = await chunks.get()
+			if chunk is None:
+				break
+			if not response_started:
+				await start()
+				response_started = True
+			await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+	except BaseException:
+		# The client is gone, the Flask thread stops at its next chunk and ends the stream.
+		abandoned.set()
+		while await chunks.get() is not None:
+			pass
+		raise
+	await finished
+	if not response_started:
+		await start()
+	await send({ "type": "http.response.body", "body": b"" })
+
+
+async def lifespan(receive, send):
+	while True:
+		message = await receive()
+		if message["type"] == "lifespan.startup":
+			await send({ "type": "lifespan.startup.complete" })
+		elif message["type"] == "lifespan.shutdown":
+			await database.close()
+			flask_executor.shutdown(wait=False)
+			await send({ "type": "lifespan.shutdown.complete" })
+			return
+
+
+""" ASGI entry point. """
+async def application(scope, receive, send):
+	if scope["type"] == "lifespan":
+		return await lifespan(receive, send)
+
+	profile = PROFILE_ROUTE.match(scope["path"])
+	if scope["method"] == "GET" and profile is not None:
+		request_headers = { name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"] }
+		token = start_request(request_headers.get("x-request-id"))
+		status = {}
+
+		async def send_with_request_id(message):
+			if message["type"] == "http.response.start":
+				status["code"] = message["status"]
+				message["headers"] = [*message["headers"], (b"x-request-id", current_request_id().encode("latin-1"))]
+			await send(message)
+
+		try:
+			return await get_hetch_account(profile.group("username"), request_headers, send_with_request_id)
+		except asyncio.CancelledError:
+			# The client went away or the server is shutting down, nothing is left to answer.
+			raise
+		except ServiceUnavailable as error:
+			# The same answer as server.service_unavailable_response.
+			if "code" not in status:
+				await send_response(send_with_request_id, 503, ResponseModel(cd=503, msg=str(error)).serialize(),
+					[(b"retry-after", str(error.retry_after).encode("latin-1"))])
+			return
+		except Exception:
+			logger.exception("Request failed.")
+			# Once the response has started the client can only be left with what it got.
+			if "code" not in status:
+				await send_response(send_with_request_id, 500,
+					ResponseModel(cd=500, msg="Something went wrong. That's all we know.").serialize())
+			return
+		finally:
+			finish_request(token, PROFILE_RULE, "GET", status.get("code"))
+	return await call_flask(scope, receive, send)
+
+
+if __name__ == "__main__":
+	import uvicorn
+	uvicorn.run("run_async:application", host="0.0.0.0", port=int(environ.get("PORT", 4000)))
@@ -0,0 +1,76 @@
+"""
+_________________________________
+ACCOUNT SEARCH
+Prefix and fuzzy matching over username and display_name, served by the
+"accounts_search" ArangoSearch view declared in database.VIEWS.
+Prefix matches are boosted above trigram matches, results are ranked by BM25.
+_________________________________
+"""
+import json
+from os import environ
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from database import get_database, read_only
+
+
+""" Fields returned for every account in search results. """
+SEARCH_FIELDS = ["username", "display_name", "profile_image", "followers_count"]
+
+""" Ranked results can only be paged this deep. """
+SEARCH_MAX_RESULTS = int(environ.get("SEARCH_MAX_RESULTS", 500))
+
+""" Share of the query trigrams a field has to contain to match. """
+SEARCH_NGRAM_THRESHOLD = float(environ.get("SEARCH_NGRAM_THRESHOLD", 0.6))
+
+""" Queries shorter than a trigram can only match as prefixes. """
+TRIGRAM_LENGTH = 3
+
+PREFIX_SEARCH_QUERY = """
+LET prefix = TOKENS(@q, "account_norm")[0]
+FOR a IN accounts_search
+	SEARCH ANALYZER(STARTS_WITH(a.username, prefix) OR STARTS_WITH(a.display_name, prefix), "account_norm")
+	SORT BM25(a) DESC, a.username
+	LIMIT @offset, @limit
+	RETURN KEEP(a, @fields)
+"""
+
+SEARCH_QUERY = """
+LET prefix = TOKENS(@q, "account_norm")[0]
+FOR a IN accounts_search
+	SEARCH BOOST(ANALYZER(STARTS_WITH(a.username, prefix) OR STARTS_WITH(a.display_name, prefix), "account_norm"), 2)
+		OR NGRAM_MATCH(a.username, @q, @threshold, "account_trigram")
+		OR NGRAM_MATCH(a.display_name, @q, @threshold, "account_trigram")
+	SORT BM25(a) DESC, a.username
+	LIMIT @offset, @limit
+	RETURN KEEP(a, @fields)
+"""
+
+
+def encode_cursor(offset: int) -> str:
+	return urlsafe_b64encode(json.dumps([offset]).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor: str) -> int:
+	position = json.loads(urlsafe_b64decode(cursor.encode("utf-8")))
+	if not isinstance(position, list) or len(position) != 1 or not isinstance(position[0], int) or position[0] < 0:
+		raise ValueError("Invalid cursor.")
+	return position[0]
+
+
+""" Returns a page of ranked accounts and the cursor of the next page, None on the last one. """
+def search_accounts(q: str, limit: int = 20, cursor: str = None) -> dict:
+	offset = decode_cursor(cursor) if cursor else 0
+	limit = max(0, min(limit, SEARCH_MAX_RESULTS - offset))
+	if limit == 0:
+		return { "accounts": [], "cursor": None }
+
+	q = q.strip()
+	bind_vars = { "q": q, "offset": offset, "limit": limit + 1, "fields": SEARCH_FIELDS }
+	if len(q) >= TRIGRAM_LENGTH:
+		bind_vars["threshold"] = SEARCH_NGRAM_THRESHOLD
+	with read_only():
+		accounts = list(get_database().aql.execute(
+			SEARCH_QUERY if len(q) >= TRIGRAM_LENGTH else PREFIX_SEARCH_QUERY,
+			bind_vars=bind_vars, count=False))
+
+	has_more = len(accounts) > limit and offset + limit < SEARCH_MAX_RESULTS
+	return { "accounts": accounts[:limit], "cursor": encode_cursor(offset + limit) if has_more else None }
@@ -2,93 +2,119 @@
 _________________________________
 HETCH_ACCOUNTS
 Server description goes here
+create_app() builds the Flask app, importing this module never connects to
+the database: connections, pools and threads start per worker on first use,
+so workers forked from a preloaded master never share them.
 _________________________________
 """
-import urllib3
-import socket
-
-from flask import Flask, request, Response as FlaskResponse
-from flask_cors import CORS, cross_origin
 from os import environ
-from dotenv import load_dotenv
-from passlib.hash import pbkdf2_sha256
-from traceback import format_exc
+from flask import Flask, Blueprint, request, g, stream_with_context, Response as FlaskResponse
+from flask_cors import CORS, cross_origin
+
+"""
+__________________________________
+DEVELOPMENTAL ENVIRONMENT VARIABLES
+Loaded before the modules that read their settings at import time.
+__________________________________
+"""
+from database import load_environment
+load_environment()
+
 from utilities import (
 	parse_request,
 	validate_request,
-	authenticate_request,
-	generate_authentication_token )
-from jwt import PyJWT
-from arango import ArangoClient
+	require_authentication,
+	require_admin,
+	generate_authentication_token,
+	service_unavailable_response )
+from hashing import password_hasher
+from errors import ServiceUnavailable
+from database import (
+	LazyCollection,
+	get_database,
+	database_status,
+	get_one_by,
+	get_many_by,
+	update_one_by,
+	PreconditionFailed,
+	UNIQUE_CONSTRAINT_ERROR )
+from avatars import AvatarResolver
+from cache import profile_cache
+from idempotency import idempotent
+from keys import keyring, JWKS_MAX_AGE
+import follows
+import verification
+import exports
+import search
+import notifications
+import capture
+import migrations
+import jobs
+from ratelimit import limit_authentication, authentication_concurrency
+from metrics import instrument, register_collector, logger
 
+from models.response import Response as ResponseModel, json_response, dumps
+from models.time_created import TimeCreatedModel
+from models.account import AccountModel, HIDDEN_FIELDS, PROJECTIONS, COUNTER_FIELDS, SYSTEM_FIELDS
 
-""" Temporarily disable any warnings """
-urllib3.disable_warnings()
 
-""" Refactor PyJWT methods """
-jwt = PyJWT()
+""" Every /accounts/* route, registered on the app by create_app. """
+accounts_blueprint = Blueprint("accounts", __name__)
 
-
-from models.response import Response as ResponseModel
-from models.time_created import TimeCreatedModel
-from models.account import AccountModel
-from models.verification_code import VerificationCodeModel
+""" Saturated or unhealthy dependencies answer with a 503 wherever they are raised. """
+@accounts_blueprint.app_errorhandler(ServiceUnavailable)
+def handle_service_unavailable(error: ServiceUnavailable) -> FlaskResponse:
+	return service_unavailable_response(error)
 
 """
 __________________________________
-DEVELOPMENTAL ENVIRONMENT VARIABLES
+DATABASE CONNECTION
 __________________________________
 """
-if environ.get("environment") != "production":
-	load_dotenv()
+""" Connections are made per worker on first use, see database.get_database. """
+accounts = LazyCollection("accounts")
 
+""" Patches the profile image once the Gravatar lookup finishes. """
+def update_profile_image(account_key: str, image_url: str):
+	account = accounts.update({ "_key": account_key, "profile_image": image_url,
+		"last_modified": TimeCreatedModel().__dict__ }, return_new=True)
+	profile_cache.delete(account["new"]["username"])
 
-"""
-__________________________________
-SERVER INSTANCE SETUP
-__________________________________
-"""
-server_instance = Flask(__name__,
-			static_folder="./assets/",
-            static_url_path="/accounts/assets/") 
-CORS(server_instance, resources={r"*": {"origins": "*"}})
+avatar_resolver = AvatarResolver()
+
+""" Looks up the Gravatar of new accounts, upstream failures keep the fallback avatar. """
+@jobs.handler("avatar", batch_size=10)
+def resolve_avatars(payloads: list) -> list:
+	errors = []
+	for payload in payloads:
+		try:
+			image_url = avatar_resolver.resolve(payload["email_address"])
+			if image_url is not None:
+				update_profile_image(payload["account_key"], image_url)
+			errors.append(None)
+		except Exception as error:
+			errors.append(error)
+	return errors
+
+""" Removes what referenced a deleted account, every step can run again after a failure. """
+@jobs.handler("account_cleanup")
+def clean_up_accounts(payloads: list):
+	for payload in payloads:
+		follows.remove_account(f'accounts/{payload["account_key"]}')
+		notifications.remove_account(payload["account_key"])
+		verification.remove_account(payload["account_key"])
+
+""" Counters kept by the components, exported as gauges next to the request histograms. """
+def component_metrics() -> dict:
+	components = { "profile_cache": profile_cache.metrics(), "avatar_resolver": avatar_resolver.metrics(),
+		"authentication": authentication_concurrency.metrics(), "migration_write_back": migrations.write_back.metrics(),
+		"jobs": jobs.job_queue.metrics() }
+	return { f"hetch_{component}": (f"Counters of the {component.replace('_', ' ')}.", {
+			(("metric", metric),): value for metric, value in values.items() if isinstance(value, (int, float)) })
+		for component, values in components.items() }
+
+register_collector(component_metrics)
 
-"""
-__________________________________
-DATABASE CONNECTION
-__________________________________
-"""
-""" Database connection """
-db_connection_failed = False
-try:
-	# Note that ArangoDB Oasis runs deployments in a cluster configuration.
-    # To achieve the best possible availability, your client application has to handle
-    # connection failures by retrying operations if needed.
-    arango_client = ArangoClient(hosts=environ["ARANGO_URL"], verify_override=False)
-    arango_sys_db = arango_client.db(
-        name="_system",
-        username="root",
-        password=environ["ARANGO_PASSWORD"])
-
-    # Create the application database if it does not exist.
-    if not arango_sys_db.has_database(environ["DATABASE_NAME"]):
-        arango_sys_db.create_database(environ["DATABASE_NAME"])
-        arango_sys_db.update_permission(username='root', permission='rw', database=environ["DATABASE_NAME"])
-        database = arango_client.db(
-            environ["DATABASE_NAME"], username="root", password=environ["ARANGO_PASSWORD"])
-    else:
-        database = arango_client.db(
-            environ["DATABASE_NAME"], username="root", password=environ["ARANGO_PASSWORD"])
-    
-    # """ Create the required collection """
-    if not database.has_collection("accounts"):
-        accounts = database.create_collection("accounts")
-    else:
-        accounts = database.collection("accounts")
-except:
-    print("SOMETHING WENT WRONG WITH DB CONNECTION:", format_exc())
-    db_connection_failed = True
-	
 """
 __________________________________
 SERVER INSTANCE ROUTES
@@ -96,181 +122,475 @@ __________________________________
 """
 
 """ Returns status of the server. """
-@server_instance.route("/accounts/status", methods=["GET"])
+@accounts_blueprint.route("/accounts/status", methods=["GET"])
 @cross_origin()
 def status() -> FlaskResponse:
-	status = not db_connection_failed
+	try:
+		get_database()
+		status = database_status()["circuit_breaker"] != "open"
+	except ServiceUnavailable:
+		status = False
 	return ResponseModel(cd=200 if status == True else 500,
 					msg="Running." if status == True else "Something's not right.",
-					d={**environ}).to_json()
+					d={**environ, "database": database_status(), "avatar_resolver": avatar_resolver.metrics(), "profile_cache": profile_cache.metrics(), "authentication": authentication_concurrency.metrics()}).to_json()
 
 
-""" Creating a new hetch account. """
-@server_instance.route("/accounts/", methods=["POST"])
+""" Creating a new hetch account, retries carrying the same Idempotency-Key replay the first response. """
+@accounts_blueprint.route("/accounts/", methods=["POST"])
 @cross_origin()
 @parse_request
+@idempotent
 def create_new_hetch_account() -> FlaskResponse:
+	from arango.exceptions import DocumentInsertError
 	try:
 		json = request.json
 		schema = { "email_address": str, "display_name": str, "password": str }
 		v_errors = validate_request(d=json, schema=schema)
 		if len(v_errors) == 0:
-			hetch_account = AccountModel(params=json)
-			existing_account = accounts.find({"email_address": hetch_account.email_address})
-			if len(existing_account) == 0:
-				accounts.insert(hetch_account.to_dict())
-				return ResponseModel(cd=200, d=hetch_account.sanitize()).to_json()
-			else:
-				return ResponseModel(cd=208, msg=f'An account with email address "{hetch_account.email_address}" already exists.').to_json()
+			hetch_account = AccountModel(params={ field: value for field, value in json.items() if field not in SYSTEM_FIELDS })
+			try:
+				# The unique indexes on email_address and username reject duplicates, no lookup beforehand.
+				insert_result = accounts.insert(hetch_account.to_dict())
+			except DocumentInsertError as error:
+				if error.error_code != UNIQUE_CONSTRAINT_ERROR:
+					raise
+				# Usernames come from the address, a taken address usually trips the username index first.
+				if "email_address" in (error.error_message or "") or get_one_by(
+						"email_address", hetch_account.email_address, keep=["_key"]) is not None:
+					return ResponseModel(cd=208, msg=f'An account with email address "{hetch_account.email_address}" already exists.').to_json()
+				return ResponseModel(cd=208, msg=f'An account with username "{hetch_account.username}" already exists.').to_json()
+			jobs.enqueue_after_write("avatar", { "account_key": insert_result["_key"], "email_address": hetch_account.email_address })
+			return ResponseModel(cd=200, d=hetch_account.sanitize()).to_json()
 		else:
 			return ResponseModel(cd=400, d={"errors": v_errors}).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
 	except:
-		print(format_exc())
+		logger.exception("Request failed.")
 		return ResponseModel(cd=500).to_json()
 
 
 """Retrieving hetch account from record."""
-@server_instance.route("/accounts/<username>/", methods=["GET"])
+@accounts_blueprint.route("/accounts/<username>/", methods=["GET"])
 def get_hetch_account(username: str) -> str:
-	hetch_accounts_cursor = accounts.find({"username": username})
-	if len(hetch_accounts_cursor) != 0:
-		for hetch_account in hetch_accounts_cursor:
-			hetch_account = AccountModel(hetch_account)
-			return ResponseModel(cd=200, d=hetch_account.sanitize()).to_json()
-	return ResponseModel(cd=404, msg="Account not found.").to_json()
+	""" Serve from the profile cache, only misses touch the database. """
+	cached_profile = profile_cache.get(username)
+	if cached_profile is None:
+		hetch_account = get_one_by("username", username)
+		if hetch_account is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		cached_profile = (f'"{hetch_account["_rev"]}"',
+			ResponseModel(cd=200, d=AccountModel(hetch_account).sanitize()).serialize())
+		profile_cache.set(username, cached_profile)
+
+	etag, body = cached_profile
+	if_none_match = request.headers.get("If-None-Match")
+	if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+		return json_response("", 304, headers={"ETag": etag})
+	return json_response(body, 200, headers={"ETag": etag})
+
+
+""" Prefix and fuzzy search over usernames and display names, ranked and paginated. """
+@accounts_blueprint.route("/accounts/search", methods=["GET"])
+def search_hetch_accounts() -> FlaskResponse:
+	try:
+		q = request.args.get("q", default="")
+		if not q.strip() or len(q) > 64:
+			return ResponseModel(cd=400, msg="\"q\" has to be between 1 and 64 characters.").to_json()
+		limit = request.args.get("limit", default=20, type=int)
+		if limit < 1 or limit > 50:
+			return ResponseModel(cd=400, msg="\"limit\" has to be between 1 and 50.").to_json()
+		try:
+			page = search.search_accounts(q, limit=limit, cursor=request.args.get("cursor"))
+		except ValueError:
+			return ResponseModel(cd=400, msg="Invalid cursor provided.").to_json()
+		return ResponseModel(cd=200, d=page).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Most usernames a single batch lookup may ask for. """
+BATCH_MAX_USERNAMES = int(environ.get("BATCH_MAX_USERNAMES", 200))
+
+
+""" Retrieving many hetch accounts at once, in request order. """
+@accounts_blueprint.route("/accounts/batch", methods=["POST"])
+@parse_request
+def get_hetch_accounts_batch() -> FlaskResponse:
+	try:
+		usernames = request.json.get("usernames") if isinstance(request.json, dict) else None
+		if not isinstance(usernames, list) or not all(isinstance(username, str) for username in usernames):
+			return ResponseModel(cd=400, msg="\"usernames\" has to be a list of usernames.").to_json()
+		if len(usernames) == 0 or len(usernames) > BATCH_MAX_USERNAMES:
+			return ResponseModel(cd=400, msg=f"Between 1 and {BATCH_MAX_USERNAMES} usernames can be requested at once.").to_json()
+
+		hetch_accounts = get_many_by("username", usernames, keep=list(PROJECTIONS["public"].keys))
+		return ResponseModel(cd=200, d={ "accounts": [
+			AccountModel(hetch_account).sanitize() if hetch_account is not None else None
+			for hetch_account in hetch_accounts ] }).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
 
 
 """ Requesting an authentication of account user. """
-@server_instance.route("/accounts/authentication", methods=["GET"])
+@accounts_blueprint.route("/accounts/authentication", methods=["GET"])
+@limit_authentication
 def request_authentication() -> FlaskResponse:
 	try:
 		r_type = request.headers.get("Content-Type")
 		if r_type == "application/json":
 			json = request.json
 			if json.get("username") and json.get("password"):
-				hetch_accounts_cursor = accounts.find({ "username": json.get("username") })
+				hetch_account = get_one_by("username", json.get("username"))
 
 				""" Confirm the account. """
-				if len(hetch_accounts_cursor) != 0:
-					for hetch_account in hetch_accounts_cursor:
-						""" Modelize the hetch_account """
-						hetch_account_model = AccountModel(hetch_account)
-						
-						""" Defines if the login should persist forever for subsequent logins. """
-						is_persist = False if json.get("is_persist") is None else json.get("is_persist")
-						
-						""" Use PassLib to compare the login password with the signup password. """
-						if pbkdf2_sha256.verify(json.get("password"), hetch_account_model.password):
-							""" Verify if the user uses Two Factor Autentication. """
-							if hetch_account_model.preferences.get("2fa_authentication"):
-								# TODO: PRODUCE AN EXPIRING VERIFICATION CODE
-								verification_code = VerificationCodeModel()
-								verification_message = f"Your Hetchfund.Capital code is {verification_code.code}. Keep it safe and don't share it, expires in an hour."
-								# TODO: SEND AN EMAIL TO THE USER TO VERIFY THEIR LOGIN
-								print(verification_message)
-
-								""" Save the verification code in record. """
-								hetch_account["verification_codes"].append(verification_code.to_dict())
-								accounts.update(hetch_account)
-
-								return ResponseModel(cd=201, msg="Two-Factor Authentication required to continue.").to_json()
-							else:							
-								""" Return the generated token with account data. """
-								return ResponseModel(cd=200, d={ **hetch_account_model.sanitize_soft(), "jwt": generate_authentication_token(hetch_account_model.email_address) }).to_json()
-						else:
-							return ResponseModel(cd=403, msg="Incorrect password provided.").to_json()
+				if hetch_account is not None:
+					""" Modelize the hetch_account """
+					hetch_account_model = AccountModel(hetch_account)
+					
+					""" Defines if the login should persist forever for subsequent logins. """
+					is_persist = False if json.get("is_persist") is None else json.get("is_persist")
+					
+					""" Use PassLib to compare the login password with the signup password. """
+					is_valid, new_password_hash = password_hasher.verify(json.get("password"), hetch_account_model.password)
+					if is_valid:
+						""" Upgrade hashes created with outdated parameters. """
+						if new_password_hash is not None:
+							accounts.update({ "_key": hetch_account["_key"], "password": new_password_hash,
+								"last_modified": TimeCreatedModel().__dict__ })
+
+						""" Verify if the user uses Two Factor Autentication. """
+						if hetch_account_model.preferences.get("2fa_authentication"):
+							""" Save an expiring verification code in record. """
+							verification_code = verification.issue(hetch_account["_key"])
+							verification.send_code(hetch_account_model.email_address, verification_code)
+
+							return ResponseModel(cd=201, msg="Two-Factor Authentication required to continue.").to_json()
+						else:							
+							""" Return the generated token with account data. """
+							return ResponseModel(cd=200, d={ **hetch_account_model.sanitize_soft(), "jwt": generate_authentication_token(hetch_account_model.email_address) }).to_json()
+					else:
+						return ResponseModel(cd=403, msg="Incorrect password provided.").to_json()
 				else:
 					return ResponseModel(cd=404, msg="Account not found.").to_json()
 			else:
 				return ResponseModel(cd=400, msg="Incomplete request. \"username\" and \"password\" field can not be empty.").to_json()
 		else:
 			return ResponseModel(cd=400, msg="Invalid request. Request has to be made with JSON data as the body.").to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
 	except:
-		print(format_exc())
+		logger.exception("Request failed.")
 		return ResponseModel(cd=500, msg="Oops something might have went wrong.").to_json()
 		
 
+""" Completing a Two-Factor Authentication login with the emailed code. """
+@accounts_blueprint.route("/accounts/authentication/verify", methods=["POST"])
+@limit_authentication
+@parse_request
+def verify_authentication() -> FlaskResponse:
+	try:
+		json = request.json
+		v_errors = validate_request(d=json, schema={ "username": str, "code": str })
+		if len(v_errors) != 0:
+			return ResponseModel(cd=400, d={"errors": v_errors}).to_json()
+
+		hetch_account = get_one_by("username", json.get("username"))
+		if hetch_account is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+
+		if not verification.consume(hetch_account["_key"], json.get("code")):
+			return ResponseModel(cd=403, msg="Invalid or expired verification code.").to_json()
+
+		hetch_account_model = AccountModel(hetch_account)
+		return ResponseModel(cd=200, d={ **hetch_account_model.sanitize_soft(), "jwt": generate_authentication_token(hetch_account_model.email_address) }).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Oops something might have went wrong.").to_json()
+
+
 """ Re-authenticates an authentication session to check it's expiry time """
-@server_instance.route("/accounts/authentication/re", methods=["GET"])
+@accounts_blueprint.route("/accounts/authentication/re", methods=["GET"])
+@require_authentication
 def re_authenticate_session() -> FlaskResponse:
-	""" Extract and verify authentication token from the request data """
-	previous_authorization = request.headers.get("Authorization")
-	if previous_authorization and "Bearer " in previous_authorization:
-		authorzation_data = previous_authorization.split(" ")[1]
-		try:
-			authorzation_data_decoded = jwt.decode(authorzation_data, environ["SEED"],
-				options={"verify_exp": True},
-				algorithms=["HS256"])
-			return ResponseModel(cd=200, d={ "p+a": previous_authorization, "p+d": authorzation_data_decoded}).to_json()
-		except jwt.exceptions.ExpiredSignatureError:
-			return ResponseModel(cd=403, d={ "p+a": previous_authorization }, msg="Signature has expired.").to_json()
-		except:
-			return ResponseModel(cd=403, d={ "p+a": previous_authorization }, msg="Invalid signature provided.").to_json()
-	else:
-		return ResponseModel(cd=403, d={ "p+a": previous_authorization }, msg="Invalid or no signature provided.").to_json()
+	return ResponseModel(cd=200, d={ "p+a": request.headers.get("Authorization"), "p+d": g.authentication }).to_json()
+
+
+""" Public keys tokens are signed with, so other services verify them without calling this one. """
+@accounts_blueprint.route("/accounts/.well-known/jwks.json", methods=["GET"])
+@cross_origin()
+def json_web_key_set() -> FlaskResponse:
+	return json_response(dumps(keyring.jwks()), 200, headers={"Cache-Control": f"public, max-age={JWKS_MAX_AGE}"})
+
+
+""" Fields an account owner can not change through PATCH. """
+DISALLOWED_FIELDS = frozenset((
+	"password", "verification_codes", "payment_tokens",
+	"username", "eggs", "eggs_funded", "eggs_archived",
+	"eggs_bookmarked", "interests", "comments", "followers",
+	"follows", "previous_usernames", "transactions",
+	"notifications", "preferences", "_schema_version_", "_id", "_key", "_rev",
+	"time_created", "last_modified", "recent_searches", *COUNTER_FIELDS))
 
 
 """ Updating account records. """
-@server_instance.route("/accounts/<username>", methods=["PATCH"])
+@accounts_blueprint.route("/accounts/<username>", methods=["PATCH"])
+@require_authentication
 def update_account_records(username: str) -> FlaskResponse:
+	from arango.exceptions import AQLQueryExecuteError
 	try:
-		def update_account(auth_payload):
-			auth_username = auth_payload["email_address"].split("@")[0]
-			# check if the authenticated user is the one being updated
-			if username == auth_username:
-				# check if data contains unchangeble data if does, delete disallowed fields
-				fields = request.json
-				disallowed_fields = (
-					"password", "verification_codes", "payment_tokens",
-					"username", "eggs", "eggs_funded", "eggs_archived",
-					"eggs_bookmarked", "interests", "comments", "followers",
-					"follows", "previous_usernames", "transactions",
-					"notifications", "preferences", "_schema_version_", "_id",
-					"recent_searches")
-					
-				for disallowed_field in disallowed_fields:
-					if fields.get(disallowed_field) != None:
-						del fields[disallowed_field]
-				print(fields)
-				
-				cursor = accounts.find({ "username": username })
-				if len(cursor) != 0:
-					for account in cursor:
-						account = { **account, **fields }
-						accounts.update(account)
-					return ResponseModel(cd=200, msg="Account updated.",
-										d=AccountModel({**account, **fields}).sanitize_soft()).to_json()
-				else:
-					return ResponseModel(cd=404, msg="Account not found.").to_json()
+		auth_username = g.authentication["email_address"].split("@")[0]
+		# check if the authenticated user is the one being updated
+		if username == auth_username:
+			if not isinstance(request.json, dict):
+				return ResponseModel(cd=400, msg="Invalid request. Request has to be made with a JSON object as the body.").to_json()
+
+			# unchangeble data is dropped, the rest is merged into the record by the database
+			fields = { field: value for field, value in request.json.items() if field not in DISALLOWED_FIELDS }
+			fields["last_modified"] = TimeCreatedModel().__dict__
+
+			# If-Match carries the ETag of the revision the client last saw
+			if_match = request.headers.get("If-Match")
+			rev = if_match.strip().strip('"') if if_match and if_match.strip() != "*" else None
+
+			try:
+				account = update_one_by("username", username, fields, rev=rev, unset=HIDDEN_FIELDS["owner"])
+			except PreconditionFailed:
+				return ResponseModel(cd=412, msg="Account was modified by another request, reload it and try again.").to_json()
+			except AQLQueryExecuteError as error:
+				if error.error_code != UNIQUE_CONSTRAINT_ERROR:
+					raise
+				# Same answer as a signup with a taken address, the unique index rejected the new one.
+				return ResponseModel(cd=208, msg=f'An account with email address "{fields.get("email_address")}" already exists.').to_json()
+
+			if account is not None:
+				profile_cache.delete(username)
+				return ResponseModel(cd=200, msg="Account updated.",
+									d=AccountModel(account).sanitize_soft()).to_json(headers={"ETag": f'"{account["_rev"]}"'})
 			else:
-				return ResponseModel(cd=403, msg="Not allowed to manipulate resource.").to_json()
-		return authenticate_request(server_instance.app_context, re_authenticate_session, update_account)
+				return ResponseModel(cd=404, msg="Account not found.").to_json()
+		else:
+			return ResponseModel(cd=403, msg="Not allowed to manipulate resource.").to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
 	except:
-		print(format_exc())
+		logger.exception("Request failed.")
 		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
 
 
 """ Deleting account records. """
-@server_instance.route("/accounts/<username>", methods=["DELETE"])
+@accounts_blueprint.route("/accounts/<username>", methods=["DELETE"])
+@require_authentication
 def delete_account_records(username: str):
 	try:
-		cred_validity = re_authenticate_session()
-		if cred_validity.status == "200 OK":
-			auth_email_address = cred_validity.json["data"]["p+d"]["email_address"]
-			auth_account_cursor = accounts.find({ "email_address": auth_email_address })
-			if len(auth_account_cursor):
-				for auth_account in auth_account_cursor:
-					if auth_account["username"] == username:
-						delete_result = accounts.delete(auth_account["_key"])
-						if delete_result:
-							return ResponseModel(cd=200, msg="Account deleted.").to_json()
-					else:
-						return ResponseModel(cd=401, msg="Not allowed to perfom this action.").to_json()
+		auth_email_address = g.authentication["email_address"]
+		auth_account = get_one_by("email_address", auth_email_address, keep=["_key", "username"])
+		if auth_account is not None:
+			if auth_account["username"] == username:
+				delete_result = accounts.delete(auth_account["_key"])
+				profile_cache.delete(username)
+				if delete_result:
+					jobs.enqueue_after_write("account_cleanup", { "account_key": auth_account["_key"] })
+					return ResponseModel(cd=200, msg="Account deleted.").to_json()
 			else:
-				return ResponseModel(cd=404, msg="Authenticated (Logged In) account not found. Logging out.").to_json()
-			return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+				return ResponseModel(cd=401, msg="Not allowed to perfom this action.").to_json()
 		else:
-			return cred_validity
+			return ResponseModel(cd=404, msg="Authenticated (Logged In) account not found. Logging out.").to_json()
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Following an account. """
+@accounts_blueprint.route("/accounts/<username>/follow", methods=["POST", "DELETE"])
+@require_authentication
+def follow_account(username: str) -> FlaskResponse:
+	try:
+		auth_username = g.authentication["email_address"].split("@")[0]
+		if auth_username == username:
+			return ResponseModel(cd=400, msg="Accounts can not follow themselves.").to_json()
+
+		if request.method == "POST":
+			changed = follows.follow(auth_username, username)
+		else:
+			changed = follows.unfollow(auth_username, username)
+
+		if changed is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		if changed and request.method == "POST":
+			try:
+				notifications.notify(username, "follow", { "username": auth_username })
+			except:
+				# The follow is stored either way, only the notification is lost.
+				logger.exception("Follow notification failed.")
+		return ResponseModel(cd=200, msg="Following." if request.method == "POST" else "Unfollowed.").to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Paginated followers and followed accounts, newest first. """
+@accounts_blueprint.route("/accounts/<username>/followers", methods=["GET"], defaults={"relation": "followers"})
+@accounts_blueprint.route("/accounts/<username>/following", methods=["GET"], defaults={"relation": "following"})
+def list_follow_accounts(username: str, relation: str) -> FlaskResponse:
+	try:
+		limit = request.args.get("limit", default=50, type=int)
+		if limit < 1 or limit > 200:
+			return ResponseModel(cd=400, msg="\"limit\" has to be between 1 and 200.").to_json()
+		try:
+			page = follows.list_accounts(username, relation, limit=limit, cursor=request.args.get("cursor"))
+		except ValueError:
+			return ResponseModel(cd=400, msg="Invalid cursor provided.").to_json()
+
+		if page is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		return ResponseModel(cd=200, d=page).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Checks whether two accounts follow each other. """
+@accounts_blueprint.route("/accounts/<username>/follows/<other_username>", methods=["GET"])
+def get_follow_relationship(username: str, other_username: str) -> FlaskResponse:
+	try:
+		relationship = follows.relationship(username, other_username)
+		if relationship is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		return ResponseModel(cd=200, d=relationship).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Notifications of the authenticated account, newest first. """
+@accounts_blueprint.route("/accounts/<username>/notifications", methods=["GET"])
+@require_authentication
+def list_account_notifications(username: str) -> FlaskResponse:
+	try:
+		if username != g.authentication["email_address"].split("@")[0]:
+			return ResponseModel(cd=403, msg="Not allowed to access resource.").to_json()
+		limit = request.args.get("limit", default=50, type=int)
+		if limit < 1 or limit > 200:
+			return ResponseModel(cd=400, msg="\"limit\" has to be between 1 and 200.").to_json()
+		try:
+			page = notifications.list_notifications(username, limit=limit, cursor=request.args.get("cursor"))
+		except ValueError:
+			return ResponseModel(cd=400, msg="Invalid cursor provided.").to_json()
+
+		if page is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		return ResponseModel(cd=200, d=page).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Unread badge count, read from the counter on the account. """
+@accounts_blueprint.route("/accounts/<username>/notifications/unread", methods=["GET"])
+@require_authentication
+def count_unread_notifications(username: str) -> FlaskResponse:
+	try:
+		if username != g.authentication["email_address"].split("@")[0]:
+			return ResponseModel(cd=403, msg="Not allowed to access resource.").to_json()
+		account = get_one_by("username", username, keep=["unread_notifications"])
+		if account is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		return ResponseModel(cd=200, d={ "unread": account.get("unread_notifications", 0) }).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
 	except:
-		print(format_exc())
-		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
\ No newline at end of file
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Marks the listed notifications read, or every unread one when no keys are sent. """
+@accounts_blueprint.route("/accounts/<username>/notifications/read", methods=["POST"])
+@require_authentication
+@parse_request
+def mark_notifications_read(username: str) -> FlaskResponse:
+	try:
+		if username != g.authentication["email_address"].split("@")[0]:
+			return ResponseModel(cd=403, msg="Not allowed to access resource.").to_json()
+		keys = request.json.get("keys") if isinstance(request.json, dict) else None
+		if keys is not None and (not isinstance(keys, list) or not all(isinstance(key, str) for key in keys) or len(keys) > 1000):
+			return ResponseModel(cd=400, msg="\"keys\" has to be a list of at most 1000 notification keys.").to_json()
+
+		result = notifications.mark_read(username, keys)
+		if result is None:
+			return ResponseModel(cd=404, msg="Account not found.").to_json()
+		return ResponseModel(cd=200, d=result).to_json()
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+""" Streaming export of sanitized accounts as NDJSON, for analytics and backfills. """
+@accounts_blueprint.route("/accounts/export", methods=["GET"])
+@require_authentication
+@require_admin
+def export_hetch_accounts() -> FlaskResponse:
+	try:
+		batch_size = request.args.get("batch_size", default=1000, type=int)
+		if batch_size < 1 or batch_size > 10000:
+			return ResponseModel(cd=400, msg="\"batch_size\" has to be between 1 and 10000.").to_json()
+		try:
+			lines = exports.export_accounts(
+				field=request.args.get("field", default="time_created"),
+				since=request.args.get("since", default=0, type=float),
+				until=request.args.get("until", default=None, type=float),
+				cursor=request.args.get("cursor"),
+				batch_size=batch_size)
+		except ValueError as error:
+			return ResponseModel(cd=400, msg=str(error)).to_json()
+		return FlaskResponse(stream_with_context(lines), status=200, mimetype="application/x-ndjson")
+	except ServiceUnavailable as error:
+		return service_unavailable_response(error)
+	except:
+		logger.exception("Request failed.")
+		return ResponseModel(cd=500, msg="Something went wrong. That's all we know.").to_json()
+
+
+"""
+__________________________________
+SERVER INSTANCE SETUP
+__________________________________
+"""
+def create_app() -> Flask:
+	app = Flask(__name__,
+			static_folder="./assets/",
+			static_url_path="/accounts/assets/")
+	CORS(app, resources={r"*": {"origins": "*"}})
+
+	""" Request IDs, latency histograms, structured access logs and /accounts/metrics. """
+	instrument(app)
+	""" Opt-in workload capture for capacity planning, see capture.py. """
+	capture.install(app)
+	""" Background job workers start with the first request of each process. """
+	jobs.install(app)
+	app.register_blueprint(accounts_blueprint)
+	return app
+
+
+server_instance = create_app()
@@ -0,0 +1,135 @@
+"""
+Shared fixtures. Route tests run the real app against the in-memory
+database stand-in from benchmarks/fake_arango.py, which answers one query
+at a time. Tests of what the queries guarantee under concurrency use the
+arango_db fixture instead, a throwaway database on the ArangoDB at
+ARANGO_TEST_URL (ARANGO_TEST_USERNAME, ARANGO_TEST_PASSWORD); they are
+skipped when it is not set.
+"""
+import sys
+import tempfile
+from os import environ, path
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+""" Settings read at import time, set before the app is imported. """
+environ.setdefault("environment", "production")
+environ.setdefault("SEED", "test-seed")
+environ.setdefault("ACCESS_LOG", "false")
+environ.setdefault("HASH_ROUNDS", "1000")
+environ.setdefault("JOBS_IN_PROCESS", "false")
+environ.setdefault("GRAVATAR_URL", "http://127.0.0.1:9")
+environ.setdefault("GRAVATAR_TIMEOUT", "0.05")
+environ.setdefault("JWT_KEYRING", path.join(tempfile.mkdtemp(prefix="hetch-tests-"), "keyring.json"))
+environ.setdefault("JWT_KEYRING_RELOAD_INTERVAL", "0")
+# Nothing listens there, a test that reaches the database without a stand-in fails fast.
+environ.setdefault("ARANGO_URL", "http://127.0.0.1:9")
+environ.setdefault("DATABASE_NAME", "hetch_test")
+environ.setdefault("ARANGO_PASSWORD", "")
+
+PASSWORD = "test-password"
+
+
+""" Answers every query with result after failing the first ones with a write-write conflict. """
+class ConflictingDatabase():
+	def __init__(self, conflicts: int, result: dict):
+		self.conflicts = conflicts
+		self.result = result
+		self.executed = 0
+		self.aql = self
+
+	def execute(self, query: str, bind_vars=None, **kwargs):
+		from arango.exceptions import AQLQueryExecuteError
+		from benchmarks.fake_arango import server_error, CONFLICT_ERROR
+		self.executed += 1
+		if self.executed <= self.conflicts:
+			raise server_error(AQLQueryExecuteError, CONFLICT_ERROR, "write-write conflict")
+		return iter([self.result])
+
+
+@pytest.fixture(scope="session")
+def server():
+	import server
+	yield server
+	server.password_hasher.shutdown()
+
+
+@pytest.fixture
+def db(server):
+	""" A fresh stand-in per test, with empty profile and idempotency caches. """
+	import database
+	import idempotency
+	from benchmarks.fake_arango import FakeDatabase
+	fake_database = FakeDatabase()
+	database.use_database(fake_database)
+	server.profile_cache._entries.clear()
+	idempotency.idempotency_store = idempotency.default_store()
+	yield fake_database
+	database.use_database(None)
+
+
+@pytest.fixture
+def arango_db(server):
+	""" A database of its own on a real ArangoDB with the collections, indexes and views of the app. """
+	if not environ.get("ARANGO_TEST_URL"):
+		pytest.skip("ARANGO_TEST_URL is not set, these tests need a real ArangoDB.")
+	import database
+	from arango import ArangoClient
+	from arango_http import PooledHTTPClient
+	settings = { "name": f"hetch_test_{uuid4().hex[:12]}", "username": environ.get("ARANGO_TEST_USERNAME", "root"),
+		"password": environ.get("ARANGO_TEST_PASSWORD", "") }
+	arango_client = ArangoClient(hosts=environ["ARANGO_TEST_URL"], http_client=PooledHTTPClient(pool_size=32),
+		verify_override=False)
+	database.bootstrap(arango_client, settings)
+	arango_database = arango_client.db(settings["name"], username=settings["username"], password=settings["password"])
+	database.use_database(arango_database)
+	server.profile_cache._entries.clear()
+	yield arango_database
+	database.use_database(None)
+	arango_client.db("_system", username=settings["username"], password=settings["password"]).delete_database(settings["name"])
+
+
+@pytest.fixture
+def use(server):
+	""" Puts a database of the test's choosing in use. """
+	import database
+	def use_database(fake_database):
+		database.use_database(fake_database)
+		return fake_database
+	yield use_database
+	database.use_database(None)
+
+
+@pytest.fixture
+def client(server, db):
+	return server.server_instance.test_client()
+
+
+@pytest.fixture
+def seed(server):
+	""" Inserts accounts straight into the database in use, returns them with a Bearer token each. """
+	import database
+	password_hash = server.password_hasher.hash(PASSWORD)
+
+	def seed_account(email_address: str, **fields) -> dict:
+		account = server.AccountModel({ "email_address": email_address, "display_name": "Test Account", **fields },
+			password_hash=password_hash)
+		metadata = database.get_database().collection("accounts").insert(account.to_dict())
+		return { "_key": metadata["_key"], "username": account.username, "email_address": email_address,
+			"authorization": f"Bearer {server.generate_authentication_token(email_address)}" }
+	return seed_account
+
+
+@pytest.fixture
+def keyring_file(server):
+	""" The keyring the app reads, emptied again after the test. """
+	import keys
+	yield keys.KEYRING_PATH
+	for entry in keys.read_entries(keys.KEYRING_PATH):
+		key_path = path.join(path.dirname(keys.KEYRING_PATH), entry["private_key"])
+		if path.exists(key_path):
+			keys.remove(key_path)
+	keys.write_entries(keys.KEYRING_PATH, [])
@@ -0,0 +1,101 @@
+import pytest
+
+from conftest import PASSWORD
+
+
+def stored_account(db, username: str) -> dict:
+	return next(document for document in db.collection("accounts").documents.values() if document["username"] == username)
+
+
+def test_signup_starts_counters_from_the_defaults(client, db):
+	response = client.post("/accounts/", json={ "email_address": "counted@test.dev", "display_name": "Counted",
+		"password": PASSWORD, "followers_count": 999999, "follows_count": 12, "unread_notifications": -5 })
+	assert response.status_code == 200
+	assert response.json["data"]["followers_count"] == 0
+	assert response.json["data"]["follows_count"] == 0
+
+	stored = stored_account(db, "counted")
+	assert (stored["followers_count"], stored["follows_count"], stored["unread_notifications"]) == (0, 0, 0)
+
+
+def test_patch_can_not_change_counters(client, db, seed):
+	account = seed("patched@test.dev")
+	response = client.patch(f'/accounts/{account["username"]}', headers={ "Authorization": account["authorization"] },
+		json={ "display_name": "Patched", "followers_count": 999999, "unread_notifications": -5 })
+	assert response.status_code == 200
+
+	stored = stored_account(db, "patched")
+	assert stored["display_name"] == "Patched"
+	assert (stored["followers_count"], stored["unread_notifications"]) == (0, 0)
+
+
+def test_patch_with_a_stale_revision_is_refused(client, db, seed):
+	account = seed("conditional@test.dev")
+	authorization = { "Authorization": account["authorization"] }
+	first = client.patch(f'/accounts/{account["username"]}', headers=authorization, json={ "display_name": "First" })
+	assert first.status_code == 200
+
+	current = client.patch(f'/accounts/{account["username"]}', headers={ **authorization, "If-Match": first.headers["ETag"] },
+		json={ "display_name": "Second" })
+	assert current.status_code == 200
+	stale = client.patch(f'/accounts/{account["username"]}', headers={ **authorization, "If-Match": first.headers["ETag"] },
+		json={ "display_name": "Third" })
+	assert stale.status_code == 412
+	assert stored_account(db, "conditional")["display_name"] == "Second"
+
+
+@pytest.mark.parametrize("taken, message", [
+	({ "email_address": "taken@test.dev" }, 'An account with email address "taken@test.dev" already exists.'),
+	({ "email_address": "taken@other.dev" }, 'An account with username "taken" already exists.')])
+def test_signup_of_a_taken_account_is_refused(client, db, seed, taken, message):
+	seed("taken@test.dev")
+	response = client.post("/accounts/", json={ **taken, "display_name": "Taken", "password": PASSWORD })
+	assert (response.status_code, response.json["status_message"]) == (208, message)
+	assert sum(1 for document in db.collection("accounts").documents.values() if document["username"] == "taken") == 1
+
+
+def test_patch_to_a_taken_email_address_is_refused(client, db, seed):
+	seed("owner@test.dev")
+	account = seed("mover@test.dev")
+	response = client.patch(f'/accounts/{account["username"]}', headers={ "Authorization": account["authorization"] },
+		json={ "email_address": "owner@test.dev" })
+	assert (response.status_code, response.json["status_message"]) == (
+		208, 'An account with email address "owner@test.dev" already exists.')
+	assert stored_account(db, "mover")["email_address"] == "mover@test.dev"
+
+
+def test_parallel_conditional_patches_have_one_winner(server, db, seed):
+	from threading import local
+	from concurrent.futures import ThreadPoolExecutor
+	account = seed("racing@test.dev")
+	etag = f'"{stored_account(db, "racing")["_rev"]}"'
+	clients = local()
+
+	def patch(index: int) -> int:
+		if getattr(clients, "client", None) is None:
+			clients.client = server.server_instance.test_client()
+		return clients.client.patch(f'/accounts/{account["username"]}', json={ "display_name": f"Writer {index}" },
+			headers={ "Authorization": account["authorization"], "If-Match": etag }).status_code
+
+	with ThreadPoolExecutor(max_workers=8) as executor:
+		statuses = sorted(executor.map(patch, range(16)))
+	assert statuses == [200] + [412] * 15
+
+
+def test_writes_stand_when_their_jobs_can_not_be_queued(client, db, server, monkeypatch):
+	import jobs
+	class UnavailableStore():
+		def add(self, job: dict):
+			raise ConnectionError("job store down")
+	monkeypatch.setattr(jobs.job_queue, "store", UnavailableStore())
+	failed = jobs.job_queue._metrics["enqueue_errors"]
+
+	response = client.post("/accounts/", json={ "email_address": "queued@test.dev", "display_name": "Queued", "password": PASSWORD })
+	assert response.status_code == 200
+	assert stored_account(db, "queued")["email_address"] == "queued@test.dev"
+
+	authorization = { "Authorization": f'Bearer {server.generate_authentication_token("queued@test.dev")}' }
+	response = client.delete("/accounts/queued", headers=authorization)
+	assert response.status_code == 200
+	assert len(db.collection("accounts").documents) == 0
+	assert jobs.job_queue._metrics["enqueue_errors"] == failed + 2
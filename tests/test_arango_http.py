@@ -0,0 +1,119 @@
+from time import sleep
+
+import pytest
+
+from arango_http import PooledHTTPClient
+from database import CircuitBreaker, DatabaseUnavailable
+from benchmarks.fault_http import FaultServer
+
+
+@pytest.fixture
+def faults():
+	server = FaultServer(delay=0.5).start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def client(breaker=None) -> PooledHTTPClient:
+	return PooledHTTPClient(pool_size=2, timeout=0.2, retries=2, backoff=0.001,
+		breaker=breaker or CircuitBreaker(threshold=2, cooldown=0.1))
+
+
+def send(http_client: PooledHTTPClient, url: str, method: str = "get"):
+	session = http_client.create_session(url)
+	try:
+		return http_client.send_request(session, method, f"{url}/_api/version")
+	finally:
+		session.close()
+
+
+@pytest.mark.parametrize("fault", ["drop", "delay", "unavailable"])
+def test_idempotent_requests_are_retried(faults, fault):
+	faults.script(fault, fault)
+	assert send(client(), faults.url).status_code == 201
+	assert [recorded for _, _, recorded in faults.requests] == [fault, fault, "ok"]
+
+
+@pytest.mark.parametrize("fault", ["drop", "delay"])
+def test_writes_are_not_sent_twice(faults, fault):
+	http_client = client()
+	faults.script(fault)
+	with pytest.raises(DatabaseUnavailable):
+		send(http_client, faults.url, "post")
+	assert len(faults.requests) == 1
+	assert http_client.breaker.failures == 1
+
+
+def test_unavailable_write_is_answered_and_counted(faults):
+	http_client = client()
+	faults.script("unavailable")
+	assert send(http_client, faults.url, "post").status_code == 503
+	assert len(faults.requests) == 1
+	assert http_client.breaker.failures == 1
+
+
+def test_breaker_opens_and_recovers_after_a_trial(faults):
+	http_client = client()
+	faults.script(*["drop"] * 6)
+	for _ in range(2):
+		with pytest.raises(DatabaseUnavailable):
+			send(http_client, faults.url)
+	assert http_client.breaker.state == "open"
+
+	# Open: nothing reaches the database.
+	sent = len(faults.requests)
+	with pytest.raises(DatabaseUnavailable):
+		send(http_client, faults.url)
+	assert len(faults.requests) == sent
+
+	sleep(0.15)
+	assert http_client.breaker.state == "half-open"
+	assert send(http_client, faults.url).status_code == 201
+	assert http_client.breaker.state == "closed"
+
+
+def test_failed_trial_reopens_the_breaker_whatever_the_error(faults):
+	""" A truncated answer raises ChunkedEncodingError, it has to end the trial like any other failure. """
+	http_client = client(CircuitBreaker(threshold=1, cooldown=0.1))
+	faults.script("drop", "drop", "drop")
+	with pytest.raises(DatabaseUnavailable):
+		send(http_client, faults.url)
+	assert http_client.breaker.state == "open"
+
+	sleep(0.15)
+	faults.script("truncate")
+	with pytest.raises(DatabaseUnavailable):
+		send(http_client, faults.url, "post")
+	assert http_client.breaker.state == "open"
+
+	sleep(0.15)
+	assert send(http_client, faults.url).status_code == 201
+	assert http_client.breaker.state == "closed"
+
+
+@pytest.fixture
+def arango(faults):
+	""" The app's database functions, connected to the stand-in through the pooled client. """
+	import database
+	from arango import ArangoClient
+	arango_client = ArangoClient(hosts=faults.url, http_client=client(), verify_override=False)
+	database.use_database(arango_client.db("hetch", username="root", password=""))
+	yield database
+	database.use_database(None)
+
+
+def test_read_only_lookups_are_retried(faults, arango):
+	faults.script("drop", "unavailable")
+	assert arango.get_one_by("username", "missing") is None
+	assert arango.get_many_by("username", ["missing"]) == []
+	assert [(method, fault) for method, _, fault in faults.requests] == [
+		("POST", "drop"), ("POST", "unavailable"), ("POST", "ok"), ("POST", "ok")]
+
+
+def test_writing_queries_are_not_retried(faults, arango):
+	faults.script("drop")
+	with pytest.raises(DatabaseUnavailable):
+		arango.update_one_by("username", "missing", { "display_name": "Changed" })
+	assert len(faults.requests) == 1
+	assert not arango.is_read_only()
@@ -0,0 +1,93 @@
+"""
+What the queries guarantee when requests race, checked on a real ArangoDB
+(see the arango_db fixture). The in-memory stand-in runs one query at a
+time and can not show any of this.
+"""
+from threading import local
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import PASSWORD
+
+
+""" Requests sent side by side in every race. """
+CONCURRENCY = 16
+
+
+@pytest.fixture
+def race(server):
+	""" Sends (method, path, options) requests from a thread pool, each thread with its own test client. """
+	clients = local()
+
+	def send(request: tuple):
+		if getattr(clients, "client", None) is None:
+			clients.client = server.server_instance.test_client()
+		method, request_path, options = request
+		response = clients.client.open(request_path, method=method, **options)
+		return response.status_code, response.headers, response.json
+
+	def run(requests: list) -> list:
+		with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+			return list(executor.map(send, requests))
+	return run
+
+
+def test_parallel_patches_keep_every_field(arango_db, seed, race):
+	account = seed("patched@test.dev")
+	outcomes = race([("PATCH", f'/accounts/{account["username"]}', { "json": { f"field_{index}": index },
+		"headers": { "Authorization": account["authorization"] } }) for index in range(64)])
+	assert [status for status, _, _ in outcomes] == [200] * 64
+
+	stored = arango_db.collection("accounts").get(account["_key"])
+	assert [stored.get(f"field_{index}") for index in range(64)] == list(range(64))
+
+
+def test_conditional_patches_on_one_revision_have_one_winner(arango_db, seed, race):
+	account = seed("conditional@test.dev")
+	rev = arango_db.collection("accounts").get(account["_key"])["_rev"]
+	outcomes = race([("PATCH", f'/accounts/{account["username"]}', { "json": { "display_name": f"Writer {index}" },
+		"headers": { "Authorization": account["authorization"], "If-Match": f'"{rev}"' } }) for index in range(CONCURRENCY)])
+	statuses = sorted(status for status, _, _ in outcomes)
+	assert statuses == [200] + [412] * (CONCURRENCY - 1)
+
+
+def test_duplicate_signups_create_one_account(arango_db, race):
+	outcomes = race([("POST", "/accounts/", { "json": {
+		"email_address": "duplicate@test.dev", "display_name": "Duplicate", "password": PASSWORD } })] * CONCURRENCY)
+	assert sorted(status for status, _, _ in outcomes) == [200] + [208] * (CONCURRENCY - 1)
+	assert arango_db.collection("accounts").find({ "email_address": "duplicate@test.dev" }).count() == 1
+
+
+def test_signup_retries_with_one_key_run_once(arango_db, race):
+	outcomes = race([("POST", "/accounts/", { "json": {
+		"email_address": "retried@test.dev", "display_name": "Retried", "password": PASSWORD },
+		"headers": { "Idempotency-Key": "retried-signup" } })] * CONCURRENCY)
+	created = [headers for status, headers, _ in outcomes if status == 200 and "Idempotent-Replayed" not in headers]
+	assert len(created) == 1
+	assert all(status in (200, 409) for status, _, _ in outcomes)
+	assert arango_db.collection("accounts").find({ "email_address": "retried@test.dev" }).count() == 1
+
+
+def test_parallel_follows_of_one_account_are_all_counted(arango_db, seed, race):
+	followee = seed("popular@test.dev")
+	followers = [seed(f"follower{index}@test.dev") for index in range(CONCURRENCY * 2)]
+	outcomes = race([("POST", f'/accounts/{followee["username"]}/follow',
+		{ "headers": { "Authorization": follower["authorization"] } }) for follower in followers])
+	assert [status for status, _, _ in outcomes] == [200] * len(followers)
+
+	stored = arango_db.collection("accounts").get(followee["_key"])
+	edges = arango_db.collection("follows").find({ "_to": f'accounts/{followee["_key"]}' }).count()
+	assert stored["followers_count"] == edges == len(followers)
+
+
+def test_jobs_are_claimed_once(arango_db):
+	import jobs
+	store = jobs.ArangoJobStore()
+	for index in range(CONCURRENCY * 4):
+		store.add({ "_key": f"job{index}", "type": "test", "payload": {}, "status": "queued", "attempts": 0,
+			"created_at": 0, "run_at": 0 })
+	with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+		claimed = list(executor.map(lambda worker: store.claim("test", 4, f"worker{worker}", 1, 60), range(CONCURRENCY * 2)))
+	keys = [job["_key"] for jobs_claimed in claimed for job in jobs_claimed]
+	assert len(keys) == len(set(keys))
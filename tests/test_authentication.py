@@ -0,0 +1,74 @@
+import pytest
+import jwt
+
+
+def test_hs256_token_reaches_authenticated_route(client, seed):
+	account = seed("hs256@test.dev")
+	assert jwt.get_unverified_header(account["authorization"].split(" ")[1])["alg"] == "HS256"
+
+	response = client.get("/accounts/authentication/re", headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 200
+	assert response.json["data"]["p+d"]["email_address"] == "hs256@test.dev"
+
+
+@pytest.mark.parametrize("alg", ["ES256", "EdDSA"])
+def test_keyring_token_reaches_authenticated_routes(client, seed, keyring_file, alg):
+	import keys
+	entry = keys.rotate(keyring_file, alg, lead_hours=0)
+	account = seed(f"{alg.lower()}@test.dev")
+	header = jwt.get_unverified_header(account["authorization"].split(" ")[1])
+	assert (header["alg"], header["kid"]) == (alg, entry["kid"])
+
+	response = client.get("/accounts/authentication/re", headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 200
+
+	response = client.patch(f'/accounts/{account["username"]}', json={ "display_name": "Rotated" },
+		headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 200
+	assert response.json["data"]["display_name"] == "Rotated"
+
+	jwks = client.get("/accounts/.well-known/jwks.json").json
+	assert entry["kid"] in [key["kid"] for key in jwks["keys"]]
+
+
+def test_tampered_and_malformed_tokens_are_rejected(client, seed, keyring_file):
+	import keys
+	keys.rotate(keyring_file, "ES256", lead_hours=0)
+	account = seed("tampered@test.dev")
+	header, claims, signature = account["authorization"].split(" ")[1].split(".")
+
+	for token in [f"{header}.{claims}.{signature[:-4]}AAAA", "not-a-token", f"{header}.{claims}"]:
+		response = client.get("/accounts/authentication/re", headers={ "Authorization": f"Bearer {token}" })
+		assert response.status_code == 403
+		assert response.json["status_message"] == "Invalid signature provided."
+
+
+def test_cached_hs256_token_stops_at_the_deadline(client, seed, monkeypatch):
+	import keys
+	from time import time
+	deadline = time() + 60
+	monkeypatch.setenv("JWT_HS256_ACCEPTED_UNTIL", str(deadline))
+	account = seed("deadline@test.dev")
+	response = client.get("/accounts/authentication/re", headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 200
+
+	monkeypatch.setattr(keys, "time", lambda: deadline + 1)
+	response = client.get("/accounts/authentication/re", headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 403
+	assert response.json["status_message"] == "Signature algorithm is no longer accepted, sign in again."
+
+
+def test_cached_token_stops_with_its_pruned_key(client, seed, keyring_file):
+	import keys
+	from os import utime
+	from time import time
+	keys.rotate(keyring_file, "ES256", lead_hours=0)
+	account = seed("pruned@test.dev")
+	response = client.get("/accounts/authentication/re", headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 200
+
+	keys.write_entries(keyring_file, [])
+	utime(keyring_file, (time() + 1, time() + 1))
+	response = client.get("/accounts/authentication/re", headers={ "Authorization": account["authorization"] })
+	assert response.status_code == 403
+	assert response.json["status_message"] == "Invalid signature provided."
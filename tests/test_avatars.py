@@ -0,0 +1,64 @@
+from time import sleep
+
+import pytest
+
+from avatars import AvatarResolver
+from database import CircuitBreaker
+from benchmarks.fault_http import FaultServer
+
+
+@pytest.fixture
+def gravatar():
+	server = FaultServer(delay=0.5, status=200).start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+def resolver(server: FaultServer, **options) -> AvatarResolver:
+	return AvatarResolver(base_url=server.url, timeout=0.2, retries=2, backoff=0.001, negative_ttl=60,
+		breaker=CircuitBreaker(threshold=2, cooldown=0.1), **options)
+
+
+@pytest.mark.parametrize("fault", ["drop", "delay", "unavailable"])
+def test_lookups_are_retried(gravatar, fault):
+	gravatar.script(fault, fault)
+	avatar_resolver = resolver(gravatar)
+	assert avatar_resolver.resolve("retried@test.dev").startswith(f"{gravatar.url}/avatar/")
+	assert [(method, recorded) for method, _, recorded in gravatar.requests] == [("GET", fault), ("GET", fault), ("GET", "ok")]
+	assert avatar_resolver.metrics()["upstream_errors"] == 0
+
+
+def test_failed_lookups_keep_the_fallback_and_are_not_cached(gravatar):
+	avatar_resolver = resolver(gravatar)
+	gravatar.script(*["unavailable"] * 3)
+	assert avatar_resolver.resolve("failed@test.dev") is None
+	assert avatar_resolver.resolve("failed@test.dev") is not None
+	assert len(gravatar.requests) == 4
+
+
+def test_missing_profiles_are_cached(gravatar):
+	gravatar.status = 404
+	avatar_resolver = resolver(gravatar)
+	assert avatar_resolver.resolve("missing@test.dev") is None
+	assert avatar_resolver.resolve("missing@test.dev") is None
+	assert len(gravatar.requests) == 1
+	assert avatar_resolver.metrics()["breaker_state"] == "closed"
+
+
+def test_breaker_opens_and_stops_lookups_until_a_trial(gravatar):
+	avatar_resolver = resolver(gravatar)
+	gravatar.script(*["drop"] * 6)
+	assert avatar_resolver.resolve("first@test.dev") is None
+	assert avatar_resolver.resolve("second@test.dev") is None
+	assert avatar_resolver.metrics()["breaker_state"] == "open"
+
+	# Open: lookups fail without reaching the upstream.
+	sent = len(gravatar.requests)
+	assert avatar_resolver.resolve("third@test.dev") is None
+	assert len(gravatar.requests) == sent
+	assert avatar_resolver.metrics()["upstream_errors"] == 3
+
+	sleep(0.15)
+	assert avatar_resolver.resolve("third@test.dev") is not None
+	assert avatar_resolver.metrics()["breaker_state"] == "closed"
@@ -0,0 +1,30 @@
+import io
+import json
+
+import pytest
+
+import bulk_import
+from conftest import PASSWORD
+
+
+@pytest.mark.parametrize("system_fields", [{ "_id": "accounts/imported" }, { "_key": "imported", "_rev": "_imported" }])
+def test_rows_with_system_fields_are_imported_as_new_accounts(db, server, system_fields):
+	row = { "email_address": "imported@test.dev", "display_name": "Imported", "password": PASSWORD, **system_fields }
+	errors = io.StringIO()
+	assert bulk_import.import_accounts([json.dumps(row)], output=errors) == { "imported": 1, "rejected": 0 }
+
+	stored, = db.collection("accounts").documents.values()
+	assert stored["username"] == "imported"
+	assert "timestamp" in stored["time_created"]
+	assert stored["password"] != PASSWORD
+	assert server.password_hasher.verify(PASSWORD, stored["password"])[0]
+
+
+def test_signups_with_system_fields_create_new_accounts(client, db):
+	response = client.post("/accounts/", json={
+		"email_address": "signup@test.dev", "display_name": "Signup", "password": PASSWORD, "_id": "accounts/signup" })
+	assert response.status_code == 200
+
+	stored, = db.collection("accounts").documents.values()
+	assert stored["username"] == "signup"
+	assert stored["password"] != PASSWORD
@@ -0,0 +1,40 @@
+import json
+from types import SimpleNamespace
+
+import capture
+from benchmarks import replay
+
+
+def test_first_captured_request_arrives_at_the_epoch(server, db, seed, tmp_path):
+	capture_path = str(tmp_path / "capture.jsonl")
+	app = capture.install(server.create_app(), capture_path)
+	account = seed("captured@test.dev")
+	client = app.test_client()
+	for _ in range(3):
+		assert client.get(f'/accounts/{account["username"]}/').status_code == 200
+
+	records = replay.read_capture(capture_path)
+	assert records[0]["t"] == 0
+	assert all(record["t"] >= 0 for record in records)
+	with open(capture_path, encoding="utf-8") as captured:
+		assert "epoch" in json.loads(captured.readline())
+
+
+def outcomes(waits: list, service: float = 0.05, spacing: float = 0.01) -> list:
+	""" (scheduled, started, finished, status) of requests arriving spacing seconds apart. """
+	return [(index * spacing, index * spacing + wait, index * spacing + wait + service, 200) for index, wait in enumerate(waits)]
+
+
+ARGS = SimpleNamespace(max_wait_ms=50.0, max_wait_growth_ms=20.0)
+
+
+def test_sparse_route_without_waits_is_not_saturated():
+	summary = replay.summarize_requests(outcomes([0.0, 0.0]), [0.0, 0.01], [200, 200], ARGS)
+	assert not summary["saturated"]
+
+
+def test_growing_backlog_is_saturated_before_waits_get_long():
+	waits = [index * 0.001 for index in range(40)]
+	summary = replay.summarize_requests(outcomes(waits), [index * 0.01 for index in range(40)], [200] * 40, ARGS)
+	assert summary["wait_p95"] < 50.0 and summary["wait_growth"] > 20.0
+	assert summary["saturated"]
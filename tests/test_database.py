@@ -0,0 +1,25 @@
+import pytest
+from arango.exceptions import AQLQueryExecuteError
+
+import database
+from conftest import ConflictingDatabase
+
+
+def test_unconditional_updates_are_retried_after_a_conflict(use):
+	conflicting = use(ConflictingDatabase(database.CONFLICT_ATTEMPTS - 1, { "username": "patched" }))
+	assert database.update_one_by("username", "patched", { "display_name": "Patched" }) == { "username": "patched" }
+	assert conflicting.executed == database.CONFLICT_ATTEMPTS
+
+
+def test_conflicts_past_the_attempts_are_raised(use):
+	conflicting = use(ConflictingDatabase(database.CONFLICT_ATTEMPTS, {}))
+	with pytest.raises(AQLQueryExecuteError):
+		database.update_one_by("username", "patched", { "display_name": "Patched" })
+	assert conflicting.executed == database.CONFLICT_ATTEMPTS
+
+
+def test_conditional_updates_fail_on_the_first_conflict(use):
+	conflicting = use(ConflictingDatabase(1, { "username": "patched" }))
+	with pytest.raises(database.PreconditionFailed):
+		database.update_one_by("username", "patched", { "display_name": "Patched" }, rev="_stale")
+	assert conflicting.executed == 1
@@ -0,0 +1,41 @@
+import json
+
+import exports
+import migrations
+import notifications
+
+
+def exported_usernames(**filters) -> list:
+	return [json.loads(line)["data"]["username"] for line in exports.export_accounts(field="last_modified", **filters)]
+
+
+def modified_long_ago(db, account: dict) -> dict:
+	document = db.collection("accounts").documents[account["_key"]]
+	document["last_modified"] = { **document["last_modified"], "timestamp": 1 }
+	return document
+
+
+def test_avatar_updates_are_exported_as_changes(db, seed, server):
+	account = seed("avatar@test.dev")
+	modified_long_ago(db, account)
+	assert exported_usernames(since=2) == []
+
+	server.update_profile_image(account["_key"], "https://gravatar.test/avatar")
+	assert exported_usernames(since=2) == [account["username"]]
+
+
+def test_migrations_are_exported_as_changes(db, seed):
+	upgraded, cleared = seed("upgraded@test.dev"), seed("cleared@test.dev")
+	document = modified_long_ago(db, upgraded)
+	modified_long_ago(db, cleared)["notifications"] = ["Welcome to Hetch."]
+
+	migrations.write_upgrades([(document["_key"], document["_rev"], { "display_name": "Upgraded" })])
+	notifications.migrate_arrays()
+	assert sorted(exported_usernames(since=2)) == sorted([upgraded["username"], cleared["username"]])
+
+
+def test_exports_without_until_have_no_upper_bound(db, seed):
+	account = seed("future@test.dev")
+	db.collection("accounts").documents[account["_key"]]["last_modified"]["timestamp"] = 2e12
+	assert exported_usernames(since=0) == [account["username"]]
+	assert exported_usernames(since=0, until=2e12) == []
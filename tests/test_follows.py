@@ -0,0 +1,31 @@
+import pytest
+from arango.exceptions import AQLQueryExecuteError
+
+import database
+import follows
+from conftest import ConflictingDatabase
+
+
+@pytest.mark.parametrize("change", [follows.follow, follows.unfollow])
+def test_conflicting_counter_updates_are_retried(use, change):
+	conflicting = use(ConflictingDatabase(database.CONFLICT_ATTEMPTS - 1,
+		{ "follower": "accounts/1", "followee": "accounts/2", "changed": True }))
+	assert change("follower", "followee") is True
+	assert conflicting.executed == database.CONFLICT_ATTEMPTS
+
+
+def test_conflicts_past_the_attempts_are_raised(use):
+	conflicting = use(ConflictingDatabase(database.CONFLICT_ATTEMPTS, {}))
+	with pytest.raises(AQLQueryExecuteError):
+		follows.follow("follower", "followee")
+	assert conflicting.executed == database.CONFLICT_ATTEMPTS
+
+
+@pytest.mark.parametrize("change", [follows.follow, follows.unfollow])
+def test_changed_counters_drop_both_cached_profiles(use, change):
+	from cache import profile_cache
+	use(ConflictingDatabase(0, { "follower": "accounts/1", "followee": "accounts/2", "changed": True }))
+	for username in ("follower", "followee", "bystander"):
+		profile_cache.set(username, ('"_rev"', b"{}"))
+	change("follower", "followee")
+	assert [profile_cache.get(username) for username in ("follower", "followee", "bystander")] == [None, None, ('"_rev"', b"{}")]
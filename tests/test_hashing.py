@@ -0,0 +1,27 @@
+from time import sleep
+
+import pytest
+
+from hashing import HashingService, HashingUnavailable
+
+
+@pytest.fixture
+def service():
+	hashing_service = HashingService(pool_size=1, queue_size=4, timeout=0.2)
+	yield hashing_service
+	hashing_service.shutdown()
+
+
+def test_timed_out_work_is_cancelled(service, monkeypatch):
+	executor = service._executor()
+	# Keeps the only process busy and the call queue full, later work waits in the executor.
+	busy = [executor.submit(sleep, 1) for _ in range(3)]
+	submitted = []
+	submit = executor.submit
+	monkeypatch.setattr(executor, "submit", lambda *args: submitted.append(submit(*args)) or submitted[-1])
+
+	with pytest.raises(HashingUnavailable):
+		service._run(sleep, 0)
+	assert submitted[0].cancelled()
+	for future in busy:
+		future.cancel()
@@ -0,0 +1,54 @@
+import idempotency
+from cache import ArangoCache
+from conftest import PASSWORD
+
+
+SIGNUP = { "email_address": "retried@test.dev", "display_name": "Retried", "password": PASSWORD }
+
+
+def test_retry_on_another_worker_is_replayed(client, db, monkeypatch):
+	monkeypatch.setattr(idempotency, "idempotency_store", ArangoCache("idempotency_keys", ttl=60))
+	first = client.post("/accounts/", json=SIGNUP, headers={ "Idempotency-Key": "signup-1" })
+	assert first.status_code == 200
+
+	# Another worker process has a store object of its own over the same collection.
+	monkeypatch.setattr(idempotency, "idempotency_store", ArangoCache("idempotency_keys", ttl=60))
+	retry = client.post("/accounts/", json=SIGNUP, headers={ "Idempotency-Key": "signup-1" })
+	assert retry.status_code == 200
+	assert retry.headers["Idempotent-Replayed"] == "true"
+	assert retry.json == first.json
+	assert db.collection("accounts").count() == 1
+
+
+def test_reused_key_with_another_body_is_refused(client, db):
+	assert client.post("/accounts/", json=SIGNUP, headers={ "Idempotency-Key": "signup-2" }).status_code == 200
+	response = client.post("/accounts/", json={ **SIGNUP, "display_name": "Changed" }, headers={ "Idempotency-Key": "signup-2" })
+	assert response.status_code == 422
+
+
+def test_only_one_worker_adds_a_key(db):
+	workers = [ArangoCache("idempotency_keys", ttl=60) for _ in range(4)]
+	assert [worker.add("key", "pending") for worker in workers] == [True, False, False, False]
+	assert workers[3].get("key") == "pending"
+
+
+def test_expired_entries_are_taken_over(db):
+	store = ArangoCache("idempotency_keys", ttl=60)
+	assert store.add("key", "first", ttl=-1)
+	assert store.get("key") is None
+	assert store.add("key", "second")
+	assert store.get("key") == "second"
+
+
+def test_default_store_is_bounded_and_off_the_database(monkeypatch):
+	from cache import MemoryCache
+	monkeypatch.delenv("IDEMPOTENCY_STORE", raising=False)
+	monkeypatch.setenv("IDEMPOTENCY_CACHE_SIZE", "2")
+	store = idempotency.default_store()
+	assert isinstance(store, MemoryCache)
+	for key in ("first", "second", "third"):
+		store.set(key, "response")
+	assert [store.get(key) for key in ("first", "second", "third")] == [None, "response", "response"]
+
+	monkeypatch.setenv("IDEMPOTENCY_STORE", "arango")
+	assert isinstance(idempotency.default_store(), ArangoCache)
@@ -0,0 +1,13 @@
+import migrations
+
+
+
+def test_write_back_drops_the_cached_profile(client, db, seed):
+	from cache import profile_cache
+	account = seed("cached@test.dev")
+	assert client.get(f'/accounts/{account["username"]}/').status_code == 200
+	assert profile_cache.get(account["username"]) is not None
+
+	document = db.collection("accounts").documents[account["_key"]]
+	assert migrations.write_upgrades([(document["_key"], document["_rev"], { "display_name": "Upgraded" })]) == 1
+	assert profile_cache.get(account["username"]) is None
@@ -0,0 +1,58 @@
+import pytest
+
+import notifications
+from benchmarks.fake_arango import FakeDatabase
+
+
+LEGACY = [{ "type": "follow", "data": { "username": "someone" }, "read": False }, "Welcome to Hetch.", { "type": "comment", "read": True }]
+
+
+def give_legacy_arrays(db, accounts: list):
+	for account in accounts:
+		db.collection("accounts").documents[account["_key"]]["notifications"] = list(LEGACY)
+
+
+def test_legacy_arrays_become_notifications(db, seed):
+	accounts = [seed(f"legacy{index}@test.dev") for index in range(3)]
+	give_legacy_arrays(db, accounts)
+
+	assert notifications.migrate_arrays(batch_size=2) == { "accounts": 3, "notifications": 9 }
+	for account in accounts:
+		stored = db.collection("accounts").documents[account["_key"]]
+		assert "notifications" not in stored
+		assert stored["unread_notifications"] == 2
+	assert len(db.collection("notifications").documents) == 9
+
+
+def test_migration_run_again_after_a_crash_adds_no_duplicates(db, seed, monkeypatch):
+	accounts = [seed(f"crashed{index}@test.dev") for index in range(2)]
+	give_legacy_arrays(db, accounts)
+
+	def crash(fake_database, bind_vars):
+		raise KeyboardInterrupt()
+	monkeypatch.setattr(db, "QUERY_HANDLERS", { **FakeDatabase.QUERY_HANDLERS, notifications.CLEAR_ARRAYS_QUERY: crash })
+	with pytest.raises(KeyboardInterrupt):
+		notifications.migrate_arrays()
+	assert len(db.collection("notifications").documents) == 6
+
+	monkeypatch.setattr(db, "QUERY_HANDLERS", FakeDatabase.QUERY_HANDLERS)
+	notifications.migrate_arrays()
+	assert len(db.collection("notifications").documents) == 6
+	assert [db.collection("accounts").documents[account["_key"]]["unread_notifications"] for account in accounts] == [2, 2]
+
+
+def test_conflicting_counter_updates_are_retried(use):
+	import database
+	from conftest import ConflictingDatabase
+	conflicting = use(ConflictingDatabase(database.CONFLICT_ATTEMPTS - 1, { "marked": 1, "unread": 0 }))
+	assert notifications.mark_read("someone") == { "marked": 1, "unread": 0 }
+	assert conflicting.executed == database.CONFLICT_ATTEMPTS
+
+
+def test_counter_updates_drop_the_cached_profile(use):
+	from cache import profile_cache
+	from conftest import ConflictingDatabase
+	use(ConflictingDatabase(0, { "marked": 1, "unread": 0 }))
+	profile_cache.set("someone", ('"_rev"', b"{}"))
+	notifications.mark_read("someone")
+	assert profile_cache.get("someone") is None
@@ -0,0 +1,48 @@
+import pytest
+
+import ratelimit
+
+
+@pytest.fixture
+def throttled(monkeypatch):
+	""" Fresh buckets at the defaults of ratelimit.py for every test. """
+	store = ratelimit.ShardedMemoryStore()
+	monkeypatch.setattr(ratelimit, "username_limiter", ratelimit.TokenBucketLimiter(store, 5, 60))
+	monkeypatch.setattr(ratelimit, "address_limiter", ratelimit.TokenBucketLimiter(store, 20, 60))
+
+
+def guess(client, username: str, index: int, address: str = "127.0.0.1"):
+	return client.get("/accounts/authentication", json={ "username": username, "password": f"guess-{index}" },
+		environ_base={ "REMOTE_ADDR": address })
+
+
+def test_burst_on_one_account_is_throttled_while_reads_succeed(client, db, seed, throttled):
+	target, reader = seed("target@test.dev"), seed("reader@test.dev")
+	guesses, reads = [], []
+	for index in range(30):
+		guesses.append(guess(client, target["username"], index))
+		reads.append(client.get(f'/accounts/{reader["username"]}/'))
+
+	assert [response.status_code for response in guesses] == [403] * 5 + [429] * 25
+	assert all(int(response.headers["Retry-After"]) >= 1 for response in guesses[5:])
+	assert [response.status_code for response in reads] == [200] * 30
+
+
+def test_burst_from_one_address_is_throttled_across_accounts(client, db, seed, throttled):
+	accounts = [seed(f"spread{index}@test.dev") for index in range(25)]
+	statuses = [guess(client, account["username"], index, "203.0.113.7").status_code for index, account in enumerate(accounts)]
+	assert statuses == [403] * 20 + [429] * 5
+	assert guess(client, accounts[0]["username"], 0, "198.51.100.1").status_code == 403
+
+
+def test_throttled_attempts_do_no_database_or_hashing_work(client, db, seed, throttled, monkeypatch):
+	target = seed("untouched@test.dev")
+	for index in range(5):
+		guess(client, target["username"], index)
+
+	import server
+	def fail(*args, **kwargs):
+		raise AssertionError("throttled attempt reached the route")
+	monkeypatch.setattr(server, "get_one_by", fail)
+	monkeypatch.setattr(server.password_hasher, "verify", fail)
+	assert guess(client, target["username"], 5).status_code == 429
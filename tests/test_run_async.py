@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+import pytest
+
+import run_async
+
+
+def request(path: str) -> dict:
+	return { "type": "http", "method": "GET", "path": path, "headers": [], "query_string": b"", "http_version": "1.1" }
+
+
+def serve(path: str) -> list:
+	""" Runs one request through the ASGI app, returns the messages it sent. """
+	sent = []
+
+	async def receive():
+		return { "type": "http.request", "body": b"" }
+
+	async def send(message):
+		sent.append(message)
+
+	asyncio.run(run_async.application(request(path), receive, send))
+	return sent
+
+
+@pytest.fixture
+def profile_read(monkeypatch, db):
+	def replace(fn):
+		monkeypatch.setattr(run_async, "get_hetch_account", fn)
+	return replace
+
+
+def test_failed_profile_read_answers_500(profile_read):
+	async def failing(username, request_headers, send):
+		raise RuntimeError("database gone")
+	profile_read(failing)
+
+	sent = serve("/accounts/someone/")
+	assert [message["type"] for message in sent] == ["http.response.start", "http.response.body"]
+	assert sent[0]["status"] == 500
+	assert json.loads(sent[1]["body"])["status_message"] == "Something went wrong. That's all we know."
+
+
+def test_failure_after_the_response_started_sends_nothing_more(profile_read):
+	async def failing_midway(username, request_headers, send):
+		await send({ "type": "http.response.start", "status": 200, "headers": [] })
+		raise RuntimeError("connection reset")
+	profile_read(failing_midway)
+
+	sent = serve("/accounts/someone/")
+	assert [message["type"] for message in sent] == ["http.response.start"]
+
+
+def test_cancelled_profile_reads_are_not_answered(profile_read):
+	async def cancelled(username, request_headers, send):
+		raise asyncio.CancelledError()
+	profile_read(cancelled)
+
+	with pytest.raises(asyncio.CancelledError):
+		serve("/accounts/someone/")
+
+
+def test_async_database_connects_as_the_configured_user(monkeypatch):
+	from async_database import AsyncDatabase
+	monkeypatch.setenv("ARANGO_USERNAME", "hetch")
+	assert AsyncDatabase().username == "hetch"
+	monkeypatch.delenv("ARANGO_USERNAME")
+	assert AsyncDatabase().username == "root"
+
+
+def test_unreachable_database_answers_503_with_retry_after(db, monkeypatch):
+	from async_database import AsyncDatabase
+	monkeypatch.setenv("ARANGO_BACKOFF", "0")
+	unreachable = AsyncDatabase(url="http://127.0.0.1:9")
+	monkeypatch.setattr(run_async, "database", unreachable)
+
+	for _ in range(unreachable.breaker.threshold + 1):
+		sent = serve("/accounts/someone/")
+		assert sent[0]["status"] == 503
+		assert int(dict(sent[0]["headers"])[b"retry-after"]) >= 1
+		assert json.loads(sent[1]["body"])["status_message"] == "Database unavailable, try again shortly."
+	assert unreachable.breaker.state == "open"
+
+
+def test_flask_responses_are_sent_chunk_by_chunk(monkeypatch):
+	def streaming_app(environ, start_response):
+		start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+		return iter([b'{"line": 1}\n', b"", b'{"line": 2}\n'])
+	monkeypatch.setattr(run_async, "server_instance", streaming_app)
+
+	sent = serve("/accounts/export")
+	assert sent[0]["status"] == 200
+	assert [(message["body"], message.get("more_body", False)) for message in sent[1:]] == [
+		(b'{"line": 1}\n', True), (b'{"line": 2}\n', True), (b"", False)]
+
+
+def test_stream_to_a_gone_client_stops_the_flask_thread(monkeypatch):
+	closed = []
+	class Lines():
+		def __iter__(self):
+			return (b"line\n" for _ in range(run_async.STREAM_QUEUE_SIZE * 10))
+		def close(self):
+			closed.append(True)
+
+	def streaming_app(environ, start_response):
+		start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+		return Lines()
+	monkeypatch.setattr(run_async, "server_instance", streaming_app)
+
+	async def receive():
+		return { "type": "http.request", "body": b"" }
+
+	async def send(message):
+		if message["type"] == "http.response.body":
+			raise OSError("client disconnected")
+
+	with pytest.raises(OSError):
+		asyncio.run(run_async.application(request("/accounts/export"), receive, send))
+	assert closed == [True]
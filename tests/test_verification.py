@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+import verification
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+	""" Messages the email jobs would send. """
+	sent = []
+	def deliver(messages: list) -> list:
+		sent.extend(messages)
+		return [None] * len(messages)
+	monkeypatch.setattr(verification, "deliver", deliver)
+	return sent
+
+
+def queued_code_emails(db) -> list:
+	return [job for job in db.collection("jobs").documents.values() if job["type"] == "verification_email"]
+
+
+def test_login_code_is_not_stored_in_the_job(client, db, seed, outbox):
+	account = seed("twofactor@test.dev", preferences={ "2fa_authentication": True, "is_expire_login": True })
+	response = client.get("/accounts/authentication", json={ "username": account["username"], "password": "test-password" })
+	assert response.status_code == 201
+
+	code = next(iter(db.collection("verification_codes").documents.values()))
+	jobs = queued_code_emails(db)
+	assert [job["payload"] for job in jobs] == [{ "to": "twofactor@test.dev", "code_key": code["_key"] }]
+	assert code["code"] not in json.dumps(jobs)
+
+	assert verification.send_code_emails([job["payload"] for job in jobs]) == [None]
+	assert [(to, body) for to, _, body in outbox] == [("twofactor@test.dev", verification.CODE_EMAIL_BODY.format(code=code["code"]))]
+
+
+def test_emails_of_expired_or_used_codes_are_dropped(db, outbox):
+	expired, used, live = (verification.issue(f"account{index}") for index in range(3))
+	db.collection("verification_codes").documents[expired._key]["expire_at"] = 0
+	assert verification.consume("account1", used.code)
+
+	payloads = [{ "to": f"{name}@test.dev", "code_key": code._key } for name, code in (("expired", expired), ("used", used), ("live", live))]
+	assert verification.send_code_emails(payloads) == [None, None, None]
+	assert [to for to, _, _ in outbox] == ["live@test.dev"]
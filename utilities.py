@@ -1,18 +1,24 @@
-from jwt import PyJWT
-from flask import request
+from jwt import PyJWT, get_unverified_header
+from jwt.exceptions import ExpiredSignatureError, PyJWTError
+from flask import request, g
 from functools import wraps
-from traceback import format_exc
 from os import environ
+from time import time
+from threading import Lock
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from models.response import Response as ResponseModel
+from metrics import logger
+from keys import keyring, hs256_accepted
 
 """ Refactor PyJWT methods """
 jwt = PyJWT()
 
 """ Decorator for reading the data fron the request sent. """
-def parse_request(fn, *args, **kwargs):
-	def decorator():
+def parse_request(fn):
+	@wraps(fn)
+	def decorator(*args, **kwargs):
 		content_type = request.headers.get("Content-Type")
 		if content_type == None:
 			return ResponseModel(cd=400, msg="Request body is empty, application/json is required.").to_json()
@@ -21,10 +27,10 @@ def parse_request(fn, *args, **kwargs):
 		else:
 			try:
 				request.get_json()
-				return fn(*args, **kwargs)
 			except:
-				print(format_exc())
+				logger.warning("Invalid JSON body.", exc_info=True)
 				return ResponseModel(cd=400, msg="Error loading JSON data. Invalid JSON provided.").to_json()
+			return fn(*args, **kwargs)
 	return decorator
 
 
@@ -40,29 +46,130 @@ def validate_request(d: dict, schema: dict) -> list:
 			errors.append({ "error": f"Attribute {schema_key} required in request body.", "type": "Undefined." })
 	return errors
 
-def authenticate_request(ctxt, auth_req, cb):
-	with ctxt():
-		# send a authentication request to the re-authenticate server route within the app
-		authentication_validity = auth_req()
-		if authentication_validity.status == "200 OK":
-			# run the callback function when authentication successful
-			return cb(authentication_validity.json["data"]["p+d"])
-		else:
-			# if failed, return the authentication response
-			return authentication_validity
+""" Raised when a request carries no usable Bearer token. """
+class AuthenticationError(Exception):
+	pass
+
+
+""" Verified tokens with their claims and (kid, alg), kept until they expire so repeat calls skip decoding. """
+class TokenCache():
+	def __init__(self, max_size=4096):
+		self.max_size = max_size
+		self._entries = OrderedDict()
+		self._lock = Lock()
+
+	def get(self, token: str):
+		""" Returns (claims, kid, alg) of a cached token that has not expired, None otherwise. """
+		with self._lock:
+			entry = self._entries.get(token)
+			if entry is None:
+				return None
+			if entry[0]["exp"] <= time():
+				del self._entries[token]
+				return None
+			self._entries.move_to_end(token)
+			return entry
+
+	def set(self, token: str, claims: dict, kid: str, alg: str):
+		# Tokens without an expiry are verified every time.
+		if not isinstance(claims.get("exp"), (int, float)):
+			return
+		with self._lock:
+			self._entries[token] = (claims, kid, alg)
+			self._entries.move_to_end(token)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+token_cache = TokenCache(max_size=int(environ.get("TOKEN_CACHE_SIZE", 4096)))
+
+
+""" The (key, algorithm) tokens with the kid are verified with, tokens without one are legacy HS256. """
+def verification_key(kid: str) -> tuple:
+	if kid is not None:
+		signing_key = keyring.verification_key(kid)
+		if signing_key is None:
+			raise AuthenticationError("Invalid signature provided.")
+		return signing_key.public_key, signing_key.alg
+	if hs256_accepted():
+		return environ["SEED"], "HS256"
+	raise AuthenticationError("Signature algorithm is no longer accepted, sign in again.")
+
+
+""" Decodes the Bearer token of an Authorization header and returns its claims. """
+def verify_authorization(authorization: str) -> dict:
+	if not authorization or "Bearer " not in authorization:
+		raise AuthenticationError("Invalid or no signature provided.")
+
+	token = authorization.split(" ")[1]
+	cached = token_cache.get(token)
+	if cached is not None:
+		# The HS256 deadline and the keyring are checked again, a cached token stops working with its key.
+		claims, kid, alg = cached
+		if verification_key(kid)[1] != alg:
+			raise AuthenticationError("Invalid signature provided.")
+		return claims
+
+	try:
+		kid = get_unverified_header(token).get("kid")
+	except PyJWTError:
+		raise AuthenticationError("Invalid signature provided.")
+	key, algorithm = verification_key(kid)
+	try:
+		claims = jwt.decode(token, key,
+			options={"verify_exp": True},
+			algorithms=[algorithm])
+	except ExpiredSignatureError:
+		raise AuthenticationError("Signature has expired.")
+	except PyJWTError:
+		raise AuthenticationError("Invalid signature provided.")
+	token_cache.set(token, claims, kid, algorithm)
+	return claims
 
 
+""" Decorator that authenticates the request once and puts the token claims on flask.g.authentication. """
+def require_authentication(fn):
+	@wraps(fn)
+	def decorator(*args, **kwargs):
+		authorization = request.headers.get("Authorization")
+		try:
+			g.authentication = verify_authorization(authorization)
+		except AuthenticationError as error:
+			return ResponseModel(cd=403, d={ "p+a": authorization }, msg=str(error)).to_json()
+		return fn(*args, **kwargs)
+	return decorator
+
+
+""" Email addresses allowed to use the administrative routes. """
+ADMIN_EMAIL_ADDRESSES = frozenset(
+	email_address.strip() for email_address in environ.get("ADMIN_EMAIL_ADDRESSES", "").split(",") if email_address.strip())
+
+
+""" Decorator for administrative routes, applied after require_authentication. """
+def require_admin(fn):
+	@wraps(fn)
+	def decorator(*args, **kwargs):
+		if g.authentication.get("email_address") not in ADMIN_EMAIL_ADDRESSES:
+			return ResponseModel(cd=403, msg="Not allowed to access resource.").to_json()
+		return fn(*args, **kwargs)
+	return decorator
+
+
+""" 503 answer for a saturated or unhealthy dependency. """
+def service_unavailable_response(error):
+	return ResponseModel(cd=503, msg=str(error)).to_json(headers={"Retry-After": str(error.retry_after)})
+
+
+""" Signs with the current key of the keyring, or HS256 and SEED when there is none. """
 def generate_authentication_token(payload, is_persist=True):
 	time_now = datetime.utcnow()
 	time_expiry = timedelta(days=7 if not is_persist else 365)
-	
-	return jwt.encode(
-		{
-			"email_address": payload,
-			"exp": time_now + time_expiry
-		},
-
-		environ["SEED"],
-		algorithm="HS256"
-	)
+	claims = {
+		"email_address": payload,
+		"exp": time_now + time_expiry
+	}
+
+	signing_key = keyring.signing_key()
+	if signing_key is None:
+		return jwt.encode(claims, environ["SEED"], algorithm="HS256")
+	return jwt.encode(claims, signing_key.private_key, algorithm=signing_key.alg, headers={"kid": signing_key.kid})
 	
\ No newline at end of file
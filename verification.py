@@ -0,0 +1,139 @@
+"""
+_________________________________
+VERIFICATION CODES
+Two-Factor Authentication codes live in their own collection,
+a TTL index on expire_at removes them once they expire. The email with a
+code is a job that only carries the key of the code, it reads the code
+when it runs and is dropped once the code is gone.
+_________________________________
+"""
+from os import environ
+from sys import argv
+from time import time
+from uuid import uuid4
+
+from database import get_database, load_environment
+from jobs import handler, enqueue
+from mailer import deliver, SMTP_BATCH_SIZE
+from models.verification_code import VerificationCodeModel
+from models.time_created import TimeCreatedModel
+
+
+""" Codes an account can have outstanding at once, the oldest are dropped first. """
+MAX_OUTSTANDING_CODES = int(environ.get("MAX_OUTSTANDING_CODES", 3))
+
+""" Email with a login code, the body is formatted when the email job runs. """
+CODE_EMAIL_SUBJECT = "Your Hetchfund.Capital login code"
+CODE_EMAIL_BODY = "Your Hetchfund.Capital code is {code}. Keep it safe and don't share it, expires in an hour."
+
+""" ArangoDB error numbers of a document removed concurrently. """
+CONCURRENT_REMOVAL_ERRORS = (1200, 1202)
+
+EVICT_QUERY = """
+FOR c IN verification_codes
+	FILTER c.account == @account
+	SORT c.time_created.timestamp DESC
+	LIMIT @keep, 1000
+	REMOVE c IN verification_codes
+"""
+
+CONSUME_QUERY = """
+FOR c IN verification_codes
+	FILTER c.account == @account AND c.code == @code AND c.expire_at > @now
+	LIMIT 1
+	REMOVE c IN verification_codes
+	RETURN OLD._key
+"""
+
+
+""" Stores a new code for the account and returns it. """
+def issue(account_key: str) -> VerificationCodeModel:
+	database = get_database()
+	verification_code = VerificationCodeModel(account=account_key)
+	# Known up front, the email job finds the code by it.
+	verification_code._key = uuid4().hex
+	database.aql.execute(EVICT_QUERY, bind_vars={ "account": account_key, "keep": MAX_OUTSTANDING_CODES - 1 })
+	database.collection("verification_codes").insert(verification_code.to_dict(), silent=True)
+	return verification_code
+
+
+""" Queues the email with the code, the job payload holds the key of the code and never the code itself. """
+def send_code(email_address: str, verification_code: VerificationCodeModel) -> str:
+	return enqueue("verification_email", { "to": email_address, "code_key": verification_code._key })
+
+
+@handler("verification_email", batch_size=SMTP_BATCH_SIZE)
+def send_code_emails(payloads: list) -> list:
+	""" Codes that expired, were used or were replaced before the job ran are not sent, their jobs just complete. """
+	codes = get_database().collection("verification_codes")
+	now = time()
+	errors = [None] * len(payloads)
+	due = []
+	for index, payload in enumerate(payloads):
+		code = codes.get(payload["code_key"])
+		if code is not None and code["expire_at"] > now:
+			due.append((index, (payload["to"], CODE_EMAIL_SUBJECT, CODE_EMAIL_BODY.format(code=code["code"]))))
+	if len(due):
+		for (index, _), error in zip(due, deliver([message for _, message in due])):
+			errors[index] = error
+	return errors
+
+
+""" Checks and removes a code in one operation, a code can only ever be consumed once. """
+def consume(account_key: str, code: str) -> bool:
+	from arango.exceptions import AQLQueryExecuteError
+	try:
+		cursor = get_database().aql.execute(CONSUME_QUERY,
+			bind_vars={ "account": account_key, "code": str(code), "now": time() })
+	except AQLQueryExecuteError as error:
+		# Another request consumed the same code first.
+		if error.error_code in CONCURRENT_REMOVAL_ERRORS:
+			return False
+		raise
+	return len(list(cursor)) > 0
+
+
+REMOVE_ACCOUNT_QUERY = """
+FOR c IN verification_codes
+	FILTER c.account == @account
+	REMOVE c IN verification_codes
+	RETURN 1
+"""
+
+
+""" Removes the outstanding codes of a deleted account, there are at most MAX_OUTSTANDING_CODES. """
+def remove_account(account_key: str) -> int:
+	return len(list(get_database().aql.execute(REMOVE_ACCOUNT_QUERY, bind_vars={ "account": account_key })))
+
+
+"""
+__________________________________
+MIGRATION
+Removes the legacy verification_codes arrays from account documents.
+__________________________________
+"""
+PURGE_ACCOUNT_CODES_QUERY = """
+FOR a IN accounts
+	FILTER HAS(a, "verification_codes")
+	LIMIT @batch_size
+	UPDATE a WITH { verification_codes: null, last_modified: @modified } IN accounts
+	OPTIONS { keepNull: false }
+	RETURN 1
+"""
+
+def purge_account_codes(batch_size: int = 1000) -> int:
+	purged = 0
+	while True:
+		count = len(list(get_database().aql.execute(PURGE_ACCOUNT_CODES_QUERY, bind_vars={
+			"batch_size": batch_size, "modified": TimeCreatedModel().__dict__ })))
+		if count == 0:
+			return purged
+		purged += count
+
+
+if __name__ == "__main__":
+	if len(argv) > 1 and argv[1] == "purge-account-codes":
+		load_environment()
+		print(purge_account_codes())
+	else:
+		print("Usage: python verification.py purge-account-codes")